@@ -4,6 +4,8 @@ import time
 
 sys.path.append('packages')
 
+from packages.lazy_imports import import_report, cold_import_times
+
 # Set the page configuration
 st.set_page_config(page_title='ClimALM', page_icon='🌍', layout='wide')
 
@@ -19,3 +21,31 @@ st.title('ClimALM')
 st.subheader('Collection of streamlit dashboard with implementation of Climate Services tools powered by AI')
 
 st.write(f"Tempo di utilizzo dell'app: {elapsed_time:.2f} secondi")
+
+# Startup timing report
+with st.expander('Startup timing'):
+    st.write('Modules imported on first use in this process')
+    st.table([{'Module': name, 'Import time [s]': round(seconds, 3)} for name, seconds in import_report()])
+
+    if st.button('Measure cold imports'):
+        st.table([{'Module': name, 'Cold import time [s]': None if seconds is None else round(seconds, 3)} for name, seconds in cold_import_times()])
+
+# Statistics of the caches shared by the sessions of this process
+with st.expander('Cache statistics'):
+    if st.button('Show cache statistics'):
+        from packages.CCKP_new_api import s3_pool
+        from packages.CCKP_dataset_cache import dataset_cache
+        from packages.CCKP_point_cache import point_cache
+        from packages.llm_cache import completion_cache
+        from packages.open_meteo_cache import weather_cache
+
+        st.write('Dataset cache (decoded variables and points, in memory)')
+        st.json(dataset_cache.stats())
+        st.write('Point cache (on disk)')
+        st.json(point_cache.stats())
+        st.write('S3 file pool')
+        st.json(s3_pool.stats())
+        st.write('LLM completion cache (on disk)')
+        st.json(completion_cache.stats())
+        st.write('Open-Meteo cache (on disk)')
+        st.json(weather_cache.stats())
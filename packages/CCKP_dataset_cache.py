@@ -0,0 +1,185 @@
+# Dataset cache importations
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+
+# -- PROCESS-WIDE CACHE OF THE DECODED CCKP VARIABLES
+# -- All the sessions of a server process share the variables read from the bucket: a file requested by many users at
+# -- the same time is downloaded once (single-flight), and the least recently used variables are evicted above the budget
+
+
+
+def _nbytes(value):
+
+    # Size in memory of a cached value (xarray objects, NumPy arrays, or the point dictionaries). Lazily opened xarray
+    # objects only hold the metadata and their own file handle, so they are not counted (max_entries bounds them)
+    if not getattr(value, '_in_memory', True):
+        return 0
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values() if isinstance(v, np.ndarray))
+    return 0
+
+
+
+class DatasetCache():
+
+    '''
+    In-memory LRU cache shared by the threads (and so by the Streamlit sessions) of a process.
+
+    Parameters:
+    max_bytes (int): Budget of the cache, in bytes. Default is the CCKP_DATASET_CACHE_BYTES environment variable, or 1 GiB.
+                     With 0 nothing is stored, but concurrent loads of the same key are still merged.
+    max_entries (int): Maximum number of entries, whatever their size (the lazily opened variables count 0 bytes but keep
+                       a file handle open). Default is the CCKP_DATASET_CACHE_ENTRIES environment variable, or 256.
+    decode_bytes (int): Maximum size of a variable read and decoded in memory when it is requested again (see decodes).
+                        Default is the CCKP_DECODE_MAX_BYTES environment variable, or 0: the variables always stay lazy,
+                        so a request never downloads a whole global grid.
+    '''
+
+    def __init__(self, max_bytes = None, max_entries = None, decode_bytes = None):
+
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.environ.get('CCKP_DATASET_CACHE_BYTES', 2 ** 30))
+        self.max_entries = max_entries if max_entries is not None else int(os.environ.get('CCKP_DATASET_CACHE_ENTRIES', 256))
+        self.decode_bytes = decode_bytes if decode_bytes is not None else int(os.environ.get('CCKP_DECODE_MAX_BYTES', 0))
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._requests = OrderedDict()
+        self.bytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'waits': 0, 'errors': 0, 'evictions': 0, 'too_large': 0}
+
+
+    def get(self, key, loader):
+
+        '''
+        Function that returns the cached value of the key, calling loader() on a miss.
+        If another thread is already loading the key, the result of that load is awaited instead of loading it again.
+
+        Parameters:
+        key (tuple): The key of the value (e.g. the url and the variable name).
+        loader (callable): Function that loads the value.
+
+        Returns:
+        value: The cached or loaded value.
+        '''
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return self._entries[key][0]
+
+            future = self._loading.get(key)
+            owner = future is None
+
+            if owner:
+                future = Future()
+                self._loading[key] = future
+                self.counters['misses'] += 1
+            else:
+                self.counters['waits'] += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+                self.counters['errors'] += 1
+            future.set_exception(e)
+            raise
+
+        nbytes = _nbytes(value)
+
+        with self._lock:
+            del self._loading[key]
+
+            if nbytes <= self.max_bytes:
+                self._entries[key] = (value, nbytes)
+                self.bytes += nbytes
+                self._evict()
+            else:
+                self.counters['too_large'] += 1
+
+        future.set_result(value)
+
+        return value
+
+
+    def _evict(self):
+
+        # Removing the least recently used entries until the cache fits in the budget and in the number of entries
+        # (called with the lock held)
+        while (self.bytes > self.max_bytes or len(self._entries) > self.max_entries) and self._entries:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.bytes -= nbytes
+            self.counters['evictions'] += 1
+
+
+    def request(self, key):
+
+        '''
+        Function that counts a request of the key and returns how many times it has been requested (evictions included).
+        Only the max_entries most recently requested keys are counted, so the counters do not grow with the process.
+        '''
+
+        with self._lock:
+            count = self._requests.pop(key, 0) + 1
+            self._requests[key] = count
+            while len(self._requests) > self.max_entries:
+                self._requests.popitem(last=False)
+
+            return count
+
+
+    def fits(self, nbytes):
+
+        '''
+        Function that returns True if a value of nbytes can be stored in the cache.
+        '''
+
+        return nbytes <= self.max_bytes
+
+
+    def decodes(self, nbytes):
+
+        '''
+        Function that returns True if a variable of nbytes can be decoded in memory (see decode_bytes).
+        '''
+
+        return nbytes <= min(self.decode_bytes, self.max_bytes)
+
+
+    def clear(self):
+
+        '''
+        Function that removes all the entries of the cache.
+        '''
+
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+
+    def stats(self):
+
+        '''
+        Function that returns the counters of the cache, with the number of entries, their size and the budget.
+        '''
+
+        with self._lock:
+            requests = self.counters['hits'] + self.counters['misses'] + self.counters['waits']
+            return {**self.counters, 'hit_rate': (self.counters['hits'] + self.counters['waits']) / requests if requests else 0.0,
+                    'entries': len(self._entries), 'max_entries': self.max_entries, 'loading': len(self._loading), 'bytes': self.bytes,
+                    'max_bytes': self.max_bytes, 'decode_bytes': self.decode_bytes}
+
+
+# Shared cache used by all the CCKP objects of the process
+dataset_cache = DatasetCache()
@@ -1,15 +1,452 @@
 # Api importations
-import s3fs
+import numpy as np
 import pandas as pd
-import xarray as xr
-import json
-from json import encoder
+import io
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from packages.lazy_imports import lazy_import
+from packages.CCKP_point_extract import extract_point, extract_point_from_dataset, POINT_BLOCK_SIZE
+from packages.CCKP_reference_index import reference_index
+from packages.variable_catalog import variable_catalog
+from packages.CCKP_point_cache import point_cache
+from packages.CCKP_dataset_cache import dataset_cache
+from packages.point_result import PointResult
+from packages.payload_encoder import encode_columns, encode_columnar, encode_dataframe, encode_scalars
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial
+
+# Heavy modules, imported on first use
+s3fs = lazy_import('s3fs')
+fsspec = lazy_import('fsspec')
+xr = lazy_import('xarray')
 
 # -- PACKAGE FOR RETRIEVING AND MANAGING CCKP RASTER DATA
 # -- AUTHOR jacopo.grassi@wsp.com / jacopo.grassi@polito.it
 
 
 
+class _CountingFile(io.RawIOBase):
+
+    '''
+    Thin wrapper around an open file handle that counts the bytes read through it.
+    The other attributes are forwarded to the wrapped handle, so h5netcdf/h5py can use it as a normal file object.
+    '''
+
+    def __init__(self, handle, pool):
+
+        super().__init__()
+        self.handle = handle
+        self.pool = pool
+
+
+    def read(self, size = -1):
+
+        data = self.handle.read(size)
+        self.pool._count_bytes(len(data))
+        return data
+
+
+    def readinto(self, buffer):
+
+        data = self.handle.read(len(buffer))
+        buffer[:len(data)] = data
+        self.pool._count_bytes(len(data))
+        return len(data)
+
+
+    def seek(self, offset, whence = 0):
+        return self.handle.seek(offset, whence)
+
+
+    def tell(self):
+        return self.handle.tell()
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def close(self):
+
+        self.handle.close()
+        super().close()
+
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+
+
+class S3FilePool():
+
+    '''
+    Process-wide pool of filesystems and file handles for the CCKP bucket.
+
+    The filesystems are created once per protocol and kept alive, so the connections (and the TLS sessions) are reused
+    between requests and between Streamlit sessions. The handles are never shared: open returns a new handle owned by the
+    caller (e.g. a lazily opened dataset, which closes it when it is garbage collected), and borrow lends an idle handle to
+    a single caller at a time, for the short reads (e.g. a point) that open and close the file in a block. Only the idle
+    handles are kept by the pool: when more than max_handles are idle, the least recently used one is closed.
+
+    Parameters:
+    max_handles (int): Maximum number of idle file handles kept open.
+    storage_options (dict): Options passed to the s3 filesystem. Default is anonymous access.
+    '''
+
+    def __init__(self, max_handles = 64, storage_options = None):
+
+        self.max_handles = max_handles
+        self.storage_options = {'anon': True} if storage_options is None else storage_options
+
+        self._lock = threading.RLock()
+        self._filesystems = {}
+        self._idle = OrderedDict()
+        self._borrowed = 0
+
+        self.counters = {'filesystems_created': 0, 'handles_opened': 0, 'handles_reused': 0, 'handles_closed': 0, 'bytes_read': 0}
+
+
+    def filesystem(self, url):
+
+        '''
+        Function that returns the shared filesystem for the protocol of the url, creating it on first use.
+        '''
+
+        protocol = url.split('://')[0] if '://' in url else 'file'
+
+        with self._lock:
+            if protocol not in self._filesystems:
+                if protocol == 's3':
+                    self._filesystems[protocol] = s3fs.S3FileSystem(**self.storage_options)
+                else:
+                    self._filesystems[protocol] = fsspec.filesystem(protocol)
+                self.counters['filesystems_created'] += 1
+
+            return self._filesystems[protocol]
+
+
+    def open(self, url, block_size = None):
+
+        '''
+        Function that opens a new (read-only) handle for the url, through the shared filesystem.
+        The handle belongs to the caller: the pool never closes it.
+
+        Parameters:
+        url (str): The url of the file.
+        block_size (int): Size of the blocks fetched for each read. Default is the one of the filesystem.
+                          Small blocks are used for point reads, where only a few chunks of the file are needed.
+
+        Returns:
+        handle (_CountingFile): The open file handle.
+        '''
+
+        if block_size is None:
+            handle = _CountingFile(self.filesystem(url).open(url, 'rb'), self)
+        else:
+            handle = _CountingFile(self.filesystem(url).open(url, 'rb', block_size=block_size), self)
+
+        with self._lock:
+            self.counters['handles_opened'] += 1
+
+        return handle
+
+
+    @contextmanager
+    def borrow(self, url, block_size = None):
+
+        '''
+        Context manager that lends an open handle for the url to the caller until the end of the block, reusing an idle
+        one if present. The handle is used by a single thread at a time, and it must not be kept after the block.
+
+        Parameters:
+        url (str): The url of the file.
+        block_size (int): Size of the blocks fetched for each read (see open).
+
+        Yields:
+        handle (_CountingFile): The open file handle.
+        '''
+
+        key = (url, block_size)
+
+        with self._lock:
+            handles = self._idle.get(key)
+            handle = handles.pop() if handles else None
+            if handles is not None and not handles:
+                del self._idle[key]
+            if handle is not None:
+                self.counters['handles_reused'] += 1
+            self._borrowed += 1
+
+        try:
+            # Opening outside the lock, so that concurrent requests for different files do not wait for each other
+            if handle is None:
+                handle = self.open(url, block_size)
+
+            yield handle
+
+        except BaseException:
+            # A handle left in an unknown state by an error is not reused
+            if handle is not None:
+                self._close(handle)
+                handle = None
+            raise
+
+        finally:
+            with self._lock:
+                self._borrowed -= 1
+                if handle is not None:
+                    self._idle.setdefault(key, []).append(handle)
+                    self._idle.move_to_end(key)
+                    self._evict()
+
+
+    def _close(self, handle):
+
+        handle.close()
+        with self._lock:
+            self.counters['handles_closed'] += 1
+
+
+    def _evict(self):
+
+        # Closing the least recently used idle handles until at most max_handles are idle (called with the lock held)
+        while sum(len(handles) for handles in self._idle.values()) > self.max_handles:
+            key, handles = next(iter(self._idle.items()))
+            self._close(handles.pop(0))
+            if not handles:
+                del self._idle[key]
+
+
+    def close(self, url):
+
+        '''
+        Function that closes the idle handles of the url, if any. The handles in use are not affected.
+        '''
+
+        with self._lock:
+            for key in [key for key in self._idle if key[0] == url]:
+                for handle in self._idle.pop(key):
+                    self._close(handle)
+
+
+    def close_all(self):
+
+        '''
+        Function that closes all the idle handles. The handles in use and the filesystems are not affected.
+        '''
+
+        with self._lock:
+            for url in {key[0] for key in self._idle}:
+                self.close(url)
+
+
+    def stats(self):
+
+        '''
+        Function that returns a copy of the counters, together with the number of idle and borrowed handles.
+        '''
+
+        with self._lock:
+            return {**self.counters, 'handles_idle': sum(len(handles) for handles in self._idle.values()), 'handles_borrowed': self._borrowed}
+
+
+    def _count_bytes(self, nbytes):
+
+        with self._lock:
+            self.counters['bytes_read'] += nbytes
+
+
+# Shared pool used by all the CCKP objects of the process
+s3_pool = S3FilePool()
+
+
+
+def run_jobs(jobs, function, concurrent = False, max_workers = 7, errors = None):
+
+    '''
+    Function that runs groups of jobs and collects their results.
+
+    Parameters:
+    jobs (dict): Dictionary with the groups of jobs. Each job is a tuple with the arguments of the function.
+    function (callable): The function called for each job.
+    concurrent (bool): If True, all the jobs are submitted at the same time to a thread pool.
+    max_workers (int): Maximum number of jobs running at the same time when concurrent is True.
+    errors (dict): If given, it is filled with the error (the repr of the exception) of each failed group.
+
+    Returns:
+    results (dict): Dictionary with the list of results of each group, or None if any job of the group failed.
+    '''
+
+    def collect(key, group):
+        try:
+            return [job.result() if isinstance(job, Future) else job() for job in group]
+        except Exception as e:
+            if errors is not None:
+                errors[key] = repr(e)
+            return None
+
+    if concurrent:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {key: [executor.submit(function, *job) for job in group] for key, group in jobs.items()}
+            return {key: collect(key, group) for key, group in futures.items()}
+
+    return {key: collect(key, [partial(function, *job) for job in group]) for key, group in jobs.items()}
+
+
+
+def read_point(url, variable_name, lat, lon):
+
+    '''
+    Function that returns the values of a variable in the grid cell nearest to (lat, lon).
+    The process-wide cache is consulted first (concurrent requests of the same cell are merged in a single read), then the
+    persistent point cache; on a miss only the chunks of the cell are read from the bucket, and the extracted point is stored
+    in the caches. The cells are resolved in the coordinates of the file, stored with its first point.
+
+    Parameters:
+    url (str): The url of the file.
+    variable_name (str): The name of the variable in the file.
+    lat (float): The latitude of the location.
+    lon (float): The longitude of the location.
+
+    Returns:
+    point (dict): The point (see CCKP_point_extract.extract_point).
+    '''
+
+    # Before the first point of the url, its coordinates are not known: the key is the location itself
+    cell = point_cache.cell(url, lat, lon) or (lat, lon)
+
+    return dataset_cache.get(('point', url, variable_name) + tuple(cell), partial(_read_point, url, variable_name, lat, lon))
+
+
+def _read_point(url, variable_name, lat, lon):
+
+    point = point_cache.get(url, lat, lon)
+
+    if point is None:
+        dataset = reference_index.open_dataset(url)
+
+        if dataset is not None:
+            # Indexed file: the chunk offsets are known, no metadata is read from the bucket
+            point = extract_point_from_dataset(dataset, variable_name, lat, lon)
+        else:
+            # Small blocks: only the coordinates and the chunks of the cell are read
+            with s3_pool.borrow(url, block_size=POINT_BLOCK_SIZE) as filejob:
+                point = extract_point(filejob, variable_name, lat, lon)
+
+        # The coordinates of the grid are stored once per url, not with every point
+        point_cache.put_coordinates(url, point.pop('lat_values'), point.pop('lon_values'))
+        point_cache.put(url, point)
+
+    return point
+
+
+
+def site_indexers(lats, lons, site_ids):
+
+    '''
+    Function that returns the lat/lon indexers for the vectorized pointwise selection of many sites (one value per site, not the grid lats x lons).
+    '''
+
+    lat_points = xr.DataArray(np.asarray(lats, dtype=float), dims='site', coords={'site': site_ids})
+    lon_points = xr.DataArray(np.asarray(lons, dtype=float), dims='site', coords={'site': site_ids})
+
+    return lat_points, lon_points
+
+
+
+def dataframe_to_json(dataframe, columnar = False):
+
+    '''
+    Function that rounds a point dataframe to 2 decimals and converts it to the json sent to the LLM (see payload_encoder).
+    '''
+
+    return encode_dataframe(dataframe, columnar=columnar)
+
+
+def dataset_to_columns(dataset):
+
+    '''
+    Function that returns the arrays of the variables of a point dataset (e.g. the trends of a site), as {name: values}.
+    '''
+
+    return {name: np.atleast_1d(dataset[name].values) for name in dataset.data_vars}
+
+
+def encode_point(index, columns, columnar = False):
+
+    # Point timeseries in the layout of the point jsons, or in the columnar layout
+    if columnar:
+        return encode_columnar(index, columns)
+    return encode_columns(index, columns)
+
+
+def encode_single_row(columns, columnar = False):
+
+    # Trends and confidences have a single value for each column
+    if columnar:
+        return encode_scalars(columns)
+    return encode_columns(np.arange(len(next(iter(columns.values()), []))), columns)
+
+
+
+def open_dataset(url):
+
+    '''
+    Function that lazily opens a CCKP file: through the reference index if the url is indexed, otherwise from the bucket
+    through the shared pool.
+
+    Parameters:
+    url (str): The url of the file.
+
+    Returns:
+    dataset (xr.Dataset): The opened dataset.
+    '''
+
+    dataset = reference_index.open_dataset(url)
+
+    if dataset is None:
+        # Reading the data from the s3 bucket through a handle of the shared filesystem, owned by the dataset
+        dataset = xr.open_dataset(s3_pool.open(url))
+
+    return dataset
+
+
+
+def open_variable(url, variable_name):
+
+    '''
+    Function that returns a variable of a CCKP file through the process-wide dataset cache.
+
+    The variable is opened lazily, as open_dataset does, so a single point only reads its chunks. If the dataset cache allows
+    it (decode_bytes, off by default), a variable small enough that is requested again (by another object or session) is read
+    and decoded in memory once, and then shared by all the objects and sessions of the process. Concurrent requests trigger
+    a single download.
+
+    Parameters:
+    url (str): The url of the file.
+    variable_name (str): The name of the variable in the file.
+
+    Returns:
+    data (xr.DataArray): The variable.
+    '''
+
+    key = ('variable', url, variable_name)
+    data = dataset_cache.get(key, lambda: open_dataset(url)[variable_name])
+
+    # Only the variables that can be decoded are counted
+    if not data._in_memory and dataset_cache.decodes(data.nbytes) and dataset_cache.request(key) > 1:
+        # The shallow copy is loaded, so the shared lazy variable stays lazy
+        data = dataset_cache.get(('decoded', url, variable_name), lambda: data.copy(deep=False).load())
+
+    return data
+
+
+
 era5_dict = {
     'collection' : ['era5-x0.25'],
     'variables' : vars,
@@ -55,9 +492,24 @@ cmip_dict = {
 }
 
 
+# Products and trend windows that can be selected on CCKP_api_ERA5
+ERA5_PRODUCTS = ['timeseries', 'climatology', 'trend', 'trendconfidence']
+ERA5_WINDOWS = ['1951-2020', '1971-2020', '1991-2020']
+
+
 class CCKP_api_ERA5():
 
-    def __init__(self, variable, climatology = False):
+    '''
+    Parameters:
+    variable (str): The code of the variable.
+    climatology (bool): If True, the 1991-2020 climatology is used instead of the 1950-2022 timeseries.
+    products (list): The products to retrieve, among timeseries, climatology, trend and trendconfidence. Timeseries and
+                     climatology are alternative (they fill the same timeseries dataframe). Default is the timeseries
+                     (or the climatology), the trends and the trend confidences.
+    windows (list): The windows of the trends and trend confidences, among 1951-2020, 1971-2020 and 1991-2020. Default is all.
+    '''
+
+    def __init__(self, variable, climatology = False, products = None, windows = None):
 
         
         self.base_url = 's3://wbg-cckp/data'
@@ -70,7 +522,29 @@ class CCKP_api_ERA5():
         self.percentile = 'mean'
 
         self.variables_dict = self.create_dict()
-        self.status_dict = {'timeseries': 'Not Retrieved', 'trend': 'Not Retrieved', 'confidence': 'Not Retrieved'}
+
+        # Selection of the products
+        if products is None:
+            products = ['climatology' if climatology else 'timeseries', 'trend', 'trendconfidence']
+        if windows is None:
+            windows = ERA5_WINDOWS
+
+        unknown = [p for p in products if p not in ERA5_PRODUCTS] + [w for w in windows if w not in ERA5_WINDOWS]
+        if unknown:
+            raise ValueError(f'Unknown products or windows: {unknown}')
+        if 'timeseries' in products and 'climatology' in products:
+            raise ValueError('timeseries and climatology are alternative, select only one of them')
+
+        self.products = [p for p in ERA5_PRODUCTS if p in products]
+        self.windows = [w for w in ERA5_WINDOWS if w in windows]
+
+        if 'timeseries' in products or 'climatology' in products:
+            climatology = 'climatology' in products
+
+        self.status_dict = {key: 'Not Retrieved' if jobs else 'Not Requested' for key, jobs in self.selected_groups().items()}
+
+        # Errors of the products (or bands) that could not be retrieved
+        self.errors_dict = {}
 
         self.climatology = climatology
         
@@ -106,6 +580,16 @@ class CCKP_api_ERA5():
 
 
 
+    def urls(self):
+
+        '''
+        Function that returns the urls of all the files used by the object.
+        '''
+
+        return [url for group in self.product_jobs().values() for url, _, _ in group]
+
+
+
     def create_dict(self, vars = None):
 
         '''
@@ -118,20 +602,51 @@ class CCKP_api_ERA5():
         variables_dict (dict): Dictionary with the names of the variables and their descriptions.
         '''
 
-        # Import the table with the names of the variables
-        names_table = pd.read_excel('packages/geonames.xlsx', sheet_name='Variables')
+        # Lookup in the catalog of the variables, loaded once per process
+        return variable_catalog().get(self.variable)
+
+
+    def open_product(self, url, product, name = None):
+
+        '''
+        Function that opens one CCKP file and returns the data array of the product.
+
+        Parameters:
+        url (str): The url of the file.
+        product (str): The product stored in the file (timeseries, climatology, trend, trendconfidence).
+        name (str): If given, the data array is renamed and the time coordinate is dropped (used for trends and confidences).
+
+        Returns:
+        data (xr.DataArray): The data array of the product.
+        '''
+
+        # Reading the variable through the shared cache (the bounds variables are not part of it)
+        data = open_variable(url, f'{product}-{self.variable}-{self.aggregation_period}-{self.statistic}')
 
-        # Keep only the rows of the table that correspond to the variables in the list, and convert it to a dictionary [CODE as index]
-        variables_dict = names_table[names_table['Code'] == self.variable].set_index('Code').to_dict()
-        variables_dict = {k: v[self.variable] for k, v in variables_dict.items()}
-        variables_dict['Code'] = self.variable
+        if name is not None:
+            data = data.rename(name).drop_vars('time')
 
-        return variables_dict
+        return data
 
 
-    def retrieve_request(self) -> xr.Dataset:
+    def selected_groups(self):
 
         '''
+        Function that returns, for each group of the status_dict, the selected windows (an empty list if the group is not requested).
+        The timeseries group has the single window of its file.
+        '''
+
+        return {
+            'timeseries': ['1991-2020' if 'climatology' in self.products else '1950-2022'] if {'timeseries', 'climatology'} & set(self.products) else [],
+            'trend': self.windows if 'trend' in self.products else [],
+            'confidence': self.windows if 'trendconfidence' in self.products else [],
+        }
+
+
+    def product_jobs(self):
+
+        '''
+        Function that returns the files to open for each requested group of the status_dict, as (url, product, name) tuples.
         '''
 
         if self.climatology:
@@ -139,111 +654,257 @@ class CCKP_api_ERA5():
         else:
             product = 'timeseries'
 
-        try:
-            # Creating the s3 file system
-            fs = s3fs.S3FileSystem()
+        groups = self.selected_groups()
+        jobs = {}
 
-            # Reading the data from the s3 bucket
-            fs = s3fs.S3FileSystem(anon=True)
-            filejob = fs.open(self.retrieve_url_timeseries)
+        if groups['timeseries']:
+            jobs['timeseries'] = [(self.retrieve_url_timeseries, product, None)]
 
-            # Opening the dataset, rechunking it and dropping the unnecessary variables
-            dataset = xr.open_dataset(filejob)
-            dataset = dataset.drop_vars(['lat_bnds', 'lon_bnds', 'bnds'])
-            
-            self.timeseries_dataset = dataset[f'{product}-{self.variable}-{self.aggregation_period}-{self.statistic}']
+        if groups['trend']:
+            jobs['trend'] = [(url, 'trend', self.variable + '_trend_' + years.replace('-', '_'))
+                             for url, years in zip([self.retrieve_url_trend_1951_2020, self.retrieve_url_trend_1971_2020, self.retrieve_url_trend_1991_2020], ERA5_WINDOWS)
+                             if years in groups['trend']]
 
-            # if self.product == 'timeseries':
-            #     self.dataset.values = self.dataset.values.astype(float) / self.variable_attr('normalization_factor')
-            self.status_dict['timeseries'] = 'Retrieved'
-            
-        except:
+        if groups['confidence']:
+            jobs['confidence'] = [(url, 'trendconfidence', self.variable + '_trend_confidence_' + years.replace('-', '_'))
+                                  for url, years in zip([self.retrieve_url_confidence_1951_2020, self.retrieve_url_confidence_1971_2020, self.retrieve_url_confidence_1991_2020], ERA5_WINDOWS)
+                                  if years in groups['confidence']]
+
+        return jobs
+
+
+    def retrieve_request(self, concurrent = False, max_workers = 7) -> 'xr.Dataset':
+
+        '''
+        Function that retrieves the timeseries (or climatology), the trends and the trend confidences of the variable.
+
+        Parameters:
+        concurrent (bool): If True, all the files are opened at the same time with a thread pool, so that the time
+                           needed is bounded by the slowest file instead of the sum. Default is False (one file after the other).
+        max_workers (int): Maximum number of files opened at the same time when concurrent is True.
+        '''
+
+        results = run_jobs(self.product_jobs(), self.open_product, concurrent, max_workers, self.errors_dict)
+
+        # Only the requested products are retrieved
+        if 'timeseries' in results:
+            if results['timeseries'] is not None:
+                self.timeseries_dataset = results['timeseries'][0]
+                self.status_dict['timeseries'] = 'Retrieved'
+            else:
                 self.status_dict['timeseries'] = 'Error'
-        
 
-        
-        try:
-            trend_dts = []
-            for url,years in zip([self.retrieve_url_trend_1951_2020, self.retrieve_url_trend_1971_2020, self.retrieve_url_trend_1991_2020], ['1951_2020', '1971_2020', '1991_2020']):
-                
-                    # Creating the s3 file system
-                    fs = s3fs.S3FileSystem()
+        if 'trend' in results:
+            if results['trend'] is not None:
+                self.trends_dataset = xr.merge(results['trend'])
+                self.status_dict['trend'] = 'Retrieved'
+            else:
+                self.status_dict['trend'] = 'Error'
 
-                    # Reading the data from the s3 bucket
-                    fs = s3fs.S3FileSystem(anon=True)
-                    filejob = fs.open(url)
+        if 'confidence' in results:
+            if results['confidence'] is not None:
+                self.confidence_dataset = xr.merge(results['confidence'])
+                self.status_dict['confidence'] = 'Retrieved'
+            else:
+                self.status_dict['confidence'] = 'Error'
 
-                    # Opening the dataset, rechunking it and dropping the unnecessary variables
-                    dataset = xr.open_dataset(filejob)
-                    dataset = dataset.drop_vars(['lat_bnds', 'lon_bnds', 'bnds'])
 
-                    trend_dts.append(dataset[f'trend-{self.variable}-{self.aggregation_period}-{self.statistic}'].rename(self.variable + '_trend_' + years).drop('time'))
-            
-            self.trends_dataset = xr.merge(trend_dts)
-            self.status_dict['trend'] = 'Retrieved'
-            
-        except:
-            self.status_dict['trend'] = 'Error'
+    def open_point(self, url, product, lat, lon):
 
-        
+        '''
+        Function that reads only the grid cell nearest to (lat, lon) from one CCKP file, or from the point cache (see read_point).
+        '''
 
-        try:
-            conf_dts = []
-            for url,years in zip([self.retrieve_url_confidence_1951_2020, self.retrieve_url_confidence_1971_2020, self.retrieve_url_confidence_1991_2020], ['1951_2020', '1971_2020', '1991_2020']):
-                
-                    # Creating the s3 file system
-                    fs = s3fs.S3FileSystem()
+        return read_point(url, f'{product}-{self.variable}-{self.aggregation_period}-{self.statistic}', lat, lon)
 
-                    # Reading the data from the s3 bucket
-                    fs = s3fs.S3FileSystem(anon=True)
-                    filejob = fs.open(url)
 
-                    # Opening the dataset, rechunking it and dropping the unnecessary variables
-                    dataset = xr.open_dataset(filejob)
-                    dataset = dataset.drop_vars(['lat_bnds', 'lon_bnds', 'bnds'])
+    def retrieve_point(self, lat, lon, concurrent = True, max_workers = 7):
 
-                    conf_dts.append(dataset[f'trendconfidence-{self.variable}-{self.aggregation_period}-{self.statistic}'].rename(self.variable + '_trend_confidence_' + years).drop('time'))
-            
-            self.confidence_dataset = xr.merge(conf_dts)
-            self.status_dict['confidence'] = 'Retrieved'
-        except:
-            self.status_dict['confidence'] = 'Error'
+        '''
+        Function that retrieves the data of a single location, reading from each file only the chunks of the nearest grid cell.
+        It replaces retrieve_request + load_point when the global grids are not needed, and fills the same point dataframes and jsons.
+
+        Parameters:
+        lat (float): The latitude of the location.
+        lon (float): The longitude of the location.
+        concurrent (bool): If True, the files are read at the same time with a thread pool.
+        max_workers (int): Maximum number of files read at the same time when concurrent is True.
+        '''
+
+        jobs = self.product_jobs()
+        results = run_jobs({key: [(url, product, lat, lon) for url, product, _ in group] for key, group in jobs.items()}, self.open_point, concurrent, max_workers,
+                           self.errors_dict)
+
+        # The products not requested are left as empty dataframes
+        self.timeseries_point_dataframe = pd.DataFrame()
+        self.trends_point_dataframe = pd.DataFrame()
+        self.confidence_point_dataframe = pd.DataFrame()
+
+        if 'timeseries' in results:
+            if results['timeseries'] is not None:
+                point = results['timeseries'][0]
+                _, product, _ = jobs['timeseries'][0]
+                values = point['values'].astype(float) / self.variables_dict['Normalization factor']
+                self.timeseries_point_dataframe = pd.DataFrame({f'{product}-{self.variable}-{self.aggregation_period}-{self.statistic}': values},
+                                                               index=pd.DatetimeIndex(point['time'], name='time').year)
+                self.status_dict['timeseries'] = 'Retrieved'
+            else:
+                self.status_dict['timeseries'] = 'Error'
+
+        if 'trend' in results:
+            if results['trend'] is not None:
+                self.trends_point_dataframe = pd.DataFrame({name: point['values'] for (_, _, name), point in zip(jobs['trend'], results['trend'])})
+                self.status_dict['trend'] = 'Retrieved'
+            else:
+                self.status_dict['trend'] = 'Error'
+
+        if 'confidence' in results:
+            if results['confidence'] is not None:
+                self.confidence_point_dataframe = pd.DataFrame({name: point['values'] for (_, _, name), point in zip(jobs['confidence'], results['confidence'])})
+                self.status_dict['confidence'] = 'Retrieved'
+            else:
+                self.status_dict['confidence'] = 'Error'
+
+        self.point_to_json()
 
 
     def load_point(self, lat, lon):
          
 
-        self.timeseries_point_dataframe = self.timeseries_dataset.sel(lat=lat, lon=lon, method='nearest')
-        self.timeseries_point_dataframe.values = self.timeseries_point_dataframe.values.astype(float) / self.variables_dict['Normalization factor']
-        self.timeseries_point_dataframe = self.timeseries_point_dataframe.to_dataframe().drop(columns=['lat', 'lon'])
-        self.timeseries_point_dataframe.index = self.timeseries_point_dataframe.index.year
+        # The products not retrieved are left as empty dataframes
+        self.timeseries_point_dataframe = pd.DataFrame()
+        self.trends_point_dataframe = pd.DataFrame()
+        self.confidence_point_dataframe = pd.DataFrame()
 
-        self.trends_point_dataframe = self.trends_dataset.sel(lat=lat, lon=lon, method='nearest').to_dataframe().drop(columns=['lat', 'lon'])
-        self.confidence_point_dataframe = self.confidence_dataset.sel(lat=lat, lon=lon, method='nearest').to_dataframe().drop(columns=['lat', 'lon'])
+        if self.timeseries_dataset is not None:
+            self.timeseries_point_dataframe = self.timeseries_dataset.sel(lat=lat, lon=lon, method='nearest')
+            self.timeseries_point_dataframe.values = self.timeseries_point_dataframe.values.astype(float) / self.variables_dict['Normalization factor']
+            self.timeseries_point_dataframe = self.timeseries_point_dataframe.to_dataframe().drop(columns=['lat', 'lon'])
+            self.timeseries_point_dataframe.index = self.timeseries_point_dataframe.index.year
 
+        if self.trends_dataset is not None:
+            self.trends_point_dataframe = self.trends_dataset.sel(lat=lat, lon=lon, method='nearest').to_dataframe().drop(columns=['lat', 'lon'])
 
-        # Rounding precision of dataframes to 2
-        self.timeseries_point_dataframe = self.timeseries_point_dataframe.round(2)
-        self.trends_point_dataframe = self.trends_point_dataframe.round(2)
-        self.confidence_point_dataframe = self.confidence_point_dataframe.round(2)
+        if self.confidence_dataset is not None:
+            self.confidence_point_dataframe = self.confidence_dataset.sel(lat=lat, lon=lon, method='nearest').to_dataframe().drop(columns=['lat', 'lon'])
 
+        self.point_to_json()
 
 
-        self.timeseries_point_json = self.timeseries_point_dataframe.astype(str).to_json()
-        self.trends_point_json = self.trends_point_dataframe.astype(str).to_json()
-        self.confidence_point_json = self.confidence_point_dataframe.astype(str).to_json()
-        
-        encoder.FLOAT_REPR = lambda o: format(o, '.2f')
+    def point_to_json(self):
 
-        # Roubding precision of jsons to 2
-        self.timeseries_point_json = json.loads(self.timeseries_point_json)
-        self.trends_point_json = json.loads(self.trends_point_json)
-        self.confidence_point_json = json.loads(self.confidence_point_json)
+        '''
+        Function that converts the point dataframes to the jsons sent to the LLM, with 2 decimals.
+        '''
 
+        # Encoding the arrays directly: the values are rounded by the encoder, not in the dataframes
+        self.timeseries_point_json = dataframe_to_json(self.timeseries_point_dataframe)
+        self.trends_point_json = dataframe_to_json(self.trends_point_dataframe)
+        self.confidence_point_json = dataframe_to_json(self.confidence_point_dataframe)
 
-    def make_json_to_llm(self):
-         
-        self.json_to_llm = {
+
+    def load_points(self, lats, lons, site_ids = None, columnar = False):
+
+        '''
+        Function that extracts many locations at once from the retrieved datasets, with vectorized pointwise indexing.
+        The files are opened once by retrieve_request and then serve every site on the same grid.
+
+        Parameters:
+        lats (list): The latitudes of the sites.
+        lons (list): The longitudes of the sites.
+        site_ids (list): The identifiers of the sites. Default is the position in the lists.
+        columnar (bool): If True, the jsons use the compact columnar layout (see make_json_to_llm).
+
+        Returns:
+        sites_dataframe (pd.DataFrame): Tidy dataframe with site, year and value columns (timeseries in unit).
+        sites_json_to_llm (dict): The json sent to the LLM for each site, with the same structure of json_to_llm.
+        '''
+
+        site_ids = list(range(len(lats))) if site_ids is None else list(site_ids)
+        lat_points, lon_points = site_indexers(lats, lons, site_ids)
+
+        # The products not retrieved give empty jsons (and no rows in the sites dataframe for the timeseries)
+        timeseries, trends, confidences = None, None, None
+        self.sites_dataframe = pd.DataFrame({'site': [], 'year': [], 'value': []})
+
+        if self.timeseries_dataset is not None:
+            timeseries = self.timeseries_dataset.sel(lat=lat_points, lon=lon_points, method='nearest').transpose('time', 'site')
+            values = timeseries.values.astype(float) / self.variables_dict['Normalization factor']
+            years = timeseries['time'].dt.year.values
+
+            self.sites_dataframe = pd.DataFrame({'site': np.tile(site_ids, len(years)), 'year': np.repeat(years, len(site_ids)), 'value': values.ravel()})
+
+        if self.trends_dataset is not None:
+            trends = self.trends_dataset.sel(lat=lat_points, lon=lon_points, method='nearest').drop_vars(['lat', 'lon'])
+
+        if self.confidence_dataset is not None:
+            confidences = self.confidence_dataset.sel(lat=lat_points, lon=lon_points, method='nearest').drop_vars(['lat', 'lon'])
+
+        self.sites_json_to_llm = {}
+        for i, site in enumerate(site_ids):
+            timeseries_json = encode_point(years, {timeseries.name: values[:, i]}, columnar) if timeseries is not None else {}
+            trends_json = encode_single_row(dataset_to_columns(trends.isel(site=i)), columnar) if trends is not None else {}
+            confidence_json = encode_single_row(dataset_to_columns(confidences.isel(site=i)), columnar) if confidences is not None else {}
+
+            self.sites_json_to_llm[site] = self.payload(timeseries_json, trends_json, confidence_json)
+
+        return self.sites_dataframe, self.sites_json_to_llm
+
+
+    def make_json_to_llm(self, columnar = False):
+
+        '''
+        Function that builds the json sent to the LLM from the point data.
+        With columnar the timeseries is {'time': [years], 'values': {column: [numbers]}} and the trends and confidences are
+        {column: number}, instead of the {column: {index: 'string'}} layout: the payload is smaller and faster to build.
+        '''
+
+        if columnar:
+            self.json_to_llm = self.payload(dataframe_to_json(self.timeseries_point_dataframe, columnar=True),
+                                            encode_scalars(self.trends_point_dataframe), encode_scalars(self.confidence_point_dataframe))
+        else:
+            self.json_to_llm = self.payload(self.timeseries_point_json, self.trends_point_json, self.confidence_point_json)
+
+
+    def release_datasets(self):
+
+        '''
+        Function that drops the references to the global-grid datasets opened by retrieve_request.
+        '''
+
+        self.timeseries_dataset = None
+        self.trends_dataset = None
+        self.confidence_dataset = None
+
+
+    def point_result(self, release = True):
+
+        '''
+        Function that returns the compact PointResult of the location loaded by retrieve_point or load_point, and releases the datasets.
+        make_json_to_llm must be called first.
+
+        Parameters:
+        release (bool): If False, the datasets are kept (for a caller that does not own the object).
+        '''
+
+        if release:
+            self.release_datasets()
+
+        return PointResult.from_dataframes('ERA5', self.variable, 'historical', self.variables_dict, self.status_dict, self.selected_groups(),
+                                           self.timeseries_point_dataframe, self.trends_point_dataframe, self.confidence_point_dataframe, self.json_to_llm)
+
+
+    def payload(self, timeseries_json, trends_json, confidence_json):
+
+        '''
+        Function that builds the json sent to the LLM from the jsons of the timeseries, the trends and the confidences.
+        Only the requested products are included.
+        '''
+
+        groups = self.selected_groups()
+        values = {'timeseries in unit': timeseries_json, 'trends in units/decades': trends_json, 'confidence in percentage': confidence_json}
+
+        return {
             
             'var_code': self.variable,
             'var_name': self.variables_dict['Variable'],
@@ -251,11 +912,7 @@ class CCKP_api_ERA5():
             'description': self.variables_dict['Description'],
             'status': self.status_dict,
 
-            'values': {
-            'timeseries in unit': self.timeseries_point_json,
-            'trends in units/decades': self.trends_point_json,
-            'confidence in percentage': self.confidence_point_json
-            }
+            'values': {k: v for (k, v), group in zip(values.items(), ['timeseries', 'trend', 'confidence']) if groups[group]}
 
         }
 
@@ -284,6 +941,9 @@ class CCKP_api_CMIP6():
         self.variables_dict = self.create_dict()
         self.status_dict = {'timeseries': 'Not Retrieved', 'trend': 'Not Retrieved', 'confidence': 'Not Retrieved'}
 
+        # Errors of the bands that could not be retrieved
+        self.errors_dict = {}
+
         self.bands = bands
 
         if climatology:
@@ -315,6 +975,16 @@ class CCKP_api_CMIP6():
 
 
 
+    def urls(self):
+
+        '''
+        Function that returns the urls of all the files used by the object.
+        '''
+
+        return [url for band in self.bands for url in self.band_urls(band)]
+
+
+
     def create_dict(self, vars = None):
 
         '''
@@ -327,18 +997,11 @@ class CCKP_api_CMIP6():
         variables_dict (dict): Dictionary with the names of the variables and their descriptions.
         '''
 
-        # Import the table with the names of the variables
-        names_table = pd.read_excel('packages/geonames.xlsx', sheet_name='Variables')
-
-        # Keep only the rows of the table that correspond to the variables in the list, and convert it to a dictionary [CODE as index]
-        variables_dict = names_table[names_table['Code'] == self.variable].set_index('Code').to_dict()
-        variables_dict = {k: v[self.variable] for k, v in variables_dict.items()}
-        variables_dict['Code'] = self.variable
+        # Lookup in the catalog of the variables, loaded once per process
+        return variable_catalog().get(self.variable)
 
-        return variables_dict
 
-
-    def retrieve_request(self) -> xr.Dataset:
+    def retrieve_request(self) -> 'xr.Dataset':
 
         '''
         '''
@@ -362,18 +1025,10 @@ class CCKP_api_CMIP6():
 
                 for url in urls:
 
-                    # Creating the s3 file system
-                    fs = s3fs.S3FileSystem()
-
-                    # Reading the data from the s3 bucket
-                    fs = s3fs.S3FileSystem(anon=True)
-                    filejob = fs.open(url)
-
-                    # Opening the dataset, rechunking it and dropping the unnecessary variables
-                    dataset = xr.open_dataset(filejob)
-                    #dataset = dataset.drop_vars(['lat_bnds', 'lon_bnds', 'bnds'])
+                    # Reading the variable through the shared cache
+                    data = open_variable(url, f'{product}-{self.variable}-annual-mean')
 
-                    dat_dts.append(dataset[f'{product}-{self.variable}-annual-mean'].rename(f'{self.variable}_{self.scenario}_{band}'))
+                    dat_dts.append(data.rename(f'{self.variable}_{self.scenario}_{band}'))
 
 
             self.timeseries_dataset = xr.merge(dat_dts)
@@ -388,6 +1043,64 @@ class CCKP_api_CMIP6():
 
 
 
+    def band_urls(self, band):
+
+        '''
+        Function that returns the urls of the files of an ensemble band (median, p10 or p90).
+        '''
+
+        return getattr(self, f'retrieve_url_timeseries_{band}')
+
+
+    def open_point(self, url, lat, lon):
+
+        '''
+        Function that reads only the grid cell nearest to (lat, lon) from one CCKP file, or from the point cache (see read_point).
+        '''
+
+        if self.climatology:
+            product = 'climatology'
+        else:
+            product = 'timeseries'
+
+        return read_point(url, f'{product}-{self.variable}-annual-mean', lat, lon)
+
+
+    def retrieve_point(self, lat, lon, concurrent = True, max_workers = 7):
+
+        '''
+        Function that retrieves the data of a single location, reading from each file only the chunks of the nearest grid cell.
+        It replaces retrieve_request + load_point when the global grids are not needed, and fills the same point dataframe and json.
+
+        Parameters:
+        lat (float): The latitude of the location.
+        lon (float): The longitude of the location.
+        concurrent (bool): If True, the files are read at the same time with a thread pool.
+        max_workers (int): Maximum number of files read at the same time when concurrent is True.
+        '''
+
+        results = run_jobs({band: [(url, lat, lon) for url in self.band_urls(band)] for band in self.bands}, self.open_point, concurrent, max_workers,
+                           self.errors_dict)
+
+        if all(results[band] is not None for band in self.bands):
+
+            # One column for each band, aligned on the union of the years of its files
+            columns = {}
+            for band in self.bands:
+                columns[f'{self.variable}_{self.scenario}_{band}'] = pd.concat([pd.Series(point['values'].astype(float) / self.variables_dict['Normalization factor'], index=pd.DatetimeIndex(point['time'], name='time'))
+                                                                               for point in results[band]])
+
+            self.timeseries_point_dataframe = pd.DataFrame(columns)
+            self.timeseries_point_dataframe.index = self.timeseries_point_dataframe.index.year
+            self.status_dict['timeseries'] = 'Retrieved'
+
+        else:
+            self.timeseries_point_dataframe = pd.DataFrame()
+            self.status_dict['timeseries'] = 'Error'
+
+        self.point_to_json()
+
+
     def load_point(self, lat, lon):
          
         self.timeseries_point_dataframe = self.timeseries_dataset.sel(lat=lat, lon=lon, method='nearest')
@@ -398,21 +1111,102 @@ class CCKP_api_CMIP6():
         self.timeseries_point_dataframe = self.timeseries_point_dataframe.to_dataframe().drop(columns=['lat', 'lon'])
         self.timeseries_point_dataframe.index = self.timeseries_point_dataframe.index.year
 
-        # Rounding precision of dataframes to 2
-        self.timeseries_point_dataframe = self.timeseries_point_dataframe.round(2)
+        self.point_to_json()
 
-        self.timeseries_point_json = self.timeseries_point_dataframe.astype(str).to_json()
 
-        
-        encoder.FLOAT_REPR = lambda o: format(o, '.2f')
-        # Rounding precision of jsons to 2
-        self.timeseries_point_json = json.loads(self.timeseries_point_json)
+    def point_to_json(self):
+
+        '''
+        Function that converts the point dataframe to the json sent to the LLM, with 2 decimals.
+        '''
 
+        # Encoding the arrays directly: the values are rounded by the encoder, not in the dataframe
+        self.timeseries_point_json = dataframe_to_json(self.timeseries_point_dataframe)
 
 
-    def make_json_to_llm(self):
-         
-        self.json_to_llm = {
+
+    def load_points(self, lats, lons, site_ids = None, columnar = False):
+
+        '''
+        Function that extracts many locations at once from the retrieved dataset, with vectorized pointwise indexing.
+        The files are opened once by retrieve_request and then serve every site on the same grid.
+
+        Parameters:
+        lats (list): The latitudes of the sites.
+        lons (list): The longitudes of the sites.
+        site_ids (list): The identifiers of the sites. Default is the position in the lists.
+        columnar (bool): If True, the jsons use the compact columnar layout (see make_json_to_llm).
+
+        Returns:
+        sites_dataframe (pd.DataFrame): Tidy dataframe with site, year, band and value columns (timeseries in unit).
+        sites_json_to_llm (dict): The json sent to the LLM for each site, with the same structure of json_to_llm.
+        '''
+
+        site_ids = list(range(len(lats))) if site_ids is None else list(site_ids)
+        lat_points, lon_points = site_indexers(lats, lons, site_ids)
+
+        timeseries = self.timeseries_dataset.sel(lat=lat_points, lon=lon_points, method='nearest').transpose('time', 'site')
+        years = timeseries['time'].dt.year.values
+
+        # One (year, site) array for each band
+        values = {band: timeseries[f'{self.variable}_{self.scenario}_{band}'].values.astype(float) / self.variables_dict['Normalization factor'] for band in self.bands}
+
+        self.sites_dataframe = pd.concat([pd.DataFrame({'site': np.tile(site_ids, len(years)), 'year': np.repeat(years, len(site_ids)), 'band': band, 'value': values[band].ravel()})
+                                          for band in self.bands], ignore_index=True)
+
+        self.sites_json_to_llm = {}
+        for i, site in enumerate(site_ids):
+            self.sites_json_to_llm[site] = self.payload(encode_point(years, {f'{self.variable}_{self.scenario}_{band}': values[band][:, i] for band in self.bands}, columnar))
+
+        return self.sites_dataframe, self.sites_json_to_llm
+
+
+    def make_json_to_llm(self, columnar = False):
+
+        '''
+        Function that builds the json sent to the LLM from the point data (columnar: see CCKP_api_ERA5.make_json_to_llm).
+        '''
+
+        if columnar:
+            self.json_to_llm = self.payload(dataframe_to_json(self.timeseries_point_dataframe, columnar=True))
+        else:
+            self.json_to_llm = self.payload(self.timeseries_point_json)
+
+
+    def release_datasets(self):
+
+        '''
+        Function that drops the reference to the global-grid dataset opened by retrieve_request.
+        '''
+
+        self.timeseries_dataset = None
+
+
+    def point_result(self, release = True):
+
+        '''
+        Function that returns the compact PointResult of the location loaded by retrieve_point or load_point, and releases the dataset.
+        make_json_to_llm must be called first.
+
+        Parameters:
+        release (bool): If False, the dataset is kept (for a caller that does not own the object).
+        '''
+
+        if release:
+            self.release_datasets()
+
+        return PointResult.from_dataframes('CMIP6', self.variable, self.scenario, self.variables_dict, self.status_dict,
+                                           {'timeseries': list(self.bands), 'trend': [], 'confidence': []},
+                                           self.timeseries_point_dataframe, None, None, self.json_to_llm)
+
+
+    def payload(self, timeseries_json):
+
+        '''
+        Function that builds the json sent to the LLM from the json of the timeseries.
+        '''
+
+        return {
             
             'var_code': self.variable,
             'var_name': self.variables_dict['Variable'],
@@ -421,7 +1215,7 @@ class CCKP_api_CMIP6():
             'status': self.status_dict,
 
             'values': {
-            'timeseries in unit': self.timeseries_point_json
+            'timeseries in unit': timeseries_json
             }
 
         }
\ No newline at end of file
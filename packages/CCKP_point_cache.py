@@ -0,0 +1,267 @@
+# Point cache importations
+import os
+import io
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+import numpy as np
+from packages.CCKP_point_extract import nearest_index
+
+# -- PERSISTENT ON-DISK CACHE FOR THE POINT SERIES EXTRACTED FROM CCKP FILES
+# -- The CCKP files are immutable, so a point series extracted once can be reused by every session and every process
+
+
+
+def _array_to_bytes(array):
+
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _bytes_to_array(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+
+class PointCache():
+
+    '''
+    SQLite cache of the point series extracted from the CCKP files, keyed by (url, lat index, lon index).
+
+    The indices are the ones selected by the extraction in the coordinates of the file, which are stored with the first
+    point of each url: a later request resolves its cell with the same nearest selection, whatever the layout of the grid
+    (ascending or descending latitudes, -180..180 or 0..360 longitudes).
+
+    The least recently used entries are evicted when the size of the stored series exceeds max_bytes.
+    Every call opens its own connection, so the cache can be shared by threads and by processes.
+
+    Parameters:
+    directory (str): Directory of the cache. Default is the CCKP_CACHE_DIR environment variable, or ~/.cache/climalm.
+    max_bytes (int): Maximum size of the stored series, in bytes.
+    enabled (bool): If False, the cache is never read nor written.
+    '''
+
+    def __init__(self, directory = None, max_bytes = 512 * 2 ** 20, enabled = True):
+
+        self.directory = directory or os.environ.get('CCKP_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'climalm'))
+        self.path = os.path.join(self.directory, 'cckp_points.sqlite')
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._coordinates = {}
+        self.counters = {'hits': 0, 'misses': 0, 'puts': 0, 'evictions': 0}
+
+
+    @contextmanager
+    def _connect(self):
+
+        # One connection per call, committed and closed at the end of the block
+        os.makedirs(self.directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+
+        try:
+            if not self._initialized:
+                with self._lock:
+                    connection.execute('PRAGMA journal_mode=WAL')
+                    connection.execute('CREATE TABLE IF NOT EXISTS points (url TEXT, lat_index INTEGER, lon_index INTEGER, '
+                                       'meta TEXT, vals BLOB, time BLOB, nbytes INTEGER, last_access REAL, '
+                                       'PRIMARY KEY (url, lat_index, lon_index))')
+                    connection.execute('CREATE INDEX IF NOT EXISTS points_last_access ON points (last_access)')
+                    connection.execute('CREATE TABLE IF NOT EXISTS coordinates (url TEXT PRIMARY KEY, lat BLOB, lon BLOB)')
+                    self._initialized = True
+
+            yield connection
+            connection.commit()
+
+        finally:
+            connection.close()
+
+
+    def _count(self, counter, n = 1):
+
+        with self._lock:
+            self.counters[counter] += n
+
+
+    def coordinates(self, url):
+
+        '''
+        Function that returns the stored lat and lon coordinates of the file of the url, or None if they are not stored.
+        '''
+
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            if url in self._coordinates:
+                return self._coordinates[url]
+
+        with self._connect() as connection:
+            row = connection.execute('SELECT lat, lon FROM coordinates WHERE url = ?', (url,)).fetchone()
+
+        if row is None:
+            return None
+
+        coordinates = (_bytes_to_array(row[0]), _bytes_to_array(row[1]))
+        with self._lock:
+            self._coordinates[url] = coordinates
+
+        return coordinates
+
+
+    def put_coordinates(self, url, lat_values, lon_values):
+
+        '''
+        Function that stores the lat and lon coordinates of the file of the url.
+        '''
+
+        if not self.enabled:
+            return
+
+        lat_values, lon_values = np.asarray(lat_values, dtype=float), np.asarray(lon_values, dtype=float)
+
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO coordinates VALUES (?, ?, ?)', (url, _array_to_bytes(lat_values), _array_to_bytes(lon_values)))
+
+        with self._lock:
+            self._coordinates[url] = (lat_values, lon_values)
+
+
+    def cell(self, url, lat, lon):
+
+        '''
+        Function that returns the indices of the grid cell of the url nearest to (lat, lon), the cell selected by the
+        extraction, or None if the coordinates of the url are not stored.
+
+        Returns:
+        lat_index (int): The index of the cell along the latitude.
+        lon_index (int): The index of the cell along the longitude.
+        '''
+
+        coordinates = self.coordinates(url)
+        if coordinates is None:
+            return None
+
+        return nearest_index(coordinates[0], lat), nearest_index(coordinates[1], lon)
+
+
+    def get(self, url, lat, lon):
+
+        '''
+        Function that returns the cached point of the url in the grid cell nearest to (lat, lon), or None if not cached.
+
+        Returns:
+        point (dict): The point, with the same structure returned by CCKP_point_extract.extract_point.
+        '''
+
+        if not self.enabled:
+            return None
+
+        cell = self.cell(url, lat, lon)
+        if cell is None:
+            self._count('misses')
+            return None
+
+        lat_index, lon_index = cell
+
+        with self._connect() as connection:
+            row = connection.execute('SELECT meta, vals, time FROM points WHERE url = ? AND lat_index = ? AND lon_index = ?',
+                                     (url, lat_index, lon_index)).fetchone()
+
+            if row is None:
+                self._count('misses')
+                return None
+
+            connection.execute('UPDATE points SET last_access = ? WHERE url = ? AND lat_index = ? AND lon_index = ?',
+                               (time.time(), url, lat_index, lon_index))
+
+        self._count('hits')
+
+        meta, values, times = row
+        point = json.loads(meta)
+        point['dims'] = tuple(point['dims'])
+        point['values'] = _bytes_to_array(values)
+        point['time'] = _bytes_to_array(times) if times is not None else None
+
+        return point
+
+
+    def put(self, url, point):
+
+        '''
+        Function that stores a point extracted from the url, keyed by the indices of its grid cell in the file.
+        Points that cannot be stored without pickling (e.g. cftime dates) are skipped.
+        '''
+
+        if not self.enabled:
+            return
+
+        if point['values'].dtype == object or (point['time'] is not None and point['time'].dtype == object):
+            return
+
+        values = _array_to_bytes(point['values'])
+        times = _array_to_bytes(point['time']) if point['time'] is not None else None
+        meta = json.dumps({k: point[k] for k in ['dims', 'lat', 'lon', 'lat_index', 'lon_index']})
+        nbytes = len(values) + (len(times) if times is not None else 0) + len(meta)
+        lat_index, lon_index = point['lat_index'], point['lon_index']
+
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (url, lat_index, lon_index, meta, values, times, nbytes, time.time()))
+            self._count('puts')
+            self._evict(connection)
+
+
+    def _evict(self, connection):
+
+        # Removing the least recently used entries until the cache fits in max_bytes
+        total = connection.execute('SELECT COALESCE(SUM(nbytes), 0) FROM points').fetchone()[0]
+
+        while total > self.max_bytes:
+            row = connection.execute('SELECT url, lat_index, lon_index, nbytes FROM points ORDER BY last_access LIMIT 1').fetchone()
+            if row is None:
+                break
+            connection.execute('DELETE FROM points WHERE url = ? AND lat_index = ? AND lon_index = ?', row[:3])
+            total -= row[3]
+            self._count('evictions')
+
+
+    def clear(self):
+
+        '''
+        Function that removes all the entries of the cache.
+        '''
+
+        if os.path.exists(self.path):
+            with self._connect() as connection:
+                connection.execute('DELETE FROM points')
+                connection.execute('DELETE FROM coordinates')
+
+        with self._lock:
+            self._coordinates.clear()
+
+
+    def stats(self):
+
+        '''
+        Function that returns the hit/miss counters of the process, together with the number of entries and the size of the cache.
+        '''
+
+        entries, nbytes = 0, 0
+        if os.path.exists(self.path):
+            with self._connect() as connection:
+                entries, nbytes = connection.execute('SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM points').fetchone()
+
+        with self._lock:
+            requests = self.counters['hits'] + self.counters['misses']
+            return {**self.counters, 'hit_rate': self.counters['hits'] / requests if requests else 0.0,
+                    'entries': entries, 'bytes': nbytes, 'max_bytes': self.max_bytes, 'path': self.path}
+
+
+# Shared cache used by all the CCKP objects of the process
+point_cache = PointCache()
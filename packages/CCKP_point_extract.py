@@ -0,0 +1,132 @@
+# Point extraction importations
+import numpy as np
+from packages.lazy_imports import lazy_import
+
+# Heavy modules, imported on first use
+xr = lazy_import('xarray')
+h5netcdf = lazy_import('h5netcdf')
+
+# -- ENGINE FOR READING A SINGLE GRID CELL FROM CCKP NETCDF FILES
+# -- Only the coordinate arrays and the HDF5 chunks covering the selected cell are read, instead of the whole global grid
+
+
+
+# Block size used for the file handles of the point reads: the reads are small (HDF5 metadata and a few chunks),
+# so big read-ahead blocks would only transfer data that is never used
+POINT_BLOCK_SIZE = 2 ** 16
+
+
+def nearest_index(coordinates, value):
+
+    '''
+    Function that returns the index of the coordinate closest to the value.
+    When the value is half way between two coordinates the index of the larger coordinate is returned, as xarray's nearest
+    selection does, for ascending and descending coordinates alike.
+
+    Parameters:
+    coordinates (np.ndarray): The 1-D coordinate array (e.g. lat or lon).
+    value (float): The requested coordinate.
+
+    Returns:
+    index (int): The index of the nearest coordinate.
+    '''
+
+    coordinates = np.asarray(coordinates, dtype=float)
+    distances = np.abs(coordinates - value)
+    candidates = np.flatnonzero(distances == distances.min())
+
+    return int(candidates[np.argmax(coordinates[candidates])])
+
+
+def _read_attributes(variable):
+
+    # Decoding the bytes attributes to strings, as xarray does when opening the file
+    attrs = {}
+    for k, v in variable.attrs.items():
+        if k not in ['_FillValue', 'missing_value'] and isinstance(v, bytes):
+            v = v.decode('utf-8', errors='replace')
+        attrs[k] = v
+
+    return attrs
+
+
+def extract_point(fileobj, variable_name, lat, lon):
+
+    '''
+    Function that extracts the values of a variable in the grid cell nearest to (lat, lon).
+
+    The nearest cell is resolved from the lat/lon coordinate arrays, then only the hyperslab of that cell is read: HDF5
+    fetches just the chunks that cover it. The values are decoded with the CF conventions (scale factors, fill values,
+    units), so they are the same obtained with xr.open_dataset(...).sel(lat=lat, lon=lon, method='nearest').
+
+    Parameters:
+    fileobj (file-like): The open NetCDF file.
+    variable_name (str): The name of the variable to extract.
+    lat (float): The latitude of the location.
+    lon (float): The longitude of the location.
+
+    Returns:
+    point (dict): Dictionary with the decoded values ('values'), the decoded time coordinate ('time', None if the
+                  variable has no time coordinate), the dimensions of the values ('dims'), the coordinates of the grid cell
+                  ('lat', 'lon'), its indices in the grid ('lat_index', 'lon_index') and the coordinates of the grid
+                  ('lat_values', 'lon_values').
+    '''
+
+    with h5netcdf.File(fileobj, 'r') as ncfile:
+
+        lat_values = ncfile.variables['lat'][:]
+        lon_values = ncfile.variables['lon'][:]
+
+        lat_index = nearest_index(lat_values, lat)
+        lon_index = nearest_index(lon_values, lon)
+
+        # Reading only the column of the selected cell
+        variable = ncfile.variables[variable_name]
+        selection = tuple(lat_index if dim == 'lat' else lon_index if dim == 'lon' else slice(None) for dim in variable.dimensions)
+        dims = tuple(dim for dim in variable.dimensions if dim not in ('lat', 'lon'))
+
+        point = xr.Dataset({variable_name: (dims, variable[selection], _read_attributes(variable))})
+
+        if 'time' in dims and 'time' in ncfile.variables:
+            point['time'] = ('time', ncfile.variables['time'][:], _read_attributes(ncfile.variables['time']))
+
+    # Decoding the values with the CF conventions
+    point = xr.decode_cf(point)
+
+    return {
+        'values': point[variable_name].values,
+        'time': point['time'].values if 'time' in point.variables else None,
+        'dims': dims,
+        'lat': float(lat_values[lat_index]),
+        'lon': float(lon_values[lon_index]),
+        'lat_index': lat_index,
+        'lon_index': lon_index,
+        'lat_values': np.asarray(lat_values, dtype=float),
+        'lon_values': np.asarray(lon_values, dtype=float),
+    }
+
+
+def extract_point_from_dataset(dataset, variable_name, lat, lon):
+
+    '''
+    Function that extracts the values of a variable in the grid cell nearest to (lat, lon) from a lazily opened dataset
+    (e.g. opened through the reference index). Returns the same dictionary of extract_point.
+    '''
+
+    lat_values, lon_values = dataset['lat'].values, dataset['lon'].values
+    lat_index = nearest_index(lat_values, lat)
+    lon_index = nearest_index(lon_values, lon)
+
+    data = dataset[variable_name].isel(lat=lat_index, lon=lon_index)
+
+    return {
+        'values': data.values,
+        'time': data['time'].values if 'time' in data.dims and 'time' in data.coords else None,
+        'dims': tuple(data.dims),
+        'lat': float(lat_values[lat_index]),
+        'lon': float(lon_values[lon_index]),
+        'lat_index': lat_index,
+        'lon_index': lon_index,
+        'lat_values': np.asarray(lat_values, dtype=float),
+        'lon_values': np.asarray(lon_values, dtype=float),
+    }
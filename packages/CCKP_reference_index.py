@@ -0,0 +1,181 @@
+# Reference index importations
+import os
+import json
+import threading
+import argparse
+from packages.lazy_imports import lazy_import
+
+# Heavy modules, imported on first use
+xr = lazy_import('xarray')
+
+# -- CHUNK REFERENCE INDEX FOR THE CCKP BUCKET
+# -- The HDF5 metadata of the CCKP files is parsed once and stored as kerchunk references (byte offsets of every chunk),
+# -- so the datasets can then be opened lazily through zarr without any metadata round-trip to the bucket
+
+
+
+# Arrays smaller than this (coordinates, bounds, time) are stored inside the index instead of referenced
+INLINE_THRESHOLD = 20000
+
+
+def _protocol(url):
+    return url.split('://')[0] if '://' in url else 'file'
+
+
+
+class ReferenceIndex():
+
+    '''
+    Index with the kerchunk references of the CCKP files, loaded from a JSON file {'version': 1, 'refs': {url: references}}.
+
+    Parameters:
+    path (str): Path of the index file. Default is the CCKP_REFERENCE_INDEX environment variable. If no file is
+                configured (or it does not exist) the index is empty and the files are opened from the bucket as usual.
+    remote_options (dict): Options of the filesystem of the referenced files. Default is anonymous access for s3.
+    '''
+
+    def __init__(self, path = None, remote_options = None):
+
+        self.path = path or os.environ.get('CCKP_REFERENCE_INDEX')
+        self.remote_options = remote_options
+
+        self._lock = threading.Lock()
+        self._refs = None
+
+
+    def refs(self):
+
+        '''
+        Function that returns the references of all the indexed files, loading the index file on first use.
+        '''
+
+        with self._lock:
+            if self._refs is None:
+                if self.path and os.path.exists(self.path):
+                    with open(self.path) as f:
+                        self._refs = json.load(f)['refs']
+                else:
+                    self._refs = {}
+
+            return self._refs
+
+
+    def __contains__(self, url):
+        return url in self.refs()
+
+
+    def open_dataset(self, url):
+
+        '''
+        Function that opens the dataset of the url through its references, or returns None if the url is not indexed.
+        Only the data chunks actually used are then read from the bucket.
+
+        Parameters:
+        url (str): The url of the file.
+
+        Returns:
+        dataset (xr.Dataset): The lazily opened dataset, or None.
+        '''
+
+        refs = self.refs().get(url)
+
+        if refs is None:
+            return None
+
+        protocol = _protocol(url)
+
+        if self.remote_options is not None:
+            remote_options = self.remote_options
+        else:
+            remote_options = {'anon': True} if protocol == 's3' else {}
+
+        return xr.open_dataset('reference://', engine='zarr',
+                               backend_kwargs={'consolidated': False,
+                                               'storage_options': {'fo': refs, 'remote_protocol': protocol, 'remote_options': remote_options}})
+
+
+
+def cckp_urls(variables, scenarios = ['historical', 'ssp119', 'ssp126', 'ssp245', 'ssp370', 'ssp585'], bands = ['median', 'p10', 'p90']):
+
+    '''
+    Function that returns the urls generated by CCKP_api_ERA5 and CCKP_api_CMIP6 for the variables, with and without climatology.
+
+    Parameters:
+    variables (list): The codes of the variables.
+    scenarios (list): The CMIP6 scenarios.
+    bands (list): The CMIP6 ensemble bands.
+
+    Returns:
+    urls (list): The urls, without duplicates.
+    '''
+
+    from packages.CCKP_new_api import CCKP_api_ERA5, CCKP_api_CMIP6
+
+    urls = []
+    for variable in variables:
+        for climatology in [False, True]:
+            urls += CCKP_api_ERA5(variable, climatology).urls()
+            for scenario in scenarios:
+                urls += CCKP_api_CMIP6(variable, scenario, bands, climatology).urls()
+
+    return list(dict.fromkeys(urls))
+
+
+def build_index(urls, path, inline_threshold = INLINE_THRESHOLD):
+
+    '''
+    Function that builds the reference index of the urls and writes it to path.
+    The urls can also be local NetCDF files, so the index can be built and tested against local fixtures.
+
+    Parameters:
+    urls (list): The urls of the files to index.
+    path (str): Path of the JSON index file. If it already exists, the new references are added to it.
+    inline_threshold (int): Arrays smaller than this number of bytes are stored inside the index.
+
+    Returns:
+    errors (dict): The urls that could not be indexed, with the error.
+    '''
+
+    from kerchunk.hdf import SingleHdf5ToZarr
+    from packages.CCKP_new_api import s3_pool
+
+    refs = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            refs = json.load(f)['refs']
+
+    errors = {}
+    for url in urls:
+        try:
+            with s3_pool.borrow(url) as filejob:
+                refs[url] = SingleHdf5ToZarr(filejob, url, inline_threshold=inline_threshold).translate()
+            s3_pool.close(url)
+        except Exception as e:
+            errors[url] = repr(e)
+
+    with open(path, 'w') as f:
+        json.dump({'version': 1, 'refs': refs}, f)
+
+    return errors
+
+
+# Shared index used by all the CCKP objects of the process
+reference_index = ReferenceIndex()
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build the kerchunk reference index of the CCKP files.')
+    parser.add_argument('output', help='Path of the JSON index file')
+    parser.add_argument('--variables', nargs='+', required=True, help='Codes of the variables (e.g. tas pr hd30)')
+    parser.add_argument('--scenarios', nargs='+', default=['historical', 'ssp119', 'ssp126', 'ssp245', 'ssp370', 'ssp585'])
+    parser.add_argument('--bands', nargs='+', default=['median', 'p10', 'p90'])
+    args = parser.parse_args()
+
+    urls = cckp_urls(args.variables, args.scenarios, args.bands)
+    errors = build_index(urls, args.output)
+
+    print(f'Indexed {len(urls) - len(errors)} of {len(urls)} files in {args.output}')
+    for url, error in errors.items():
+        print(f'  {url}: {error}')
@@ -1,11 +1,9 @@
-from langchain_openai import AzureChatOpenAI
-from langchain_core.messages import HumanMessage, ToolMessage, SystemMessage
+from langchain_core.messages import HumanMessage, ToolMessage, SystemMessage, message_chunk_to_message
 from langchain_core.tools import tool
 import streamlit as st
-from openai import AzureOpenAI
-import os
-from dotenv import load_dotenv
 import json
+import time
+from packages.llm_streaming import timed_chunks, render_stream
 
 # Setting off warnings
 import warnings
@@ -75,6 +73,9 @@ class main_agent(object):
         self.conversation = []
         self.llm = llm
 
+        # Latency of each step: time to the first token (streamed steps only) and total seconds
+        self.timings = []
+
         # Initilize the conversation
         self.conversation.append(SystemMessage("You are ALM-APP, an Augmented Language Model based application designed to help in climate change analysis.\
                                                 You can fill the form for selecting the climate data. The form is on the right side of the page. \
@@ -100,10 +101,25 @@ class main_agent(object):
 
         if tools:
             self.tools = tools
-            self.augmented_llm = llm.bind_tools(self.tools, tool_choice="fill_form")
+            self.tool_choice = "fill_form"
+            self.augmented_llm = llm.bind_tools(self.tools, tool_choice=self.tool_choice)
+
+
+    def conversation_step(self, tools = False, placeholder = None):
+
+        '''
+        Function that asks the model for the next message of the conversation and appends it.
+
+        Parameters:
+        tools (bool): If True, the model can call the tools.
+        placeholder (st.delta_generator.DeltaGenerator): If given (st.empty()), the answer is streamed into it.
+        '''
 
+        if placeholder is not None:
+            render_stream(placeholder, self.conversation_stream(tools))
+            return
 
-    def conversation_step(self, tools = False):
+        start = time.perf_counter()
 
         if tools:
             ai_msg = self.augmented_llm.invoke(self.conversation)
@@ -112,9 +128,52 @@ class main_agent(object):
             ai_msg = self.llm.invoke(self.conversation)
         
         self.conversation.append(ai_msg)
+        self.timings.append({'ttft': None, 'total': time.perf_counter() - start, 'streamed': False})
+
+
+    def conversation_stream(self, tools = False):
+
+        '''
+        Function that streams the next message of the conversation: it yields the text chunks as they arrive, then appends
+        the complete message (tool calls included) to the conversation and records its latency.
+        The completion cache of the model is used as in conversation_step.
+
+        Parameters:
+        tools (bool): If True, the model can call the tools.
+
+        Yields:
+        chunk (str): The text chunks.
+        '''
+
+        model = self.augmented_llm if tools else self.llm
+        bound = {'tools': self.tools, 'tool_choice': self.tool_choice} if tools else {}
+        cache = getattr(self.llm, 'cache', None)
+        cache = cache if hasattr(cache, 'lookup_message') else None
+
+        timings = {'streamed': True}
+        cached = cache.lookup_message(self.llm, self.conversation, **bound) if cache else None
+
+        if cached is not None:
+            yield from timed_chunks([cached.content], timings)
+            message = cached
+
+        else:
+            message = None
+            for chunk in timed_chunks(model.stream(self.conversation), timings, lambda c: bool(c.content or c.tool_call_chunks)):
+                message = chunk if message is None else message + chunk
+                if isinstance(chunk.content, str) and chunk.content:
+                    yield chunk.content
+
+            message = message_chunk_to_message(message)
+            if cache:
+                cache.update_message(self.llm, self.conversation, message, **bound)
+
+        timings['cached'] = cached is not None
+        self.conversation.append(message)
+        self.timings.append(timings)
 
 
-    def check_tool(self):
+    def check_tool(self, placeholder = None):
 
         # st.write(self.conversation)
 
@@ -131,7 +190,7 @@ class main_agent(object):
                                                            Be specific about the time periods you want to analyze.\
                                                            Be specific about the variables, the sources, the scenarios and the bands.\
                                                            Be specific about the criteria you will use in the analysis.'))
-                    self.conversation_step(False)
+                    self.conversation_step(False, placeholder)
                     st.session_state.proposed_analysis = self.conversation[-1].content
 
                     return tool_output[1]
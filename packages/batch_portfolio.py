@@ -0,0 +1,293 @@
+# Batch portfolio importations
+import os
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+
+# -- BATCH SCREENING OF SITE PORTFOLIOS FROM THE COMMAND LINE
+# -- The sites are grouped by CCKP file: each unit of work is one CCKP object (source, variable, scenario), whose files are
+# -- opened once and then serve all the sites of the unit. The units run in a process pool and write partitioned Parquet
+#
+# -- python -m packages.batch_portfolio sites.csv results --variables tas hd30 --scenarios ssp245 ssp585 --bands median p90
+
+
+
+SOURCES = ['ERA5', 'CMIP6']
+BANDS = ['median', 'p10', 'p90']
+CHECKPOINT_FILE = '_checkpoint.jsonl'
+SUMMARY_FILE = '_summary.json'
+
+
+def _split(value):
+
+    # List columns of the csv are separated by spaces, commas or semicolons
+    if pd.isna(value) or str(value).strip() == '':
+        return []
+    return [item for item in str(value).replace(';', ' ').replace(',', ' ').split()]
+
+
+def read_sites(path, variables = None, scenarios = None, bands = None, sources = None):
+
+    '''
+    Function that reads the csv of the sites.
+
+    The csv must have the columns site, latitude and longitude. The optional columns variables, scenarios, bands and sources
+    select the data of each site (lists separated by spaces or semicolons); where they are missing or empty, the defaults are used.
+
+    Parameters:
+    path (str): The path of the csv.
+    variables (list): Default codes of the variables.
+    scenarios (list): Default CMIP6 scenarios.
+    bands (list): Default CMIP6 bands.
+    sources (list): Default sources ('ERA5' and/or 'CMIP6').
+
+    Returns:
+    sites (pd.DataFrame): One row per site, with lists in the variables, scenarios, bands and sources columns.
+    '''
+
+    sites = pd.read_csv(path, dtype={'site': str})
+
+    missing = {'site', 'latitude', 'longitude'} - set(sites.columns)
+    if missing:
+        raise ValueError(f'Missing columns in {path}: {sorted(missing)}')
+
+    if sites['site'].duplicated().any():
+        raise ValueError(f'Duplicated sites in {path}: {sorted(sites.loc[sites["site"].duplicated(), "site"].unique())}')
+
+    defaults = {'variables': variables or [], 'scenarios': scenarios or [], 'bands': bands or ['median'], 'sources': sources or SOURCES}
+    for column, default in defaults.items():
+        if column in sites.columns:
+            sites[column] = [_split(value) or list(default) for value in sites[column]]
+        else:
+            sites[column] = [list(default) for _ in range(len(sites))]
+
+    return sites
+
+
+def plan_units(sites, climatology = False):
+
+    '''
+    Function that groups the requests of the sites by CCKP object, so that each file is opened by a single unit.
+
+    Parameters:
+    sites (pd.DataFrame): The sites, as returned by read_sites.
+    climatology (bool): If True, the CMIP6 climatologies are used instead of the timeseries.
+
+    Returns:
+    units (list): The units of work, as dictionaries with source, variable, scenario, bands, climatology, site ids,
+                  latitudes, longitudes and the key used by the checkpoints.
+    '''
+
+    groups = {}
+    for site in sites.itertuples(index=False):
+        for variable in site.variables:
+            if 'ERA5' in site.sources:
+                groups.setdefault(('ERA5', variable, 'historical'), {'bands': set(), 'sites': {}})['sites'][site.site] = (site.latitude, site.longitude)
+            if 'CMIP6' in site.sources:
+                for scenario in site.scenarios:
+                    group = groups.setdefault(('CMIP6', variable, scenario), {'bands': set(), 'sites': {}})
+                    group['bands'].update(site.bands)
+                    group['sites'][site.site] = (site.latitude, site.longitude)
+
+    units = []
+    for (source, variable, scenario), group in groups.items():
+        site_ids = list(group['sites'])
+        unit = {'source': source, 'variable': variable, 'scenario': scenario,
+                'bands': [band for band in BANDS if band in group['bands']],
+                'climatology': climatology and source == 'CMIP6',
+                'sites': site_ids,
+                'latitudes': [float(group['sites'][s][0]) for s in site_ids],
+                'longitudes': [float(group['sites'][s][1]) for s in site_ids]}
+
+        # The key changes with the content of the unit, so a modified portfolio is never resumed from stale results
+        unit['key'] = hashlib.sha1(json.dumps(unit, sort_keys=True).encode()).hexdigest()[:16]
+        units.append(unit)
+
+    return units
+
+
+def unit_path(output, unit):
+
+    '''
+    Function that returns the path of the Parquet file of a unit, in the source=/variable=/scenario= partitions.
+    '''
+
+    return os.path.join(output, f'source={unit["source"]}', f'variable={unit["variable"]}', f'scenario={unit["scenario"]}', f'part-{unit["key"]}.parquet')
+
+
+def run_unit(unit, output):
+
+    '''
+    Function that retrieves the data of a unit and writes its Parquet file. It runs in the worker processes.
+    Raises RuntimeError if the files of the unit could not be retrieved, so the unit is not checkpointed and a resumed run retries it.
+
+    Parameters:
+    unit (dict): The unit of work, as returned by plan_units.
+    output (str): The output directory.
+
+    Returns:
+    stats (dict): The key, the number of sites, files and rows, the bytes read and the seconds spent by the unit.
+    '''
+
+    from packages.CCKP_new_api import CCKP_api_ERA5, CCKP_api_CMIP6, s3_pool
+
+    start = time.perf_counter()
+    bytes_before = s3_pool.stats()['bytes_read']
+
+    if unit['source'] == 'ERA5':
+        # Only the timeseries is written, so the trend and confidence files are not opened
+        obj = CCKP_api_ERA5(unit['variable'], products=['timeseries'])
+        obj.retrieve_request(concurrent=True)
+    else:
+        obj = CCKP_api_CMIP6(unit['variable'], unit['scenario'], unit['bands'], unit['climatology'])
+        obj.retrieve_request()
+
+    # retrieve_request keeps the errors in the status instead of raising: an empty unit must not be checkpointed as completed
+    if obj.status_dict['timeseries'] != 'Retrieved' or 'Error' in obj.status_dict.values():
+        errors = '; '.join(f'{key}: {e}' for key, e in obj.errors_dict.items()) or obj.status_dict
+        raise RuntimeError(f'timeseries not retrieved: {errors}')
+
+    sites_dataframe, _ = obj.load_points(unit['latitudes'], unit['longitudes'], unit['sites'])
+
+    if 'band' not in sites_dataframe.columns:
+        sites_dataframe.insert(2, 'band', obj.percentile)
+
+    path = unit_path(output, unit)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Writing to a temporary file first, so an interrupted unit never leaves a partial Parquet file
+    sites_dataframe.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+    s3_pool.close_all()
+
+    return {'key': unit['key'], 'source': unit['source'], 'variable': unit['variable'], 'scenario': unit['scenario'],
+            'sites': len(unit['sites']), 'files': len(obj.urls()), 'rows': len(sites_dataframe),
+            'bytes': s3_pool.stats()['bytes_read'] - bytes_before, 'seconds': time.perf_counter() - start}
+
+
+def read_checkpoint(output):
+
+    '''
+    Function that returns the stats of the units already completed in the output directory, by key.
+    Units whose Parquet file is missing are not considered completed.
+    '''
+
+    path = os.path.join(output, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return {}
+
+    completed = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                stats = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of an interrupted run
+                continue
+            completed[stats['key']] = stats
+
+    return completed
+
+
+def run_portfolio(sites, output, climatology = False, workers = 4, resume = True, progress = print):
+
+    '''
+    Function that runs all the units of a portfolio, skipping the ones already in the checkpoint when resume is True.
+
+    Parameters:
+    sites (pd.DataFrame): The sites, as returned by read_sites.
+    output (str): The output directory.
+    climatology (bool): If True, the CMIP6 climatologies are used instead of the timeseries.
+    workers (int): Number of worker processes. With 1 (or less) the units run in this process.
+    resume (bool): If True, the units completed by a previous run are skipped.
+    progress (callable): Function called with a message when each unit ends.
+
+    Returns:
+    summary (dict): The throughput summary of the run (sites/s, files/s, bytes), with the failed units.
+    '''
+
+    os.makedirs(output, exist_ok=True)
+    start = time.perf_counter()
+
+    units = plan_units(sites, climatology)
+    completed = read_checkpoint(output) if resume else {}
+    todo = [unit for unit in units if not (unit['key'] in completed and os.path.exists(unit_path(output, unit)))]
+
+    done, errors = [], {}
+
+    with open(os.path.join(output, CHECKPOINT_FILE), 'a' if resume else 'w') as checkpoint:
+
+        def record(unit, stats):
+
+            # One line for each completed unit, flushed immediately so the run can be resumed at any time
+            checkpoint.write(json.dumps(stats) + '\n')
+            checkpoint.flush()
+            done.append(stats)
+            progress(f'[{len(done) + len(errors)}/{len(todo)}] {unit["source"]} {unit["variable"]} {unit["scenario"]}: '
+                     f'{stats["sites"]} sites, {stats["files"]} files in {stats["seconds"]:.1f} s')
+
+        if workers > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(run_unit, unit, output): unit for unit in todo}
+                for future in as_completed(futures):
+                    unit = futures[future]
+                    try:
+                        record(unit, future.result())
+                    except Exception as e:
+                        errors[unit['key']] = f'{unit["source"]} {unit["variable"]} {unit["scenario"]}: {e!r}'
+                        progress(f'Error in {errors[unit["key"]]}')
+        else:
+            for unit in todo:
+                try:
+                    record(unit, run_unit(unit, output))
+                except Exception as e:
+                    errors[unit['key']] = f'{unit["source"]} {unit["variable"]} {unit["scenario"]}: {e!r}'
+                    progress(f'Error in {errors[unit["key"]]}')
+
+    elapsed = time.perf_counter() - start
+    site_requests = sum(stats['sites'] for stats in done)
+    files = sum(stats['files'] for stats in done)
+    nbytes = sum(stats['bytes'] for stats in done)
+
+    summary = {'units': len(units), 'units_run': len(done), 'units_skipped': len(units) - len(todo), 'units_failed': len(errors),
+               'sites': len(sites), 'site_requests': site_requests, 'files': files, 'bytes': nbytes,
+               'rows': sum(stats['rows'] for stats in done), 'elapsed': elapsed,
+               'sites_per_second': site_requests / elapsed if elapsed else 0.0,
+               'files_per_second': files / elapsed if elapsed else 0.0,
+               'bytes_per_second': nbytes / elapsed if elapsed else 0.0,
+               'errors': errors}
+
+    with open(os.path.join(output, SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f, indent=1)
+
+    return summary
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Retrieve the CCKP data of a portfolio of sites and write it as partitioned Parquet.')
+    parser.add_argument('sites', help='Csv with the columns site, latitude, longitude and optionally variables, scenarios, bands, sources')
+    parser.add_argument('output', help='Output directory (Parquet partitions, checkpoint and summary)')
+    parser.add_argument('--variables', nargs='+', default=[], help='Default codes of the variables (e.g. tas pr hd30)')
+    parser.add_argument('--scenarios', nargs='+', default=[], help='Default CMIP6 scenarios')
+    parser.add_argument('--bands', nargs='+', default=['median'], choices=BANDS, help='Default CMIP6 bands')
+    parser.add_argument('--sources', nargs='+', default=SOURCES, choices=SOURCES, help='Default sources')
+    parser.add_argument('--climatology', action='store_true', help='Use the CMIP6 climatologies instead of the timeseries')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of worker processes')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and run all the units again')
+    args = parser.parse_args()
+
+    sites = read_sites(args.sites, args.variables, args.scenarios, args.bands, args.sources)
+    summary = run_portfolio(sites, args.output, args.climatology, args.workers, resume=not args.restart)
+
+    print(f'{summary["units_run"]} units run, {summary["units_skipped"]} resumed from the checkpoint, {summary["units_failed"]} failed '
+          f'in {summary["elapsed"]:.1f} s')
+    print(f'{summary["sites_per_second"]:.2f} sites/s, {summary["files_per_second"]:.2f} files/s, '
+          f'{summary["bytes"] / 2 ** 20:.1f} MiB read ({summary["bytes_per_second"] / 2 ** 20:.1f} MiB/s)')
+    for error in summary['errors'].values():
+        print(f'  {error}')
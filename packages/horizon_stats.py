@@ -0,0 +1,259 @@
+# Horizon statistics importations
+import warnings
+import numpy as np
+import pandas as pd
+
+# -- LOCAL STATISTICS OF THE TIME HORIZONS
+# -- The historical normal and the 2030, 2050 and 2100 windows (plus/minus 5 years) of all the variables, scenarios and bands
+# -- are computed in one NumPy pass over the point results, so the LLM cites the numbers instead of computing them
+
+
+
+# Baseline of the deltas (the historical normal)
+BASELINE = ('1991-2020', (1991, 2020))
+
+# Time horizons compared with the baseline, as {label: (first year, last year)}
+HORIZONS = {'2030': (2025, 2035), '2050': (2045, 2055), '2100': (2095, 2105)}
+
+# Percentile of the baseline years used as the default exceedance threshold of each series
+EXCEEDANCE_PERCENTILE = 90
+
+# Minimum number of years with data in the baseline: a shorter baseline (e.g. the 2015-2020 years of a projection whose
+# historical run is not loaded) is not the normal of the period, so the baseline and the deltas of the series are not computed
+MIN_BASELINE_YEARS = 20
+
+
+def window_masks(years, windows):
+
+    '''
+    Function that returns the windows x years boolean mask of the years inside each window (bounds included).
+    '''
+
+    bounds = np.array(list(windows.values()), dtype=float).reshape(-1, 2)
+
+    return (years[None, :] >= bounds[:, :1]) & (years[None, :] <= bounds[:, 1:])
+
+
+def window_means(years, values, windows):
+
+    '''
+    Function that computes the mean of each series in each window, ignoring the missing values.
+
+    Parameters:
+    years (np.ndarray): The years of the series.
+    values (np.ndarray): The values, as a series x years array.
+    windows (dict): The windows, as {label: (first year, last year)}.
+
+    Returns:
+    means (np.ndarray): The means, as a series x windows array (NaN where a window has no data).
+    '''
+
+    mask = window_masks(years, windows).astype(float)
+    valid = ~np.isnan(values)
+
+    sums = np.where(valid, values, 0) @ mask.T
+    counts = valid.astype(float) @ mask.T
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def _point_result(obj):
+
+    # CCKP objects are converted to their compact result without releasing their datasets (they belong to the caller),
+    # PointResult objects are used as they are
+    return obj.point_result(release=False) if hasattr(obj, 'point_result') else obj
+
+
+def collect_series(climate_data, variables = None):
+
+    '''
+    Function that collects the timeseries of the point results of climate_data ({var: {source: {scenario: result}}}).
+
+    Parameters:
+    climate_data (dict): The climate data of the session (PointResult or CCKP objects).
+    variables (list): The codes of the variables to include. Default is all.
+
+    Returns:
+    index (pd.DataFrame): One row per series, with variable, source, scenario, band, unit and name.
+    years (np.ndarray): The union of the years of the series.
+    values (np.ndarray): The values, as a series x years array (NaN where a series has no data).
+    '''
+
+    rows, series = [], []
+    for var, data in climate_data.items():
+        if var == 'attrs' or (variables is not None and var not in variables):
+            continue
+
+        for source in ['ERA5', 'CMIP6']:
+            for scenario, obj in (data.get(source) or {}).items():
+                result = _point_result(obj)
+                if result is None or not len(result.columns):
+                    continue
+
+                for i, column in enumerate(result.columns):
+                    # CMIP6 columns are named {variable}_{scenario}_{band}, ERA5 has a single series
+                    band = column.rsplit('_', 1)[-1] if source == 'CMIP6' else 'value'
+                    rows.append({'variable': var, 'source': source, 'scenario': scenario, 'band': band,
+                                 'unit': result.variables_dict['Unit'], 'name': result.variables_dict['Variable']})
+                    series.append((np.asarray(result.years, dtype=int), np.asarray(result.values[:, i], dtype=float)))
+
+    index = pd.DataFrame(rows, columns=['variable', 'source', 'scenario', 'band', 'unit', 'name'])
+
+    if not series:
+        return index, np.empty(0, dtype=int), np.empty((0, 0))
+
+    years = np.unique(np.concatenate([y for y, _ in series]))
+    values = np.full((len(series), len(years)), np.nan)
+    for r, (y, v) in enumerate(series):
+        values[r, np.searchsorted(years, y)] = v
+
+    return index, years, values
+
+
+def _join_historical(index, years, values):
+
+    # The CMIP6 projections start in 2015: their 1991-2020 baseline uses the historical run of the same band before that
+    historical = {(row.variable, row.band): r for r, row in enumerate(index.itertuples()) if row.source == 'CMIP6' and row.scenario == 'historical'}
+
+    joined = values.copy()
+    for r, row in enumerate(index.itertuples()):
+        h = historical.get((row.variable, row.band))
+        if row.source == 'CMIP6' and row.scenario != 'historical' and h is not None:
+            fill = np.isnan(joined[r]) & ~np.isnan(values[h])
+            joined[r, fill] = values[h, fill]
+
+    return joined
+
+
+def horizon_stats(climate_data, variables = None, horizons = HORIZONS, baseline = BASELINE, thresholds = None, min_baseline_years = MIN_BASELINE_YEARS):
+
+    '''
+    Function that computes, for every series (variable x source x scenario x band), the mean of the baseline and of each
+    horizon, the delta and the percent change with respect to the baseline, the spread of the bands (p90 - p10) and the
+    number of years of each horizon above a threshold.
+
+    The threshold of a series is the 90th percentile of its baseline years, or the value of thresholds for its variable.
+    The projections take the years before 2015 from the historical run of the same band, when it is loaded. A series with
+    less than min_baseline_years years in the baseline has NaN baseline, delta, percent change and percentile threshold.
+
+    Parameters:
+    climate_data (dict): The climate data of the session ({var: {source: {scenario: result}}}).
+    variables (list): The codes of the variables to include. Default is all.
+    horizons (dict): The horizons, as {label: (first year, last year)}.
+    baseline (tuple): The label and the (first year, last year) of the baseline.
+    thresholds (dict): Absolute exceedance thresholds, by variable code.
+    min_baseline_years (int): Minimum number of years with data in the baseline.
+
+    Returns:
+    stats (pd.DataFrame): One row per series and horizon, with baseline, mean, delta, pct_change, spread, threshold,
+                          exceedances, years (the number of years with data in the horizon) and baseline_years (the number
+                          of years with data in the baseline).
+    '''
+
+    index, years, values = collect_series(climate_data, variables)
+    columns = ['variable', 'source', 'scenario', 'band', 'unit', 'name', 'horizon', 'baseline', 'mean', 'delta', 'pct_change',
+               'spread', 'threshold', 'exceedances', 'years', 'baseline_years']
+
+    if index.empty:
+        return pd.DataFrame(columns=columns)
+
+    joined = _join_historical(index, years, values)
+    windows = {baseline[0]: baseline[1], **horizons}
+
+    # All the windows of all the series at once: series x windows
+    mask = window_masks(years, windows)
+    means = window_means(years, joined, windows)
+    counts = (~np.isnan(joined)).astype(float) @ mask.T.astype(float)
+
+    # The series with a short baseline have no baseline (the mean of a few years would be reported as the normal)
+    short = counts[:, 0] < min_baseline_years
+    means[short, 0] = np.nan
+
+    # Exceedance thresholds: percentile of the baseline years of each series, unless given for the variable
+    # (np.nanpercentile warns for the series without baseline years, whose threshold is NaN)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        threshold = np.nanpercentile(np.where(mask[0], joined, np.nan), EXCEEDANCE_PERCENTILE, axis=1)
+    threshold[short] = np.nan
+    for var, value in (thresholds or {}).items():
+        threshold[(index['variable'] == var).values] = value
+
+    with np.errstate(invalid='ignore'):
+        above = (joined > threshold[:, None]).astype(float)
+    exceedances = above @ mask.T.astype(float)
+
+    base = means[:, :1]
+    delta = means - base
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pct_change = np.where(base != 0, delta / np.abs(base) * 100, np.nan)
+
+    # Spread of the ensemble: p90 - p10 of the same variable, source and scenario
+    band_row = {(row.variable, row.source, row.scenario, row.band): r for r, row in enumerate(index.itertuples())}
+    spread = np.full(means.shape, np.nan)
+    for r, row in enumerate(index.itertuples()):
+        p10, p90 = band_row.get((row.variable, row.source, row.scenario, 'p10')), band_row.get((row.variable, row.source, row.scenario, 'p90'))
+        if p10 is not None and p90 is not None:
+            spread[r] = means[p90] - means[p10]
+
+    labels = list(windows)
+    stats = index.loc[np.repeat(np.arange(len(index)), len(labels))].reset_index(drop=True)
+    stats['horizon'] = np.tile(labels, len(index))
+    stats['baseline'] = np.repeat(base[:, 0], len(labels))
+
+    for name, array in [('mean', means), ('delta', delta), ('pct_change', pct_change), ('spread', spread), ('exceedances', exceedances), ('years', counts)]:
+        stats[name] = array.ravel()
+    stats['threshold'] = np.repeat(threshold, len(labels))
+    stats['baseline_years'] = np.repeat(counts[:, 0], len(labels))
+
+    # Horizons without data are dropped, the baseline row keeps the threshold of the series
+    stats = stats[stats['years'] > 0].reset_index(drop=True)
+    stats[['exceedances', 'years', 'baseline_years']] = stats[['exceedances', 'years', 'baseline_years']].astype(int)
+
+    return stats[columns]
+
+
+def _number(value, sign = False):
+
+    if pd.isna(value):
+        return '-'
+    return f'{value:+.2f}' if sign else f'{value:.2f}'
+
+
+def stats_text(stats, baseline = BASELINE):
+
+    '''
+    Function that formats the statistics as a compact text table for the LLM: one line per series, with the baseline and,
+    for each horizon, the mean, the delta, the percent change, the years above the threshold and the band spread.
+    A series without baseline (too few years, see horizon_stats) shows the number of years it has instead.
+
+    Parameters:
+    stats (pd.DataFrame): The statistics, as returned by horizon_stats.
+    baseline (tuple): The label and the years of the baseline.
+
+    Returns:
+    text (str): The table.
+    '''
+
+    if stats.empty:
+        return ''
+
+    lines = [f'Statistics computed locally. Baseline {baseline[0]}; each horizon: mean (delta, % change, years above the '
+             f'baseline p{EXCEEDANCE_PERCENTILE} / years with data, p90-p10 spread)']
+
+    for (var, source, scenario, band), group in stats.groupby(['variable', 'source', 'scenario', 'band'], sort=False):
+        base = group[group['horizon'] == baseline[0]]
+        base_years = group['baseline_years'].iloc[0]
+        cells = [f'{var} {source} {scenario} {band} ({group["unit"].iloc[0]})',
+                 f'base {_number(base["mean"].iloc[0])}' if len(base) and not pd.isna(base['mean'].iloc[0]) else
+                 f'base - (only {base_years} years of {baseline[0]})']
+
+        for row in group[group['horizon'] != baseline[0]].itertuples():
+            spread = f', spread {_number(row.spread)}' if not pd.isna(row.spread) else ''
+            exceedances = f'{row.exceedances}/{row.years}' if not pd.isna(row.threshold) else f'-/{row.years}'
+            cells.append(f'{row.horizon} {_number(row.mean)} ({_number(row.delta, True)}, {_number(row.pct_change, True)}%, '
+                         f'{exceedances}{spread})')
+
+        lines.append(' | '.join(cells))
+
+    return '\n'.join(lines)
@@ -1,7 +1,6 @@
 import streamlit as st
-from stqdm import stqdm
-from packages.CCKP_new_api import CCKP_api_ERA5, CCKP_api_CMIP6
-import pandas as pd
+from packages.variable_catalog import variable_catalog
+from packages.retrieval_engine import retrieve, plan_jobs, variable_codes
 
 
 categories = ['Average temperatures', 'Average precipitation', 'Heat', 'Cold', 'Drought', 'Extreme precipitation']
@@ -9,8 +8,7 @@ categories = ['Average temperatures', 'Average precipitation', 'Heat', 'Cold', '
 # Function for importing the variables
 @st.cache_data 
 def load_variables_table():
-    names_table = pd.read_excel('packages/geonames.xlsx', sheet_name='Variables').set_index('Code').to_dict()
-    return names_table
+    return variable_catalog().columns()
 
 @st.cache_data 
 def select_category(category):
@@ -27,17 +25,16 @@ def select_category(category):
     -> var_codes (set): the codes of the variables in the category
     '''
 
-    names_table = load_variables_table()
-    # Select the item in obj.variables_dict['Category'] that corresponds to the category
-    var_codes = {k for k, v in names_table['Category'].items() if v == category}
+    catalog = variable_catalog()
+    # Select the codes of the variables of the category
+    codes = catalog.codes(category)
+    var_codes = set(codes)
 
     # Select the names of the variables that are in var_codes
-    var_nm = {k: v for k, v in names_table['Variable'].items() if k in var_codes}
-    var_names = {v: k for k, v in var_nm.items()}
+    var_names = {catalog.by_code[k]['Variable']: k for k in codes}
 
     # Select the description of the variables
-    var_desc = {k: v for k, v in names_table['Description'].items() if k in var_codes}
-    var_description = [x for x in var_desc.values()]
+    var_description = [catalog.by_code[k]['Description'] for k in codes]
 
     return var_names, var_description, var_codes
 
@@ -112,7 +109,7 @@ def climate_form(sources, variables, scenarios, bands, latitude, longitude) -> N
         return True
 
 
-def retrieve_climate_data(variables, sources, scenarios, bands, latitude, longitude, climatology) -> None:
+def retrieve_climate_data(variables, sources, scenarios, bands, latitude, longitude, climatology, products = None, windows = None) -> None:
 
 
     '''
@@ -125,6 +122,9 @@ def retrieve_climate_data(variables, sources, scenarios, bands, latitude, longit
     -> bands (list): the bands selected by the user
     -> latitude (float): the latitude of the location
     -> longitude (float): the longitude of the location
+    -> climatology (bool): if True, the CMIP6 climatologies are used instead of the timeseries
+    -> products (list): the ERA5 products to retrieve (timeseries or climatology, trend, trendconfidence). Default is all
+    -> windows (list): the ERA5 trend windows to retrieve (1951-2020, 1971-2020, 1991-2020). Default is all
 
     Returns:
     -> None
@@ -139,8 +139,7 @@ def retrieve_climate_data(variables, sources, scenarios, bands, latitude, longit
         st.session_state.climate_data = {}
         st.session_state.climate_data['attrs'] = {'latitude': latitude, 'longitude': longitude}
 
-    selected_var_names = {v for k, v in variables.items() for v in v}
-    selected_var_codes = [k[0] for k in load_variables_table()['Variable'].items() if k[1] in selected_var_names]
+    selected_var_codes = variable_codes(variables)
 
     for v in selected_var_codes:
         if not st.session_state.climate_data.get(v):
@@ -153,40 +152,40 @@ def retrieve_climate_data(variables, sources, scenarios, bands, latitude, longit
             cl_bkp.pop(v)
     st.session_state.climate_data = cl_bkp
 
-    if sources[0]:
-        with st.status('Loading ERA5 data... [could take a while]'):
-            for v in stqdm(selected_var_codes):
-
-                if not st.session_state.climate_data[v].get('ERA5'):
-                    st.session_state.climate_data[v].update({'ERA5': {}})
-                    st.write(f'Loading {v}')
-                    obj = CCKP_api_ERA5(v)
-                    obj.retrieve_request()
-                    obj.load_point(latitude, longitude)
-                    obj.make_json_to_llm()
-                    st.session_state.climate_data[v].update({'ERA5': {'historical': obj}})
-                
-                else:
-                    st.write(f'{v} has already been loaded')
-    
+    # The pages expect the key of each selected source, even if empty
+    for v in selected_var_codes:
+        if sources[0]:
+            st.session_state.climate_data[v].setdefault('ERA5', {})
+        if sources[1]:
+            st.session_state.climate_data[v].setdefault('CMIP6', {})
+
+    with st.status('Loading climate data... [could take a while]') as status:
+
+        jobs, skipped = plan_jobs(selected_var_codes, sources, scenarios, st.session_state.climate_data, products, windows)
+        for v, source, scenario in skipped:
+            st.write(f'{v} has already been loaded' if source == 'ERA5' else f'{v} - {scenario} has already been loaded')
+
+        progress_bar = st.progress(0.0)
+        done = []
+
+        def progress(job_result):
 
+            # Called in the script thread as soon as each job ends
+            done.append(job_result)
+            progress_bar.progress(len(done) / len(jobs))
 
-    if sources[1]:
-        with st.status('Loading CMIP6 data... [could take a while]'):
-            for v in stqdm(selected_var_codes):
+            name = job_result['variable'] if job_result['source'] == 'ERA5' else f"{job_result['variable']} - {job_result['scenario']} - {bands}"
+            if job_result['error'] is None:
+                st.write(f"Loaded {job_result['source']} {name} ({job_result['status']}, {job_result['seconds']:.1f} s)")
+            else:
+                st.write(f"Error loading {job_result['source']} {name}: {job_result['error']}")
 
-                if not st.session_state.climate_data[v].get('CMIP6'):
-                    st.session_state.climate_data[v].update({'CMIP6': {}})
+        result = retrieve(selected_var_codes, sources, scenarios, bands, latitude, longitude, climatology,
+                          loaded=st.session_state.climate_data, progress=progress, products=products, windows=windows)
 
-                for scenario in scenarios:
+        for v, sources_data in result.data.items():
+            for source, objs in sources_data.items():
+                st.session_state.climate_data[v][source].update(objs)
 
-                    if not st.session_state.climate_data[v]['CMIP6'].get(scenario):
-                        st.write(f'Loading {v} - {scenario} - {bands}')
-                        obj = CCKP_api_CMIP6(v, scenario, bands, climatology)
-                        obj.retrieve_request()
-                        obj.load_point(latitude, longitude)
-                        obj.make_json_to_llm()
-                        st.session_state.climate_data[v]['CMIP6'].update({scenario: obj})
-                    
-                    else:
-                        st.write(f'{v} - {scenario} has already been loaded')
+        status.update(label=f'Climate data loaded: {len(result.jobs)} retrieved in {result.elapsed:.1f} s, {len(skipped)} already loaded',
+                      state='error' if result.status == 'Error' and result.jobs else 'complete')
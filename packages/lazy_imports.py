@@ -0,0 +1,151 @@
+# Lazy imports importations
+import sys
+import time
+import json
+import threading
+import importlib
+import subprocess
+
+# -- STARTUP-OPTIMIZED IMPORT LAYER
+# -- The heavy modules (xarray, s3fs, openai, langchain, plotly, folium...) are imported on first use instead of at the
+# -- load of the pages, and the time spent importing each of them is recorded for the startup timing report
+
+
+
+# Seconds spent importing each module in this process, in order of import
+import_times = {}
+_import_lock = threading.RLock()
+
+
+def timed_import(name):
+
+    '''
+    Function that imports a module and records the time spent importing it.
+    Modules already imported are returned without recording anything. If another thread is still importing the module,
+    importlib waits for the end of that import instead of returning the partially initialized module.
+
+    Parameters:
+    name (str): The name of the module (e.g. 'plotly.express').
+
+    Returns:
+    module (module): The imported module.
+    '''
+
+    if name in sys.modules:
+        return importlib.import_module(name)
+
+    with _import_lock:
+        if name in sys.modules:
+            return importlib.import_module(name)
+
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        import_times[name] = time.perf_counter() - start
+
+    return module
+
+
+
+class LazyModule():
+
+    '''
+    Proxy of a module that is imported on the first access to one of its attributes.
+
+    Parameters:
+    name (str): The name of the module.
+    '''
+
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+
+
+    def _load(self):
+
+        module = object.__getattribute__(self, '_module')
+        if module is None:
+            module = timed_import(object.__getattribute__(self, '_name'))
+            object.__setattr__(self, '_module', module)
+
+        return module
+
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+    def __repr__(self):
+
+        name = object.__getattribute__(self, '_name')
+        state = 'loaded' if object.__getattribute__(self, '_module') is not None else 'not loaded'
+        return f'<lazy module {name!r} ({state})>'
+
+
+
+def lazy_import(name):
+
+    '''
+    Function that returns a lazy proxy of a module: e.g. xr = lazy_import('xarray') can be used as import xarray as xr,
+    but xarray is only imported the first time one of its attributes is used.
+    If the module is already imported, the module itself is returned.
+    '''
+
+    return sys.modules.get(name) or LazyModule(name)
+
+
+def import_report():
+
+    '''
+    Function that returns the time spent importing the modules loaded through this layer in the current process.
+
+    Returns:
+    report (list): Tuples (module, seconds), the slowest first.
+    '''
+
+    with _import_lock:
+        return sorted(import_times.items(), key=lambda item: item[1], reverse=True)
+
+
+# Modules loaded by the pages, measured by the cold start report
+STARTUP_MODULES = ['streamlit', 'pandas', 'numpy', 'xarray', 's3fs', 'h5netcdf', 'openai', 'langchain_core.messages',
+                   'langchain_core.tools', 'langchain_openai', 'plotly.express', 'folium', 'streamlit_folium', 'stqdm',
+                   'dotenv', 'packages.CCKP_new_api', 'packages.interaction_funcs', 'packages.LLM_agents']
+
+
+def cold_import_times(modules = STARTUP_MODULES):
+
+    '''
+    Function that measures the cold import time of each module, importing it in a fresh interpreter.
+    The time of a module includes the time of the modules it imports.
+
+    Parameters:
+    modules (list): The names of the modules.
+
+    Returns:
+    report (list): Tuples (module, seconds), the slowest first. Modules that cannot be imported have None.
+    '''
+
+    script = 'import sys, time, json, importlib; start = time.perf_counter(); importlib.import_module(sys.argv[1]); print(json.dumps(time.perf_counter() - start))'
+
+    report = []
+    for name in modules:
+        result = subprocess.run([sys.executable, '-c', script, name], capture_output=True, text=True)
+        report.append((name, json.loads(result.stdout.strip().splitlines()[-1]) if result.returncode == 0 else None))
+
+    return sorted(report, key=lambda item: -1 if item[1] is None else item[1], reverse=True)
+
+
+
+if __name__ == '__main__':
+
+    print(f'{"module":<30}{"cold import [s]":>16}')
+    for name, seconds in cold_import_times():
+        print(f'{name:<30}{"failed" if seconds is None else f"{seconds:.3f}":>16}')
@@ -0,0 +1,273 @@
+# LLM cache importations
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from langchain_core.caches import BaseCache
+from langchain_core.outputs import ChatGeneration, Generation
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+# -- CONTENT-ADDRESSED ON-DISK CACHE OF THE LLM COMPLETIONS
+# -- A completion is keyed by the hash of the deployment, the parameters and the full message list, so identical requests
+# -- (a rerun, a reset, a second user analysing the same site) are answered from disk, by any session and any process
+
+
+
+def completion_key(deployment, params, messages):
+
+    '''
+    Function that returns the key of a completion: the sha256 of the canonical json of the deployment, the parameters
+    and the messages.
+
+    Parameters:
+    deployment (str): The deployment (or the model string of a langchain model).
+    params (dict): The parameters of the call (temperature, tools...).
+    messages (list or str): The messages, as dictionaries, or their serialization.
+
+    Returns:
+    key (str): The hexadecimal hash.
+    '''
+
+    payload = json.dumps({'deployment': deployment, 'params': params, 'messages': messages}, sort_keys=True, default=str, ensure_ascii=False)
+
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+
+class CompletionCache():
+
+    '''
+    SQLite cache of the LLM completions, keyed by completion_key.
+
+    The entries older than ttl seconds are expired, and the least recently used entries are evicted when the size of the
+    stored completions exceeds max_bytes. Every call opens its own connection, so the cache can be shared by threads and
+    by processes.
+
+    Parameters:
+    directory (str): Directory of the cache. Default is the CCKP_CACHE_DIR environment variable, or ~/.cache/climalm.
+    max_bytes (int): Maximum size of the stored completions, in bytes.
+    ttl (float): Time to live of the entries, in seconds. Default is the LLM_CACHE_TTL environment variable, or 7 days.
+    enabled (bool): If False, the cache is never read nor written. Default is False when LLM_CACHE is set to 0.
+    '''
+
+    def __init__(self, directory = None, max_bytes = 64 * 2 ** 20, ttl = None, enabled = None):
+
+        self.directory = directory or os.environ.get('CCKP_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'climalm'))
+        self.path = os.path.join(self.directory, 'llm_completions.sqlite')
+        self.max_bytes = max_bytes
+        self.ttl = ttl if ttl is not None else float(os.environ.get('LLM_CACHE_TTL', 7 * 24 * 3600))
+        self.enabled = enabled if enabled is not None else os.environ.get('LLM_CACHE', '1') != '0'
+
+        self._lock = threading.Lock()
+        self._initialized = False
+        self.counters = {'hits': 0, 'misses': 0, 'expired': 0, 'puts': 0, 'evictions': 0}
+
+
+    @contextmanager
+    def _connect(self):
+
+        # One connection per call, committed and closed at the end of the block
+        os.makedirs(self.directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+
+        try:
+            if not self._initialized:
+                with self._lock:
+                    connection.execute('PRAGMA journal_mode=WAL')
+                    connection.execute('CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT, nbytes INTEGER, '
+                                       'created REAL, last_access REAL)')
+                    connection.execute('CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)')
+                    self._initialized = True
+
+            yield connection
+            connection.commit()
+
+        finally:
+            connection.close()
+
+
+    def _count(self, counter, n = 1):
+
+        with self._lock:
+            self.counters[counter] += n
+
+
+    def get(self, key):
+
+        '''
+        Function that returns the cached completion of the key, or None if it is not cached or expired.
+
+        Returns:
+        value: The completion, as stored by put (any json value).
+        '''
+
+        if not self.enabled:
+            return None
+
+        now = time.time()
+
+        with self._connect() as connection:
+            row = connection.execute('SELECT value, created FROM completions WHERE key = ?', (key,)).fetchone()
+
+            if row is not None and now - row[1] > self.ttl:
+                connection.execute('DELETE FROM completions WHERE key = ?', (key,))
+                self._count('expired')
+                row = None
+
+            if row is None:
+                self._count('misses')
+                return None
+
+            connection.execute('UPDATE completions SET last_access = ? WHERE key = ?', (now, key))
+
+        self._count('hits')
+
+        return json.loads(row[0])
+
+
+    def put(self, key, value):
+
+        '''
+        Function that stores the completion (any json value) of the key.
+        '''
+
+        if not self.enabled:
+            return
+
+        data = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)', (key, data, len(data.encode()), now, now))
+            self._count('puts')
+            self._evict(connection)
+
+
+    def _evict(self, connection):
+
+        # Removing the expired entries, then the least recently used ones until the cache fits in max_bytes
+        self._count('evictions', connection.execute('DELETE FROM completions WHERE created < ?', (time.time() - self.ttl,)).rowcount)
+
+        total = connection.execute('SELECT COALESCE(SUM(nbytes), 0) FROM completions').fetchone()[0]
+
+        while total > self.max_bytes:
+            row = connection.execute('SELECT key, nbytes FROM completions ORDER BY last_access LIMIT 1').fetchone()
+            if row is None:
+                break
+            connection.execute('DELETE FROM completions WHERE key = ?', (row[0],))
+            total -= row[1]
+            self._count('evictions')
+
+
+    def clear(self):
+
+        '''
+        Function that removes all the entries of the cache.
+        '''
+
+        if os.path.exists(self.path):
+            with self._connect() as connection:
+                connection.execute('DELETE FROM completions')
+
+
+    def stats(self):
+
+        '''
+        Function that returns the hit/miss counters of the process, together with the number of entries and the size of the cache.
+        '''
+
+        entries, nbytes = 0, 0
+        if os.path.exists(self.path):
+            with self._connect() as connection:
+                entries, nbytes = connection.execute('SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM completions').fetchone()
+
+        with self._lock:
+            requests = self.counters['hits'] + self.counters['misses']
+            return {**self.counters, 'hit_rate': self.counters['hits'] / requests if requests else 0.0,
+                    'entries': entries, 'bytes': nbytes, 'max_bytes': self.max_bytes, 'ttl': self.ttl, 'path': self.path}
+
+
+
+class LangchainCompletionCache(BaseCache):
+
+    '''
+    Adapter of a CompletionCache to the cache interface of the langchain chat models (cache=... of AzureChatOpenAI).
+    langchain passes the serialized messages as prompt and the model parameters (deployment, temperature, bound tools)
+    as llm_string, so both are part of the key.
+
+    Parameters:
+    cache (CompletionCache): The cache of the completions.
+    '''
+
+    def __init__(self, cache):
+        self.cache = cache
+
+
+    def lookup(self, prompt, llm_string):
+
+        value = self.cache.get(completion_key(llm_string, {}, prompt))
+        if value is None:
+            return None
+
+        return [ChatGeneration(message=messages_from_dict([g['message']])[0]) if g.get('message') else Generation(text=g['text'])
+                for g in value]
+
+
+    def update(self, prompt, llm_string, return_val):
+
+        value = [{'message': message_to_dict(g.message)} if isinstance(g, ChatGeneration) else {'text': g.text} for g in return_val]
+        self.cache.put(completion_key(llm_string, {}, prompt), value)
+
+
+    def clear(self, **kwargs):
+        self.cache.clear()
+
+
+    def _message_key(self, model, messages, tools, tool_choice):
+
+        # Built from the public fields of the model and the openai schemas of the tools only, so it does not depend on
+        # the internals of a langchain version (the ids of the messages change at every run, they are not part of it)
+        deployment = getattr(model, 'deployment_name', None) or getattr(model, 'model_name', None)
+        params = {'temperature': getattr(model, 'temperature', None), 'tools': [convert_to_openai_tool(t) for t in tools or []],
+                  'tool_choice': tool_choice}
+        normalized = [m.model_copy(update={'id': None}) if getattr(m, 'id', None) is not None else m for m in messages]
+
+        return completion_key(deployment, params, [message_to_dict(m) for m in normalized])
+
+
+    def lookup_message(self, model, messages, tools = None, tool_choice = None):
+
+        '''
+        Function that returns the cached answer of a chat model to the messages, or None. It is used by the streamed
+        calls, since langchain only reads the cache in invoke.
+
+        Parameters:
+        model (BaseChatModel): The chat model (without the tools).
+        messages (list): The messages.
+        tools (list): The tools bound to the model, if any.
+        tool_choice (str): The tool_choice bound to the model, if any.
+
+        Returns:
+        message (AIMessage): The cached answer.
+        '''
+
+        value = self.cache.get(self._message_key(model, messages, tools, tool_choice))
+
+        return messages_from_dict([value[0]['message']])[0] if value and value[0].get('message') else None
+
+
+    def update_message(self, model, messages, message, tools = None, tool_choice = None):
+
+        '''
+        Function that stores the answer of a chat model to the messages (see lookup_message).
+        '''
+
+        self.cache.put(self._message_key(model, messages, tools, tool_choice), [{'message': message_to_dict(message)}])
+
+
+# Shared cache used by the LLM calls of the process
+completion_cache = CompletionCache()
@@ -0,0 +1,69 @@
+# LLM clients importations
+import streamlit as st
+from packages.lazy_imports import timed_import
+
+# -- AZURE OPENAI CLIENTS
+# -- The clients are built once per process (st.cache_resource) and shared by all the sessions and reruns of the pages.
+# -- openai and langchain_openai are only imported when the first client is built. The deterministic (temperature 0)
+# -- chat models answer the repeated requests from the completion cache
+
+
+
+API_VERSION = '2024-02-01'
+
+
+@st.cache_resource(show_spinner=False)
+def azure_chat_llm(deployment_name = 'llm-gpt35', temperature = 0):
+
+    '''
+    Function that returns the AzureChatOpenAI model of the process. With temperature 0 the completions are cached
+    (see llm_cache), since the same messages give the same answer.
+
+    Parameters:
+    deployment_name (str): The name of the Azure deployment.
+    temperature (float): The temperature of the model.
+
+    Returns:
+    llm (AzureChatOpenAI): The langchain chat model.
+    '''
+
+    langchain_openai = timed_import('langchain_openai')
+
+    # Imported here with langchain, which the cache adapter depends on
+    from packages.llm_cache import completion_cache, LangchainCompletionCache
+
+    return langchain_openai.AzureChatOpenAI(deployment_name=deployment_name, openai_api_version=API_VERSION,
+                                            openai_api_key=st.secrets['OPENAI_API_KEY'], azure_endpoint=st.secrets['AZURE_ENDPOINT'],
+                                            temperature=temperature,
+                                            cache=LangchainCompletionCache(completion_cache) if temperature == 0 else False)
+
+
+@st.cache_resource(show_spinner=False)
+def azure_openai_client():
+
+    '''
+    Function that returns the AzureOpenAI client of the process.
+
+    Returns:
+    client (AzureOpenAI): The openai client.
+    '''
+
+    openai = timed_import('openai')
+
+    return openai.AzureOpenAI(azure_endpoint=st.secrets['AZURE_ENDPOINT'], api_key=st.secrets['OPENAI_API_KEY'], api_version=API_VERSION)
+
+
+def azure_async_openai_client():
+
+    '''
+    Function that returns a new AsyncAzureOpenAI client.
+    It is not cached: the connections of an async client belong to the event loop that opened them, and each run of an
+    async pipeline (asyncio.run) has its own loop. Use it as an async context manager, so the connections are closed.
+
+    Returns:
+    client (AsyncAzureOpenAI): The async openai client.
+    '''
+
+    openai = timed_import('openai')
+
+    return openai.AsyncAzureOpenAI(azure_endpoint=st.secrets['AZURE_ENDPOINT'], api_key=st.secrets['OPENAI_API_KEY'], api_version=API_VERSION)
@@ -0,0 +1,272 @@
+# LLM context importations
+import os
+import math
+import json
+import threading
+import numpy as np
+from packages.lazy_imports import lazy_import
+from packages.horizon_stats import BASELINE, HORIZONS as STATS_HORIZONS, window_means, horizon_stats, stats_text
+
+# tiktoken is installed with langchain_openai, but its encodings are downloaded on first use
+tiktoken = lazy_import('tiktoken')
+
+# -- COMPACT CONTEXT OF THE CLIMATE DATA FOR THE LLM
+# -- The json_to_llm payloads are turned into small text tables (local statistics per time horizon and decimated series)
+# -- that fit a token budget, instead of sending the full yearly series of every band and scenario
+
+
+
+# Default budget of the context, in tokens
+MAX_TOKENS = int(os.environ.get('LLM_CONTEXT_TOKENS', 3000))
+
+# Time horizons of the tables: the historical normal, then 2030, 2050 and 2100 with plus/minus 5 years (see horizon_stats)
+HORIZONS = {BASELINE[0]: BASELINE[1], **STATS_HORIZONS}
+
+# Decimation steps of the series (in years), tried in order until the context fits the budget. None drops the series
+STEPS = [1, 2, 5, 10, 20, None]
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+
+    '''
+    Function that estimates the number of tokens of a text, with the cl100k_base encoding of tiktoken when it is available
+    and with 4 characters per token otherwise (e.g. when the encoding cannot be downloaded).
+
+    Parameters:
+    text (str): The text.
+
+    Returns:
+    tokens (int): The estimated number of tokens.
+    '''
+
+    global _encoding
+
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                _encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception:
+                _encoding = False
+
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+
+    return math.ceil(len(text) / 4)
+
+
+def _number(value):
+
+    # Values of the payloads are strings (default layout) or numbers (columnar layout), None when missing
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _format(value):
+
+    return '-' if np.isnan(value) else f'{value:.2f}'.rstrip('0').rstrip('.')
+
+
+def payload_series(timeseries_json):
+
+    '''
+    Function that returns the timeseries of a payload as arrays, for both the default and the columnar layout.
+
+    Parameters:
+    timeseries_json (dict): The 'timeseries in unit' value of a json_to_llm payload.
+
+    Returns:
+    years (np.ndarray): The years, sorted.
+    columns (dict): The values of each column, aligned with the years.
+    '''
+
+    if not timeseries_json:
+        return np.empty(0, dtype=int), {}
+
+    if 'values' in timeseries_json and isinstance(timeseries_json['values'], dict):
+        years = np.asarray(next(v for k, v in timeseries_json.items() if k != 'values'), dtype=int)
+        columns = {name: np.array([_number(v) for v in values]) for name, values in timeseries_json['values'].items()}
+
+    else:
+        keys = sorted({int(year) for values in timeseries_json.values() for year in values})
+        years = np.asarray(keys, dtype=int)
+        columns = {name: np.array([_number(values.get(str(year))) for year in keys]) for name, values in timeseries_json.items()}
+
+    order = np.argsort(years)
+
+    return years[order], {name: values[order] for name, values in columns.items()}
+
+
+def payload_scalars(values_json):
+
+    '''
+    Function that returns the single values of the trends or the confidences of a payload, as {name: number}.
+    '''
+
+    if not values_json:
+        return {}
+
+    return {name: _number(next(iter(value.values()), None) if isinstance(value, dict) else value) for name, value in values_json.items()}
+
+
+def _table(header, rows):
+
+    # Pipe-separated table, the most compact layout still read reliably by the model
+    return '\n'.join(' | '.join(str(cell) for cell in row) for row in [header] + rows)
+
+
+def payload_section(label, payload, step = 1, horizons = HORIZONS):
+
+    '''
+    Function that turns a json_to_llm payload into a compact text section: the horizon means, the series decimated
+    every step years (the first and the last years are always kept), the trends and the confidences.
+
+    Parameters:
+    label (str): The label of the section (e.g. 'ERA5 historical' or 'CMIP6 ssp585').
+    payload (dict): The json_to_llm payload of a CCKP object (or of a PointResult).
+    step (int): The decimation step of the series, in years. None drops the series and keeps only the statistics.
+    horizons (dict): The horizons of the statistics.
+
+    Returns:
+    section (str): The text of the section.
+    '''
+
+    values = payload.get('values', {})
+    years, columns = payload_series(values.get('timeseries in unit'))
+
+    lines = [f"## {payload['var_code']} {label}: {payload['var_name']} ({payload['unit']})"]
+
+    failed = [key for key, status in payload.get('status', {}).items() if status in ('Error', 'Partial')]
+    if failed:
+        lines.append(f'Missing: {", ".join(failed)}')
+
+    if columns:
+        data = np.vstack(list(columns.values()))
+        lines.append(f'Years {years[0]}-{years[-1]}')
+
+        # Only the horizons covered by the series are shown
+        means = window_means(years, data, horizons)
+        covered = ~np.all(np.isnan(means), axis=0)
+        if covered.any():
+            labels = [h for h, c in zip(horizons, covered) if c]
+            lines.append(_table(['horizon mean'] + labels, [[name] + [_format(v) for v in row[covered]] for name, row in zip(columns, means)]))
+
+        if step is not None:
+            keep = np.zeros(len(years), dtype=bool)
+            keep[::step] = True
+            keep[-1] = True
+            lines.append(_table(['year'] + years[keep].tolist(), [[name] + [_format(v) for v in row[keep]] for name, row in zip(columns, data)]))
+
+    for key, title in [('trends in units/decades', 'Trends (units/decade)'), ('confidence in percentage', 'Confidence (%)')]:
+        scalars = payload_scalars(values.get(key))
+        if scalars:
+            lines.append(f'{title}: ' + ', '.join(f'{name} {_format(v)}' for name, v in scalars.items()))
+
+    return '\n'.join(lines)
+
+
+def build_context(sections, max_tokens = MAX_TOKENS, notes = None, steps = STEPS, horizons = HORIZONS):
+
+    '''
+    Function that builds the context sent to the LLM from the payloads, within a token budget.
+    The series are decimated with the smallest step of steps that fits the budget; if even the statistics do not fit,
+    the last sections are left out (and listed in the context, so the model knows they exist).
+
+    Parameters:
+    sections (list): The sections, as (label, payload) tuples.
+    max_tokens (int): The budget of the context, in tokens (estimate_tokens).
+    notes (list): Texts always included before the sections (e.g. descriptions already written), counted in the budget.
+    steps (list): The decimation steps to try.
+    horizons (dict): The horizons of the statistics.
+
+    Returns:
+    context (dict): The text, its tokens, the step used, the tokens of each section and the labels of the omitted sections.
+    '''
+
+    notes = [note for note in (notes or []) if note]
+    notes_tokens = [estimate_tokens(note) for note in notes]
+    budget = max_tokens - sum(notes_tokens)
+
+    for step in steps:
+        texts = [payload_section(label, payload, step, horizons) for label, payload in sections]
+        tokens = [estimate_tokens(text) for text in texts]
+        if sum(tokens) + len(texts) <= budget:
+            break
+
+    # Leaving out the sections that do not fit, in order
+    kept, omitted, used = [], [], 0
+    for (label, payload), text, n in zip(sections, texts, tokens):
+        if used + n + 1 <= budget:
+            kept.append((label, payload, text, n))
+            used += n + 1
+        else:
+            omitted.append(f"{payload.get('var_code')} {label}")
+
+    parts = notes + [text for _, _, text, _ in kept]
+    if omitted:
+        parts.append('Not included for the size of the context: ' + ', '.join(omitted))
+
+    text = '\n\n'.join(parts)
+
+    return {'text': text, 'tokens': estimate_tokens(text), 'max_tokens': max_tokens, 'step': step,
+            'sections': {f"{payload.get('var_code')} {label}": n for label, payload, _, n in kept},
+            'notes_tokens': sum(notes_tokens), 'omitted': omitted}
+
+
+def climate_data_sections(climate_data, variables = None):
+
+    '''
+    Function that returns the sections of the session state climate_data ({var: {source: {scenario: result}}}).
+
+    Parameters:
+    climate_data (dict): The climate data of the session.
+    variables (list): The codes of the variables to include. Default is all.
+
+    Returns:
+    sections (list): The (label, payload) tuples.
+    '''
+
+    sections = []
+    for var, data in climate_data.items():
+        if var == 'attrs' or (variables is not None and var not in variables):
+            continue
+        for source in ['ERA5', 'CMIP6']:
+            for scenario, result in (data.get(source) or {}).items():
+                if getattr(result, 'json_to_llm', None):
+                    sections.append((f'{source} {scenario}', result.json_to_llm))
+
+    return sections
+
+
+def climate_data_context(climate_data, max_tokens = MAX_TOKENS, variables = None, descriptions = True):
+
+    '''
+    Function that builds the context of the session state climate_data, with the location, the statistics of the time
+    horizons (see horizon_stats) and, if descriptions is True, the descriptions already written for the variables.
+    '''
+
+    notes = []
+    attrs = climate_data.get('attrs')
+    if attrs:
+        notes.append(f"Location: latitude {attrs['latitude']}, longitude {attrs['longitude']}")
+
+    notes.append(stats_text(horizon_stats(climate_data, variables)))
+
+    if descriptions:
+        notes += [f'## Analysis of {var}\n{data["Description"]}' for var, data in climate_data.items()
+                  if var != 'attrs' and (variables is None or var in variables) and data.get('Description')]
+
+    return build_context(climate_data_sections(climate_data, variables), max_tokens, notes)
+
+
+def context_report(context):
+
+    '''
+    Function that returns the token estimates of a context as a json string (for logs and the debug expanders).
+    '''
+
+    return json.dumps({key: context[key] for key in ['tokens', 'max_tokens', 'step', 'notes_tokens', 'sections', 'omitted']}, indent=1)
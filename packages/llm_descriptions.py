@@ -0,0 +1,148 @@
+# LLM descriptions importations
+import os
+import time
+import asyncio
+from packages.llm_clients import azure_async_openai_client
+from packages.llm_cache import completion_cache, completion_key
+from packages.llm_streaming import TextStream
+
+# -- CONCURRENT DESCRIPTIONS OF THE VARIABLES
+# -- The descriptions of all the variables are requested at once with an async client, with a bound on the concurrent
+# -- calls, and each one is handed back as soon as it arrives. Descriptions of identical data and requests are read
+# -- from the completion cache
+
+
+
+# Deployment used for the descriptions
+MODEL = 'llm-gpt35'
+
+# Maximum number of concurrent calls to the model
+MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 4))
+
+
+def description_messages(context, request):
+
+    '''
+    Function that returns the messages of a description: the request, then the context of the data.
+
+    Parameters:
+    context (str): The context of the variable (see llm_context.build_context).
+    request (str): The request of the analysis.
+
+    Returns:
+    messages (list): The chat messages.
+    '''
+
+    return [{'role': 'system', 'content': request}, {'role': 'system', 'content': context}]
+
+
+async def describe_graphs_async(client, context, request, model = MODEL, cache = completion_cache, on_text = None):
+
+    '''
+    Function that asks the model for the description of the data of a variable.
+    A description is written once for the data and the request (it is then kept in the session), so the description of
+    identical messages is reused from the cache instead of sampling a new one.
+
+    Parameters:
+    client (AsyncAzureOpenAI): The async openai client.
+    context (str): The context of the variable.
+    request (str): The request of the analysis.
+    model (str): The deployment of the model.
+    cache (CompletionCache): The completion cache. None disables it.
+    on_text (callable): If given, the answer is streamed and on_text is called with the text received so far
+                        (throttled, see llm_streaming.TextStream), and once with the complete text.
+
+    Returns:
+    description (str): The description written by the model.
+    cached (bool): True if the description comes from the cache.
+    '''
+
+    messages = description_messages(context, request)
+    key = completion_key(model, {}, messages)
+
+    # SQLite is blocking, but a lookup takes a fraction of a millisecond
+    description = cache.get(key) if cache is not None else None
+    if description is not None:
+        if on_text:
+            on_text(description)
+        return description, True
+
+    if on_text is None:
+        response = await client.chat.completions.create(model=model, messages=messages)
+        description = response.choices[0].message.content
+
+    else:
+        stream = TextStream(on_text)
+        async for chunk in await client.chat.completions.create(model=model, messages=messages, stream=True):
+            # Azure sends chunks without choices (e.g. the content filter results)
+            if chunk.choices and chunk.choices[0].delta.content:
+                stream.add(chunk.choices[0].delta.content)
+        description = stream.close()
+
+    if cache is not None:
+        cache.put(key, description)
+
+    return description, False
+
+
+async def describe_all_async(jobs, on_result = None, max_concurrency = MAX_CONCURRENCY, client_factory = azure_async_openai_client, model = MODEL,
+                             on_text = None):
+
+    '''
+    Function that requests all the descriptions at once, with at most max_concurrency calls in flight.
+    A failed call does not stop the others: its result has the error and no description.
+
+    Parameters:
+    jobs (dict): The descriptions to write, as {key: (context, request)}.
+    on_result (callable): Function called with each result as soon as it arrives (in the thread of the event loop).
+    max_concurrency (int): The maximum number of concurrent calls.
+    client_factory (callable): Function that returns a new async client.
+    model (str): The deployment of the model.
+    on_text (callable): If given, the answers are streamed and on_text is called with the key and the text so far.
+
+    Returns:
+    results (dict): For each key, a dictionary with key, description, error, cached, seconds (latency of the call),
+                    ttft (seconds to the first token of a streamed call) and waited (seconds spent waiting for a free slot).
+    '''
+
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    results = {}
+
+    async with client_factory() as client:
+
+        async def describe(key, context, request):
+            queued = time.perf_counter()
+            async with semaphore:
+                start = time.perf_counter()
+                first = []
+
+                def text(so_far):
+                    if not first and so_far:
+                        first.append(time.perf_counter() - start)
+                    on_text(key, so_far)
+
+                try:
+                    (description, cached), error = await describe_graphs_async(client, context, request, model, on_text=text if on_text else None), None
+                except Exception as e:
+                    description, cached, error = None, False, repr(e)
+                return {'key': key, 'description': description, 'error': error, 'cached': cached,
+                        'seconds': time.perf_counter() - start, 'ttft': first[0] if first else None, 'waited': start - queued}
+
+        for future in asyncio.as_completed([describe(key, context, request) for key, (context, request) in jobs.items()]):
+            result = await future
+            results[result['key']] = result
+            if on_result:
+                on_result(result)
+
+    return results
+
+
+def describe_all(jobs, on_result = None, max_concurrency = MAX_CONCURRENCY, client_factory = azure_async_openai_client, model = MODEL,
+                 on_text = None):
+
+    '''
+    Function that runs describe_all_async from synchronous code (e.g. a Streamlit page). on_result and on_text are
+    called in the calling thread, so they can write to the page.
+    '''
+
+    return asyncio.run(describe_all_async(jobs, on_result, max_concurrency, client_factory, model, on_text))
@@ -0,0 +1,99 @@
+# LLM streaming importations
+import time
+
+# -- STREAMING OF THE LLM ANSWERS INTO THE PAGES
+# -- The tokens are shown as they arrive, and the time to the first token and the total latency of each answer are recorded
+
+
+
+# Minimum seconds between two updates of a streamed text (each update is a message to the browser)
+STREAM_INTERVAL = 0.05
+
+# Cursor shown at the end of a text while it is streamed
+CURSOR = '▌'
+
+
+def timed_chunks(chunks, timings, is_token = bool):
+
+    '''
+    Function that yields the chunks of a stream and records its latency.
+
+    Parameters:
+    chunks (iterable): The chunks (text, or langchain message chunks).
+    timings (dict): Filled with ttft (seconds to the first token, None if there is none) and total (seconds to the end
+                    of the stream).
+    is_token (callable): Function that returns True for the chunks carrying a token. Default is the non-empty chunks.
+
+    Yields:
+    chunk: The chunks.
+    '''
+
+    start = time.perf_counter()
+    timings['ttft'] = None
+
+    for chunk in chunks:
+        if timings['ttft'] is None and is_token(chunk):
+            timings['ttft'] = time.perf_counter() - start
+        yield chunk
+
+    timings['total'] = time.perf_counter() - start
+
+
+
+class TextStream():
+
+    '''
+    Accumulator of a streamed text that calls on_text with the text received so far, at most every interval seconds.
+
+    Parameters:
+    on_text (callable): Function called with the text so far (e.g. a placeholder update).
+    interval (float): Minimum seconds between two calls.
+    '''
+
+    def __init__(self, on_text, interval = STREAM_INTERVAL):
+
+        self.on_text = on_text
+        self.interval = interval
+        self.text = ''
+        self._last = 0.0
+
+
+    def add(self, chunk):
+
+        self.text += chunk or ''
+
+        now = time.perf_counter()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.on_text(self.text)
+
+
+    def close(self):
+
+        # The complete text is always shown
+        self.on_text(self.text)
+
+        return self.text
+
+
+def render_stream(placeholder, chunks, interval = STREAM_INTERVAL):
+
+    '''
+    Function that writes the text chunks into a Streamlit placeholder (st.empty()) as they arrive, with a cursor until the end.
+
+    Parameters:
+    placeholder (st.delta_generator.DeltaGenerator): The placeholder.
+    chunks (iterable): The text chunks.
+    interval (float): Minimum seconds between two updates of the placeholder.
+
+    Returns:
+    text (str): The complete text.
+    '''
+
+    stream = TextStream(lambda text: placeholder.markdown(text + CURSOR), interval)
+    for chunk in chunks:
+        stream.add(chunk)
+
+    stream.on_text = placeholder.markdown
+
+    return stream.close()
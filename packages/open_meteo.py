@@ -0,0 +1,439 @@
+# Open-Meteo importations
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from packages.open_meteo_cache import weather_cache
+from packages.payload_encoder import encode_columnar, PRECISION
+
+# -- OPEN-METEO ARCHIVE CLIENT
+# -- A pooled HTTP session with retries and timeouts. Long periods are split into one request per year, fetched
+# -- concurrently, and each response is decoded into NumPy columns when its body is complete, so the hourly series of
+# -- decades are never held as a single JSON body. A body (one year) is small and it is parsed whole, not incrementally
+
+
+
+ARCHIVE_URL = 'https://archive-api.open-meteo.com/v1/archive'
+
+# Number of concurrent requests of a retrieval (and connections kept in the pool)
+MAX_WORKERS = int(os.environ.get('OPEN_METEO_WORKERS', 4))
+
+# Seconds to connect and to wait for each response
+TIMEOUT = (10, 120)
+
+# TLS verification, disabled by default as in the original requests of the page (set OPEN_METEO_VERIFY=1 to enable it)
+VERIFY = os.environ.get('OPEN_METEO_VERIFY', '0') != '0'
+
+# Daily aggregates computed by Open-Meteo from the hourly ERA5 values (UTC days), usable instead of the hourly data
+DAILY_PARAMETERS = {'temperature_2m_mean', 'temperature_2m_min', 'temperature_2m_max', 'precipitation_sum',
+                    'wind_speed_10m_max', 'wind_gusts_10m_max'}
+
+# Pandas rules and index formats of the resample codes of get_past_weather
+RESAMPLE_RULES = {'Y': 'YE', 'M': 'ME', 'W': 'W', 'D': 'D'}
+INDEX_FORMATS = {'Y': '%Y', 'M': '%Y-%m', 'W': '%Y-%W', 'D': '%Y-%m-%d', 'H': '%Y-%m-%d %H'}
+
+
+
+class OpenMeteoClient():
+
+    '''
+    Client of the Open-Meteo archive API, shared by the threads (and so by the Streamlit sessions) of a process.
+
+    Parameters:
+    url (str): The url of the archive API.
+    max_workers (int): Number of concurrent requests of a retrieval.
+    retries (int): Retries of a request on connection errors and 429/5xx responses, with exponential backoff.
+    timeout (tuple): Seconds to connect and to wait for each response.
+    verify (bool): TLS verification.
+    '''
+
+    def __init__(self, url = ARCHIVE_URL, max_workers = MAX_WORKERS, retries = 3, timeout = TIMEOUT, verify = VERIFY):
+
+        self.url = url
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.verify = verify
+
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, max_workers), max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self.counters = {'requests': 0, 'bytes': 0, 'seconds': 0.0, 'errors': 0}
+
+
+    def _count(self, **values):
+
+        with self._lock:
+            for counter, value in values.items():
+                self.counters[counter] += value
+
+
+    def get(self, params):
+
+        '''
+        Function that sends one request to the archive API.
+
+        Parameters:
+        params (dict): The query parameters.
+
+        Returns:
+        data (dict): The decoded json.
+        '''
+
+        start = time.perf_counter()
+
+        try:
+            response = self.session.get(self.url, params=params, timeout=self.timeout, verify=self.verify)
+
+            # Open-Meteo explains the invalid requests in the body ({"error": true, "reason": ...})
+            if response.status_code == 400:
+                raise ValueError(f'Open-Meteo: {response.json().get("reason", response.text)}')
+            response.raise_for_status()
+
+            data = json.loads(response.content)
+
+        except Exception:
+            self._count(errors=1)
+            raise
+
+        self._count(requests=1, bytes=len(response.content), seconds=time.perf_counter() - start)
+
+        return data
+
+
+    def fetch(self, latitude, longitude, variables, start, end, frequency = 'hourly', models = 'era5'):
+
+        '''
+        Function that retrieves the series of one location, with one request per calendar year run concurrently.
+
+        Parameters:
+        latitude (float): The latitude of the location.
+        longitude (float): The longitude of the location.
+        variables (list): The Open-Meteo variables (e.g. ['temperature_2m']).
+        start (str): The first date (YYYY-MM-DD).
+        end (str): The last date (YYYY-MM-DD).
+        frequency (str): 'hourly' or 'daily'.
+        models (str): The reanalysis of the archive.
+
+        Returns:
+        data (pd.DataFrame): The series, indexed by time, with one column per variable.
+        '''
+
+        data = self.fetch_many([latitude], [longitude], variables, start, end, frequency, models)[0]
+        data.columns.name = None
+
+        return data
+
+
+    def fetch_many(self, latitudes, longitudes, variables, start, end, frequency = 'hourly', models = 'era5'):
+
+        '''
+        Function that retrieves the series of several locations and variables, with a single request per calendar year for
+        all of them (comma-separated coordinates and variables), run concurrently.
+
+        Parameters:
+        latitudes (list): The latitudes of the locations.
+        longitudes (list): The longitudes of the locations.
+        variables (list): The Open-Meteo variables (e.g. ['temperature_2m', 'precipitation']).
+        start (str): The first date (YYYY-MM-DD).
+        end (str): The last date (YYYY-MM-DD).
+        frequency (str): 'hourly' or 'daily'.
+        models (str): The reanalysis of the archive.
+
+        Returns:
+        data (pd.DataFrame): The series, indexed by time, with the (location, variable) columns, where location is the
+                             position of the location in latitudes.
+        '''
+
+        variables = [variables] if isinstance(variables, str) else list(variables)
+        if len(latitudes) != len(longitudes):
+            raise ValueError('latitudes and longitudes must have the same length')
+
+        chunks = year_chunks(start, end)
+
+        def fetch_chunk(chunk):
+            params = {'latitude': ','.join(str(latitude) for latitude in latitudes), 'longitude': ','.join(str(longitude) for longitude in longitudes),
+                      'start_date': chunk[0], 'end_date': chunk[1], frequency: ','.join(variables), 'models': models}
+            data = self.get(params)
+            # A list with one element per location is returned for several locations, a single object for one
+            return [decode_block(location, frequency, variables) for location in (data if isinstance(data, list) else [data])]
+
+        if len(chunks) == 1 or self.max_workers <= 1:
+            blocks = [fetch_chunk(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as executor:
+                blocks = list(executor.map(fetch_chunk, chunks))
+
+        return pd.concat({i: assemble_blocks([chunk[i] for chunk in blocks], variables) for i in range(len(latitudes))},
+                         axis=1, names=['location', 'variable'])
+
+
+    def stats(self):
+
+        '''
+        Function that returns the counters of the client (requests, bytes received, seconds spent and errors).
+        '''
+
+        with self._lock:
+            return dict(self.counters)
+
+
+
+def year_chunks(start, end):
+
+    '''
+    Function that splits the period from start to end (included) at the calendar years.
+
+    Returns:
+    chunks (list): The (start, end) dates of each chunk, as YYYY-MM-DD strings.
+    '''
+
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    if end < start:
+        raise ValueError(f'The end date {end.date()} is before the start date {start.date()}')
+
+    chunks = []
+    for year in range(start.year, end.year + 1):
+        first = max(start, pd.Timestamp(year=year, month=1, day=1))
+        last = min(end, pd.Timestamp(year=year, month=12, day=31))
+        chunks.append((first.strftime('%Y-%m-%d'), last.strftime('%Y-%m-%d')))
+
+    return chunks
+
+
+def decode_block(data, frequency, variables):
+
+    '''
+    Function that converts the json of a response into NumPy columns (missing values as NaN), so the json can be discarded
+    before the other responses are decoded.
+
+    Returns:
+    block (dict): The times (np.datetime64) and the values of each variable.
+    '''
+
+    series = data[frequency]
+    block = {'time': np.array(series['time'], dtype='datetime64[m]')}
+    for variable in variables:
+        block[variable] = np.array([np.nan if v is None else v for v in series[variable]], dtype=float)
+
+    return block
+
+
+def assemble_blocks(blocks, variables):
+
+    '''
+    Function that concatenates the blocks of the chunks into a single DataFrame indexed by time.
+    '''
+
+    data = pd.DataFrame({variable: np.concatenate([block[variable] for block in blocks]) for variable in variables},
+                        index=pd.DatetimeIndex(np.concatenate([block['time'] for block in blocks]), name='time'))
+
+    return data[~data.index.duplicated()].sort_index()
+
+
+def aggregations(variable):
+
+    '''
+    Function that returns the aggregations of a variable over the resample periods: the sum for the precipitation,
+    the mean, the minimum and the maximum for the others.
+    '''
+
+    return ['sum'] if variable == 'precipitation' else ['mean', 'min', 'max']
+
+
+def plan_request(variables, resample):
+
+    '''
+    Function that chooses the data to request for a resample: the daily aggregates of Open-Meteo when all the aggregations
+    of the variables can be computed from them (24 times less data), the hourly values otherwise.
+
+    Parameters:
+    variables (list): The Open-Meteo hourly variables.
+    resample (str): The resample code ('Y', 'M', 'W', 'D' or 'H').
+
+    Returns:
+    frequency (str): 'daily' or 'hourly'.
+    parameters (list): The parameters to request.
+    '''
+
+    if resample != 'H':
+        parameters = [f'{variable}_{aggregation}' for variable in variables for aggregation in aggregations(variable)]
+        if all(parameter in DAILY_PARAMETERS for parameter in parameters):
+            return 'daily', parameters
+
+    return 'hourly', list(variables)
+
+
+def aggregate(data, variables, resample, frequency = 'hourly'):
+
+    '''
+    Function that aggregates the data over the resample periods and formats the index, as get_past_weather does.
+    The mean, the minimum and the maximum give the columns (variable, 'mean'), (variable, 'min') and (variable, 'max');
+    the precipitation gives the column of its sum. With daily data, the means of the days, the minimum of the daily
+    minima, the maximum of the daily maxima and the sum of the daily sums are the same aggregates of the hourly values.
+
+    Parameters:
+    data (pd.DataFrame): The hourly values, or the daily parameters of plan_request.
+    variables (list): The Open-Meteo hourly variables.
+    resample (str): The resample code ('Y', 'M', 'W', 'D' or 'H').
+    frequency (str): 'hourly' or 'daily', the frequency of data.
+
+    Returns:
+    data (pd.DataFrame): The aggregated data, indexed by the formatted periods.
+    '''
+
+    if resample != 'H':
+        resampled = data.resample(RESAMPLE_RULES[resample])
+        columns = {}
+
+        for variable in variables:
+            for aggregation in aggregations(variable):
+                source = f'{variable}_{aggregation}' if frequency == 'daily' else variable
+                name = variable if aggregation == 'sum' else (variable, aggregation)
+                columns[name] = getattr(resampled[source], aggregation)()
+
+        data = pd.DataFrame(columns)
+        if any(isinstance(name, tuple) for name in columns):
+            data.columns = pd.MultiIndex.from_tuples([name if isinstance(name, tuple) else (name, '') for name in columns])
+
+    data.index = data.index.strftime(INDEX_FORMATS[resample])
+
+    return data
+
+
+def past_weather(latitude, longitude, variable, start, end, resample = 'Y', client = None, cache = weather_cache):
+
+    '''
+    Function that retrieves the ERA5 weather of a location from the Open-Meteo archive, aggregated over the resample periods.
+    The daily aggregates are requested when they are enough (see plan_request), the hourly values otherwise, and only the
+    days missing from the cache are requested.
+
+    Parameters:
+    latitude (float): The latitude of the location.
+    longitude (float): The longitude of the location.
+    variable (str): The Open-Meteo hourly variable (e.g. 'temperature_2m').
+    start (str): The first date (YYYY-MM-DD).
+    end (str): The last date (YYYY-MM-DD).
+    resample (str): The resample code ('Y', 'M', 'W', 'D' or 'H').
+    client (OpenMeteoClient): The client. Default is the shared client.
+    cache (WeatherCache): The cache of the series. None disables it.
+
+    Returns:
+    data (pd.DataFrame): The aggregated data.
+    '''
+
+    client = client or open_meteo
+    frequency, parameters = plan_request([variable], resample)
+
+    if cache is None:
+        data = client.fetch(latitude, longitude, parameters, start, end, frequency)
+    else:
+        data = cache.fetch(client.fetch_many, latitude, longitude, parameters, start, end, frequency)
+
+    return aggregate(data, [variable], resample, frequency)
+
+
+def unique_names(names):
+
+    '''
+    Function that makes the names of the locations unique, appending the position (from 2) to the repeated ones
+    (e.g. ['Rome', 'Rome'] gives ['Rome', 'Rome (2)']), so no location is lost in the columns of past_weather_many.
+    '''
+
+    unique = []
+    for name in names:
+        candidate, n = name, 1
+        while candidate in unique:
+            n += 1
+            candidate = f'{name} ({n})'
+        unique.append(candidate)
+
+    return unique
+
+
+def past_weather_many(latitudes, longitudes, variables, start, end, resample = 'Y', names = None, client = None, cache = weather_cache):
+
+    '''
+    Function that retrieves several ERA5 variables of several locations at once, aggregated over the resample periods as
+    past_weather does. All the locations and variables share the same requests: one with the daily aggregates of the
+    variables that have them, one with the hourly values of the others (see plan_request).
+
+    Parameters:
+    latitudes (list): The latitudes of the locations.
+    longitudes (list): The longitudes of the locations.
+    variables (list): The Open-Meteo hourly variables.
+    start (str): The first date (YYYY-MM-DD).
+    end (str): The last date (YYYY-MM-DD).
+    resample (str): The resample code ('Y', 'M', 'W', 'D' or 'H').
+    names (list): The names of the locations. Default is 'latitude,longitude'. Repeated names are made unique (see unique_names).
+    client (OpenMeteoClient): The client. Default is the shared client.
+    cache (WeatherCache): The cache of the series. None disables it.
+
+    Returns:
+    data (pd.DataFrame): The aggregated data, with the (location, variable, aggregation) columns, or the (location, variable)
+                         columns for the hourly resample.
+    '''
+
+    client = client or open_meteo
+    variables = [variables] if isinstance(variables, str) else list(dict.fromkeys(variables))
+    names = unique_names(names if names else [f'{latitude},{longitude}' for latitude, longitude in zip(latitudes, longitudes)])
+
+    # The variables are grouped by the frequency of their request
+    groups = {}
+    for variable in variables:
+        groups.setdefault(plan_request([variable], resample)[0], []).append(variable)
+
+    frames = {i: [] for i in range(len(names))}
+    for group in groups.values():
+        frequency, parameters = plan_request(group, resample)
+
+        if cache is None:
+            data = client.fetch_many(latitudes, longitudes, parameters, start, end, frequency)
+        else:
+            data = cache.fetch_many(client.fetch_many, latitudes, longitudes, parameters, start, end, frequency)
+
+        for i in frames:
+            frame = aggregate(data[i], group, resample, frequency)
+            # The sums get an empty aggregation, so all the columns have the same levels
+            if resample != 'H' and not isinstance(frame.columns, pd.MultiIndex):
+                frame.columns = pd.MultiIndex.from_tuples([(column, '') for column in frame.columns])
+            frames[i].append(frame)
+
+    levels = ['location', 'variable'] if resample == 'H' else ['location', 'variable', 'aggregation']
+
+    return pd.concat({names[i]: pd.concat(frames[i], axis=1)[variables] for i in frames}, axis=1, names=levels)
+
+
+def weather_payload(data, precision = PRECISION):
+
+    '''
+    Function that encodes the data of past_weather_many for the LLM: the periods once, then the rounded values of each
+    column of each location ({'time': [...], 'values': {location: {'variable aggregation': [...]}}}).
+
+    Parameters:
+    data (pd.DataFrame): The data of past_weather_many.
+    precision (int): The number of decimals.
+
+    Returns:
+    payload (str): The json of the payload.
+    '''
+
+    values = {}
+    for location in data.columns.get_level_values(0).unique():
+        columns = {' '.join(str(level) for level in column[1:] if level): data[column].values for column in data.columns if column[0] == location}
+        values[location] = encode_columnar(data.index, columns, precision)['values']
+
+    return json.dumps({'time': list(data.index), 'values': values})
+
+
+# Shared client used by the pages
+open_meteo = OpenMeteoClient()
@@ -0,0 +1,318 @@
+# Open-Meteo cache importations
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+# -- PERSISTENT PARQUET CACHE OF THE OPEN-METEO ERA5 HISTORY
+# -- The reanalysis does not change once it is older than its publication lag, so the series of a location are stored
+# -- once, by day, and a new request only fetches the days that are not stored yet
+
+
+
+# Decimals of the coordinates in the keys of the cache (about 10 m). Open-Meteo adjusts the series to the elevation of
+# the requested location, so the locations of the same grid cell do not share a series
+COORDINATE_DECIMALS = 4
+
+# Days before today that may still change (ERA5 is published with a delay of about 5 days), never stored
+LAG_DAYS = int(os.environ.get('OPEN_METEO_LAG_DAYS', 7))
+
+
+def location_key(latitude, longitude):
+
+    '''
+    Function that returns the coordinates of a location in the keys of the cache, rounded to COORDINATE_DECIMALS.
+    '''
+
+    return round(float(latitude), COORDINATE_DECIMALS) + 0.0, round(float(longitude), COORDINATE_DECIMALS) + 0.0
+
+
+def day_ranges(days):
+
+    '''
+    Function that groups sorted days into ranges of consecutive days.
+
+    Parameters:
+    days (pd.DatetimeIndex): The sorted days.
+
+    Returns:
+    ranges (list): The (first, last) days of each range, as YYYY-MM-DD strings.
+    '''
+
+    if not len(days):
+        return []
+
+    breaks = np.flatnonzero(np.diff(days.values).astype('timedelta64[D]').astype(int) > 1)
+    firsts = np.concatenate([[0], breaks + 1])
+    lasts = np.concatenate([breaks, [len(days) - 1]])
+
+    return [(days[f].strftime('%Y-%m-%d'), days[l].strftime('%Y-%m-%d')) for f, l in zip(firsts, lasts)]
+
+
+
+class WeatherCache():
+
+    '''
+    Parquet cache of the Open-Meteo series, with one file per (location, variable, model, frequency).
+
+    A file holds the days already retrieved (the days with at least one row), so the days of a request that are missing
+    are fetched as a few ranges and merged into the file. The days after today - lag_days are returned but never stored.
+    The least recently used files are removed when the size of the cache exceeds max_bytes, after each write.
+
+    Parameters:
+    directory (str): Directory of the cache. Default is the CCKP_CACHE_DIR environment variable, or ~/.cache/climalm.
+    max_bytes (int): Maximum size of the stored series, in bytes.
+    lag_days (int): Days before today that are never stored.
+    enabled (bool): If False, the cache is never read nor written. Default is False when OPEN_METEO_CACHE is set to 0.
+    '''
+
+    def __init__(self, directory = None, max_bytes = 256 * 2 ** 20, lag_days = LAG_DAYS, enabled = None):
+
+        self.directory = os.path.join(directory or os.environ.get('CCKP_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'climalm')),
+                                      'open_meteo')
+        self.max_bytes = max_bytes
+        self.lag_days = lag_days
+        self.enabled = enabled if enabled is not None else os.environ.get('OPEN_METEO_CACHE', '1') != '0'
+
+        self._lock = threading.Lock()
+        self._path_locks = {}
+        self.counters = {'hits': 0, 'partial': 0, 'misses': 0, 'fetched_ranges': 0, 'puts': 0, 'evictions': 0}
+
+
+    def _count(self, counter, n = 1):
+
+        with self._lock:
+            self.counters[counter] += n
+
+
+    def path(self, latitude, longitude, variable, models, frequency):
+
+        '''
+        Function that returns the path of the Parquet file of a series, in the model=/frequency=/variable= partitions.
+        '''
+
+        return os.path.join(self.directory, f'model={models}', f'frequency={frequency}', f'variable={variable}',
+                            f'{latitude:+.{COORDINATE_DECIMALS}f}_{longitude:+.{COORDINATE_DECIMALS}f}.parquet')
+
+
+    def read(self, path):
+
+        '''
+        Function that returns the stored series of a file (indexed by time), or None if it is not stored.
+        '''
+
+        if not os.path.exists(path):
+            return None
+
+        try:
+            series = pd.read_parquet(path)['value']
+        except Exception:
+            # A corrupted file is ignored, and replaced at the next write
+            return None
+
+        # The access time is kept in the modification time, for the eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Removed by a concurrent eviction after the read: a miss, the file is written again by the fetch
+            return None
+
+        return series
+
+
+    def write(self, path, series):
+
+        '''
+        Function that merges a series into its file. The new values replace the stored ones of the same times.
+        The merges of a file are serialized, so concurrent requests (e.g. parallel tool calls) do not drop each other's days.
+        '''
+
+        with self._lock:
+            lock = self._path_locks.setdefault(path, threading.Lock())
+
+        with lock:
+            stored = self.read(path)
+            if stored is not None:
+                series = pd.concat([stored[~stored.index.isin(series.index)], series]).sort_index()
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Writing to a temporary file first, so a reader never sees a partial Parquet file
+            temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            series.rename('value').to_frame().to_parquet(temporary)
+            os.replace(temporary, path)
+
+        self._count('puts')
+
+
+    def missing_ranges(self, series, start, end):
+
+        '''
+        Function that returns the ranges of days from start to end (included) that are not in a stored series.
+        '''
+
+        days = pd.date_range(start, end, freq='D')
+        if series is not None and len(series):
+            days = days[~days.isin(series.index.normalize().unique())]
+
+        return day_ranges(days)
+
+
+    def fetch(self, fetch_many, latitude, longitude, variables, start, end, frequency = 'hourly', models = 'era5'):
+
+        '''
+        Function that returns the series of a location, reading the stored days and fetching only the missing ones
+        (see fetch_many).
+
+        Returns:
+        data (pd.DataFrame): The series, indexed by time, with one column per variable.
+        '''
+
+        data = self.fetch_many(fetch_many, [latitude], [longitude], variables, start, end, frequency, models)[0]
+        data.columns.name = None
+
+        return data
+
+
+    def fetch_many(self, fetch_many, latitudes, longitudes, variables, start, end, frequency = 'hourly', models = 'era5'):
+
+        '''
+        Function that returns the series of several locations, reading the stored days and fetching only the missing ones.
+        The locations are requested with their own coordinates and stored under their rounded coordinates (see
+        location_key), and the series missing the same days are fetched together, in the same requests.
+
+        Parameters:
+        fetch_many (callable): Function that retrieves the series, with the arguments of OpenMeteoClient.fetch_many.
+        latitudes (list): The latitudes of the locations.
+        longitudes (list): The longitudes of the locations.
+        variables (list): The Open-Meteo parameters.
+        start (str): The first date (YYYY-MM-DD).
+        end (str): The last date (YYYY-MM-DD).
+        frequency (str): 'hourly' or 'daily'.
+        models (str): The reanalysis of the archive.
+
+        Returns:
+        data (pd.DataFrame): The series, indexed by time, with the (location, variable) columns, where location is the
+                             position of the location in latitudes.
+        '''
+
+        variables = [variables] if isinstance(variables, str) else list(variables)
+
+        if not self.enabled:
+            return fetch_many(latitudes, longitudes, variables, start, end, frequency, models)
+
+        points = [location_key(latitude, longitude) for latitude, longitude in zip(latitudes, longitudes)]
+        coordinates = {}
+        for point, latitude, longitude in zip(points, latitudes, longitudes):
+            coordinates.setdefault(point, (latitude, longitude))
+
+        paths = {(point, variable): self.path(*point, variable, models, frequency) for point in dict.fromkeys(points) for variable in variables}
+        stored = {key: self.read(path) for key, path in paths.items()}
+
+        # The series missing the same days are fetched together
+        groups = {}
+        for key, series in stored.items():
+            groups.setdefault(tuple(self.missing_ranges(series, start, end)), []).append(key)
+
+        stored_any = any(series is not None and len(series) for series in stored.values())
+        self._count('hits' if not any(groups) else 'partial' if stored_any else 'misses')
+
+        fetched = {key: [] for key in stored}
+        for ranges, keys in groups.items():
+            group_points = list(dict.fromkeys(point for point, _ in keys))
+            group_variables = list(dict.fromkeys(variable for _, variable in keys))
+
+            for first, last in ranges:
+                data = fetch_many([coordinates[point][0] for point in group_points], [coordinates[point][1] for point in group_points],
+                                  group_variables, first, last, frequency, models)
+                self._count('fetched_ranges')
+                for point, variable in keys:
+                    fetched[(point, variable)].append(data[(group_points.index(point), variable)])
+
+        # Only the days older than the lag are stored
+        last_final = pd.Timestamp.now().normalize() - pd.Timedelta(days=self.lag_days)
+        written = False
+        for key, series in fetched.items():
+            if series:
+                new = pd.concat(series)
+                if (new.index < last_final).any():
+                    self.write(paths[key], new[new.index < last_final])
+                    written = True
+
+        if written:
+            self._evict()
+
+        frames = {}
+        for i, point in enumerate(points):
+            frame = pd.DataFrame({variable: pd.concat(([stored[(point, variable)]] if stored[(point, variable)] is not None else [])
+                                                      + fetched[(point, variable)]) for variable in variables})
+            frame = frame[~frame.index.duplicated(keep='last')].sort_index()
+            frame.index.name = 'time'
+            frames[i] = frame.loc[pd.Timestamp(start):pd.Timestamp(end) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)]
+
+        return pd.concat(frames, axis=1, names=['location', 'variable'])
+
+
+    def _files(self):
+
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.parquet'):
+                    path = os.path.join(root, name)
+                    try:
+                        files.append((os.path.getmtime(path), os.path.getsize(path), path))
+                    except OSError:
+                        pass
+
+        return files
+
+
+    def _evict(self):
+
+        # Removing the least recently used files until the cache fits in max_bytes
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self._count('evictions')
+
+
+    def clear(self):
+
+        '''
+        Function that removes all the files of the cache.
+        '''
+
+        for _, _, path in self._files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+    def stats(self):
+
+        '''
+        Function that returns the hit/miss counters of the process, together with the number of files and the size of the cache.
+        A request is a hit when all its days are stored, partial when only some of them are.
+        '''
+
+        files = self._files()
+
+        with self._lock:
+            requests = self.counters['hits'] + self.counters['partial'] + self.counters['misses']
+            return {**self.counters, 'hit_rate': self.counters['hits'] / requests if requests else 0.0,
+                    'files': len(files), 'bytes': sum(size for _, size, _ in files), 'max_bytes': self.max_bytes,
+                    'lag_days': self.lag_days, 'path': self.directory}
+
+
+# Shared cache used by the Open-Meteo requests of the process
+weather_cache = WeatherCache()
@@ -0,0 +1,117 @@
+# Payload encoder importations
+import numpy as np
+
+# -- ENCODER OF THE POINT ARRAYS INTO THE JSON SENT TO THE LLM
+# -- The arrays are rounded and formatted directly, without building DataFrames and without the str -> json -> dict round-trip
+
+
+
+# Decimals of the values sent to the LLM
+PRECISION = 2
+
+
+def format_values(values, precision = PRECISION):
+
+    '''
+    Function that rounds the values and formats them as strings, as DataFrame.round(precision).astype(str) does:
+    the shortest representation of the rounded value in its own dtype (e.g. 17.02 for both float32 and float64),
+    and None for the missing values.
+
+    Parameters:
+    values (np.ndarray): The values.
+    precision (int): The number of decimals.
+
+    Returns:
+    formatted (list): The formatted values.
+    '''
+
+    values = np.asarray(values).ravel()
+
+    if values.dtype.kind not in 'fc':
+        return [str(v) for v in values.tolist()]
+
+    rounded = np.round(values, precision)
+    missing = np.isnan(rounded)
+
+    return [None if m else str(v) for v, m in zip(rounded, missing)]
+
+
+def encode_columns(index, columns, precision = PRECISION):
+
+    '''
+    Function that encodes point arrays in the layout of the point jsons: {column: {index: value}}, with the index as string.
+    It gives the same result of json.loads(DataFrame(columns, index=index).round(precision).astype(str).to_json()).
+
+    Parameters:
+    index (np.ndarray): The index of the values (e.g. the years).
+    columns (dict): The values of each column, aligned with the index.
+    precision (int): The number of decimals.
+
+    Returns:
+    payload (dict): The encoded columns.
+    '''
+
+    keys = [str(i) for i in np.asarray(index).tolist()]
+
+    return {name: dict(zip(keys, format_values(values, precision))) for name, values in columns.items()}
+
+
+def encode_columnar(index, columns, precision = PRECISION, index_name = 'time'):
+
+    '''
+    Function that encodes point arrays in the compact columnar layout: the index once, then one list of numbers for each column.
+    The values are rounded numbers instead of strings and the missing values are None, so the payload is much smaller.
+
+    Parameters:
+    index (np.ndarray): The index of the values (e.g. the years).
+    columns (dict): The values of each column, aligned with the index.
+    precision (int): The number of decimals.
+    index_name (str): The name of the index in the payload.
+
+    Returns:
+    payload (dict): {index_name: [...], 'values': {column: [...]}}.
+    '''
+
+    encoded = {}
+    for name, values in columns.items():
+        # Rounding in float64, so float32 values do not carry their representation error (17.020000457 for 17.02)
+        rounded = np.round(np.asarray(values, dtype='float64').ravel(), precision)
+        encoded[name] = [None if np.isnan(v) else float(v) for v in rounded.tolist()]
+
+    return {index_name: np.asarray(index).tolist(), 'values': encoded}
+
+
+def encode_dataframe(dataframe, precision = PRECISION, columnar = False):
+
+    '''
+    Function that encodes a point dataframe (e.g. the timeseries of a CCKP object) with encode_columns, or with
+    encode_columnar when columnar is True.
+    '''
+
+    columns = {name: dataframe[name].values for name in dataframe.columns}
+
+    if columnar:
+        return encode_columnar(dataframe.index.values, columns, precision, dataframe.index.name or 'index')
+
+    return encode_columns(dataframe.index.values, columns, precision)
+
+
+def encode_scalars(columns, precision = PRECISION):
+
+    '''
+    Function that encodes single-valued columns (e.g. the trends of a point) as {column: number}, for the columnar layout.
+
+    Parameters:
+    columns (dict or pd.DataFrame): The values of each column (one value each).
+    precision (int): The number of decimals.
+
+    Returns:
+    payload (dict): The rounded values, None for the missing ones.
+    '''
+
+    encoded = {}
+    for name in columns:
+        value = float(np.asarray(columns[name], dtype=float).ravel()[0])
+        encoded[name] = None if np.isnan(value) else round(value, precision)
+
+    return encoded
@@ -0,0 +1,117 @@
+# Point result importations
+import numpy as np
+import pandas as pd
+
+# -- COMPACT RESULT OF A POINT RETRIEVAL
+# -- Only the NumPy arrays of the location are kept (no xarray datasets, no file handles), so the objects stored in the
+# -- session state scale with the number of points instead of the size of the global grids
+
+
+
+class PointResult():
+
+    '''
+    Point data of a CCKP object at one location, with the attributes used by the pages (variables_dict, status_dict,
+    json_to_llm and the point dataframes, rebuilt on access).
+
+    Parameters:
+    source (str): 'ERA5' or 'CMIP6'.
+    variable (str): The code of the variable.
+    scenario (str): The scenario ('historical' for ERA5).
+    variables_dict (dict): The catalog entry of the variable.
+    status_dict (dict): The status of the products.
+    groups (dict): The selected windows of each group of the status_dict (see CCKP_api_ERA5.selected_groups).
+    years (np.ndarray): The years of the timeseries.
+    columns (list): The names of the timeseries columns (one for each CMIP6 band).
+    values (np.ndarray): The timeseries, as a years x columns array.
+    trend_names (list): The names of the trends.
+    trends (np.ndarray): The trends.
+    confidence_names (list): The names of the trend confidences.
+    confidences (np.ndarray): The trend confidences.
+    json_to_llm (dict): The json sent to the LLM.
+    '''
+
+    __slots__ = ['source', 'variable', 'scenario', 'variables_dict', 'status_dict', 'groups', 'years', 'columns', 'values',
+                 'trend_names', 'trends', 'confidence_names', 'confidences', 'json_to_llm']
+
+    def __init__(self, source, variable, scenario, variables_dict, status_dict, groups, years, columns, values,
+                 trend_names, trends, confidence_names, confidences, json_to_llm):
+
+        self.source = source
+        self.variable = variable
+        self.scenario = scenario
+        self.variables_dict = variables_dict
+        self.status_dict = status_dict
+        self.groups = groups
+        self.years = years
+        self.columns = columns
+        self.values = values
+        self.trend_names = trend_names
+        self.trends = trends
+        self.confidence_names = confidence_names
+        self.confidences = confidences
+        self.json_to_llm = json_to_llm
+
+
+    @classmethod
+    def from_dataframes(cls, source, variable, scenario, variables_dict, status_dict, groups, timeseries, trends, confidences, json_to_llm):
+
+        '''
+        Function that builds the result from the point dataframes of a CCKP object (timeseries indexed by year, trends and
+        confidences with a single row). Empty or missing dataframes give empty arrays.
+        '''
+
+        timeseries = timeseries if timeseries is not None else pd.DataFrame()
+        trends = trends if trends is not None else pd.DataFrame()
+        confidences = confidences if confidences is not None else pd.DataFrame()
+
+        return cls(source, variable, scenario, variables_dict, dict(status_dict), groups,
+                   timeseries.index.values, list(timeseries.columns), timeseries.values,
+                   list(trends.columns), trends.values[0] if len(trends) else np.empty(0),
+                   list(confidences.columns), confidences.values[0] if len(confidences) else np.empty(0),
+                   json_to_llm)
+
+
+    def selected_groups(self):
+        return self.groups
+
+
+    @property
+    def timeseries_point_dataframe(self):
+
+        if not self.columns:
+            return pd.DataFrame()
+
+        return pd.DataFrame(self.values, index=pd.Index(self.years, name='time'), columns=self.columns)
+
+
+    @property
+    def trends_point_dataframe(self):
+
+        if not self.trend_names:
+            return pd.DataFrame()
+
+        return pd.DataFrame({name: self.trends[i:i + 1] for i, name in enumerate(self.trend_names)})
+
+
+    @property
+    def confidence_point_dataframe(self):
+
+        if not self.confidence_names:
+            return pd.DataFrame()
+
+        return pd.DataFrame({name: self.confidences[i:i + 1] for i, name in enumerate(self.confidence_names)})
+
+
+    @property
+    def nbytes(self):
+
+        '''
+        The bytes of the arrays of the result.
+        '''
+
+        return self.years.nbytes + self.values.nbytes + self.trends.nbytes + self.confidences.nbytes
+
+
+    def __repr__(self):
+        return f'PointResult({self.source} {self.variable} {self.scenario}, {len(self.years)} years x {len(self.columns)} columns)'
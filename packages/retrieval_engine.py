@@ -0,0 +1,296 @@
+# Retrieval engine importations
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from packages.CCKP_new_api import CCKP_api_ERA5, CCKP_api_CMIP6
+from packages.variable_catalog import variable_catalog
+
+# -- HEADLESS RETRIEVAL ENGINE FOR THE CLIMATE DATA
+# -- Plain Python, without Streamlit: it can be used by the pages (through interaction_funcs.retrieve_climate_data),
+# -- by batch jobs and by worker processes. Each (variable, source, scenario) is a job, and the jobs run in parallel
+
+
+
+def variable_codes(variables):
+
+    '''
+    Function that returns the codes of the selected variables, in the order of the catalog.
+
+    Parameters:
+    variables (dict or list): The display names of the variables by category (the variables of the form), or a list of codes.
+
+    Returns:
+    codes (list): The codes of the variables.
+    '''
+
+    if isinstance(variables, dict):
+        return variable_catalog().codes_from_names({name for names in variables.values() for name in names})
+
+    return list(dict.fromkeys(variables))
+
+
+def covers(obj, products = None, windows = None):
+
+    '''
+    Function that returns True if a loaded ERA5 object already has the requested products and windows.
+    '''
+
+    requested = CCKP_api_ERA5(obj.variable, products=products, windows=windows)
+    loaded_groups = obj.selected_groups()
+
+    return all(set(group_windows) <= set(loaded_groups[group]) for group, group_windows in requested.selected_groups().items())
+
+
+def plan_jobs(codes, sources, scenarios, loaded = None, products = None, windows = None):
+
+    '''
+    Function that returns the jobs needed for the selection, skipping the ones already loaded.
+    A loaded result with a failed product is planned again.
+
+    Parameters:
+    codes (list): The codes of the variables.
+    sources (list): Two booleans, for ERA5 and CMIP6.
+    scenarios (list): The CMIP6 scenarios.
+    loaded (dict): The data already loaded, with the structure of RetrievalResult.data.
+    products (list): The ERA5 products (see CCKP_api_ERA5). Loaded ERA5 objects without them are retrieved again.
+    windows (list): The ERA5 trend windows.
+
+    Returns:
+    jobs (list): The jobs to run, as tuples (code, source, scenario). ERA5 jobs have the 'historical' scenario.
+    skipped (list): The jobs already loaded.
+    '''
+
+    loaded = loaded or {}
+
+    planned = []
+    if sources[0]:
+        planned += [(code, 'ERA5', 'historical') for code in codes]
+    if sources[1]:
+        planned += [(code, 'CMIP6', scenario) for code in codes for scenario in scenarios]
+
+    jobs, skipped = [], []
+    for job in planned:
+        code, source, scenario = job
+        obj = (loaded.get(code) or {}).get(source, {}).get(scenario)
+        if obj and 'Error' not in obj.status_dict.values() and (source != 'ERA5' or covers(obj, products, windows)):
+            skipped.append(job)
+        else:
+            jobs.append(job)
+
+    return jobs, skipped
+
+
+def run_job(job, latitude, longitude, bands, climatology = False, products = None, windows = None):
+
+    '''
+    Function that retrieves the data of a single job at a location.
+
+    Parameters:
+    job (tuple): The job, as (code, source, scenario).
+    latitude (float): The latitude of the location.
+    longitude (float): The longitude of the location.
+    bands (list): The CMIP6 ensemble bands.
+    climatology (bool): If True, the CMIP6 climatologies are used instead of the timeseries.
+    products (list): The ERA5 products (see CCKP_api_ERA5). Default is the timeseries, the trends and the trend confidences.
+    windows (list): The ERA5 trend windows. Default is all.
+
+    Returns:
+    job_result (dict): The job, its status ('Retrieved', 'Partial' or 'Error'), the seconds spent, the error (if any)
+                       and the PointResult with the point data and the json for the LLM (None if any product failed,
+                       so the job is not stored as loaded and it is retried at the next retrieval).
+    '''
+
+    code, source, scenario = job
+    start = time.perf_counter()
+
+    try:
+        if source == 'ERA5':
+            obj = CCKP_api_ERA5(code, products=products, windows=windows)
+        else:
+            obj = CCKP_api_CMIP6(code, scenario, bands, climatology)
+
+        obj.retrieve_point(latitude, longitude)
+        obj.make_json_to_llm()
+
+        # Products not requested, or not retrieved for a single point, are not considered
+        retrieved = [status == 'Retrieved' for status in obj.status_dict.values() if status not in ['Not Retrieved', 'Not Requested']]
+        status = 'Retrieved' if retrieved and all(retrieved) else 'Partial' if any(retrieved) else 'Error'
+
+        # The errors of the products (or bands) that failed, so a partial or failed job explains itself
+        error = '; '.join(f'{key}: {e}' for key, e in obj.errors_dict.items()) or None
+
+        # Only the compact point data is kept, and only if no product failed
+        obj = obj.point_result() if 'Error' not in obj.status_dict.values() else None
+
+    except Exception as e:
+        obj, status, error = None, 'Error', repr(e)
+
+    return {'variable': code, 'source': source, 'scenario': scenario, 'status': status,
+            'seconds': time.perf_counter() - start, 'error': error, 'data': obj}
+
+
+
+class RetrievalResult():
+
+    '''
+    Result of a retrieval: the point results of the jobs, with their status and timings.
+
+    Parameters:
+    latitude (float): The latitude of the location.
+    longitude (float): The longitude of the location.
+    codes (list): The codes of the selected variables.
+    skipped (list): The jobs not run because already loaded.
+    '''
+
+    def __init__(self, latitude, longitude, codes, skipped = None):
+
+        self.latitude = latitude
+        self.longitude = longitude
+        self.codes = codes
+        self.skipped = skipped or []
+
+        # Results of the jobs, in the order of the plan
+        self.jobs = []
+
+        # PointResult objects, as {code: {'ERA5': {'historical': result}, 'CMIP6': {scenario: result}}}
+        self.data = {}
+
+        self.elapsed = 0.0
+
+
+    def add(self, job_result):
+
+        self.jobs.append(job_result)
+
+        if job_result['data'] is not None:
+            self.data.setdefault(job_result['variable'], {}).setdefault(job_result['source'], {})[job_result['scenario']] = job_result['data']
+
+
+    @property
+    def status(self):
+
+        '''
+        The status of the whole retrieval: 'Retrieved' if every job was retrieved, 'Error' if every job failed, 'Partial' otherwise.
+        '''
+
+        statuses = {job_result['status'] for job_result in self.jobs}
+
+        if statuses <= {'Retrieved'}:
+            return 'Retrieved'
+        if statuses == {'Error'}:
+            return 'Error'
+        return 'Partial'
+
+
+    def timings(self):
+
+        '''
+        Function that returns the seconds spent by each job, as {(code, source, scenario): seconds}.
+        '''
+
+        return {(r['variable'], r['source'], r['scenario']): r['seconds'] for r in self.jobs}
+
+
+    def errors(self):
+
+        '''
+        Function that returns the errors of the failed jobs, as {(code, source, scenario): error}.
+        '''
+
+        return {(r['variable'], r['source'], r['scenario']): r['error'] for r in self.jobs if r['error'] is not None}
+
+
+    def summary(self):
+
+        '''
+        Function that returns a json-serializable summary of the retrieval (without the data).
+        '''
+
+        return {'latitude': self.latitude, 'longitude': self.longitude, 'status': self.status, 'elapsed': self.elapsed,
+                'jobs': [{k: v for k, v in r.items() if k != 'data'} for r in self.jobs],
+                'skipped': [list(job) for job in self.skipped]}
+
+
+
+def retrieve(variables, sources, scenarios, bands, latitude, longitude, climatology = False, loaded = None, max_workers = 4, progress = None,
+             products = None, windows = None):
+
+    '''
+    Function that retrieves the climate data of a location.
+
+    Parameters:
+    variables (dict or list): The display names of the variables by category, or a list of codes.
+    sources (list): Two booleans, for ERA5 and CMIP6.
+    scenarios (list): The CMIP6 scenarios.
+    bands (list): The CMIP6 ensemble bands.
+    latitude (float): The latitude of the location.
+    longitude (float): The longitude of the location.
+    climatology (bool): If True, the CMIP6 climatologies are used instead of the timeseries.
+    loaded (dict): The data already loaded, with the structure of RetrievalResult.data. These jobs are skipped.
+    max_workers (int): Maximum number of jobs running at the same time. With 1 the jobs run one after the other.
+    progress (callable): Function called with each job result as soon as the job ends, in the calling thread.
+    products (list): The ERA5 products, among timeseries, climatology, trend and trendconfidence. Default is timeseries, trend and trendconfidence.
+    windows (list): The ERA5 trend windows, among 1951-2020, 1971-2020 and 1991-2020. Default is all.
+
+    Returns:
+    result (RetrievalResult): The result of the retrieval.
+    '''
+
+    start = time.perf_counter()
+
+    codes = variable_codes(variables)
+    jobs, skipped = plan_jobs(codes, sources, scenarios, loaded, products, windows)
+    result = RetrievalResult(latitude, longitude, codes, skipped)
+
+    if max_workers > 1 and len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(run_job, job, latitude, longitude, bands, climatology, products, windows) for job in jobs]
+            for future in as_completed(futures):
+                if progress:
+                    progress(future.result())
+            job_results = [future.result() for future in futures]
+
+    else:
+        job_results = []
+        for job in jobs:
+            job_results.append(run_job(job, latitude, longitude, bands, climatology, products, windows))
+            if progress:
+                progress(job_results[-1])
+
+    for job_result in job_results:
+        result.add(job_result)
+
+    result.elapsed = time.perf_counter() - start
+
+    return result
+
+
+async def retrieve_async(variables, sources, scenarios, bands, latitude, longitude, climatology = False, loaded = None, max_workers = 4, progress = None,
+                         products = None, windows = None):
+
+    '''
+    Asyncio version of retrieve: the jobs run in worker threads, so the event loop is never blocked.
+    The parameters and the result are the same of retrieve.
+    '''
+
+    start = time.perf_counter()
+
+    codes = variable_codes(variables)
+    jobs, skipped = plan_jobs(codes, sources, scenarios, loaded, products, windows)
+    result = RetrievalResult(latitude, longitude, codes, skipped)
+
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def run(job):
+        async with semaphore:
+            job_result = await asyncio.to_thread(run_job, job, latitude, longitude, bands, climatology, products, windows)
+        if progress:
+            progress(job_result)
+        return job_result
+
+    for job_result in await asyncio.gather(*[run(job) for job in jobs]):
+        result.add(job_result)
+
+    result.elapsed = time.perf_counter() - start
+
+    return result
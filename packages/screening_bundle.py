@@ -0,0 +1,248 @@
+# Screening bundle importations
+import os
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from packages.CCKP_new_api import CCKP_api_ERA5, open_dataset
+from packages.CCKP_point_extract import nearest_index
+
+# -- PRECOMPUTED SCREENING BUNDLE
+# -- The ERA5 1991-2020 climatologies, trends and trend confidences of the screening indices are packed into one local
+# -- lat x lon x layer array, memory-mapped, so the screening of a location is a single lookup of a contiguous row
+#
+# -- python -m packages.screening_bundle ~/.cache/climalm/screening
+
+
+
+# Indices used by the screening of the ALM-APP page
+SCREENING_CODES = ['tas', 'pr', 'tasmin', 'tasmax', 'sd', 'wsdi', 'hd30', 'hd35', 'hd40', 'hd42', 'tr23', 'tr26', 'tr29',
+                   'rx1day', 'rx5day', 'r20mm', 'r50mm']
+
+# Products of the screening payloads: the screening only uses the 1991-2020 climatology
+SCREENING_PRODUCTS = ['climatology']
+
+CUBE_FILE = 'screening.npy'
+META_FILE = 'screening.json'
+
+
+def build_bundle(directory, codes = SCREENING_CODES, dtype = 'float32', progress = print):
+
+    '''
+    Function that builds the screening bundle from the CCKP files of CCKP_api_ERA5(code, climatology=True).
+
+    Each index has 7 layers: the 1991-2020 climatology, the three trends and the three trend confidences. The raw values of the
+    files are stored (the normalization factor is applied at lookup time, as retrieve_point does). Products that cannot be read
+    are stored as NaN with an 'Error' status.
+
+    Parameters:
+    directory (str): The directory of the bundle.
+    codes (list): The codes of the indices.
+    dtype (str): 'float32' keeps the values of the files; 'float16' halves the size, but the rounded values sent to the LLM can differ.
+    progress (callable): Function called with a message after each file.
+
+    Returns:
+    meta (dict): The metadata of the bundle.
+    '''
+
+    os.makedirs(directory, exist_ok=True)
+
+    objects = [CCKP_api_ERA5(code, True) for code in codes]
+    jobs = [(obj, key, url, product, name) for obj in objects for key, group in obj.product_jobs().items() for url, product, name in group]
+
+    cube = None
+    meta = {'version': 1, 'dtype': dtype, 'built': time.time(), 'codes': {}}
+
+    for layer, (obj, key, url, product, name) in enumerate(jobs):
+
+        code_meta = meta['codes'].setdefault(obj.variable, {'status': {'timeseries': 'Retrieved', 'trend': 'Retrieved', 'confidence': 'Retrieved'},
+                                                            'timeseries': None, 'trend': [], 'confidence': []})
+        variable_name = f'{product}-{obj.variable}-{obj.aggregation_period}-{obj.statistic}'
+
+        try:
+            data = open_dataset(url)[variable_name].isel(time=0).transpose('lat', 'lon')
+
+            if cube is None:
+                meta['lat'] = data['lat'].values.tolist()
+                meta['lon'] = data['lon'].values.tolist()
+                cube = np.lib.format.open_memmap(os.path.join(directory, CUBE_FILE + '.tmp'), mode='w+', dtype=dtype,
+                                                 shape=(len(meta['lat']), len(meta['lon']), len(jobs)))
+                cube[:] = np.nan
+
+            elif data['lat'].values.tolist() != meta['lat'] or data['lon'].values.tolist() != meta['lon']:
+                raise ValueError(f'{url} is not on the grid of the bundle')
+
+            cube[:, :, layer] = data.values.astype(dtype)
+            year = int(pd.DatetimeIndex([data['time'].values]).year[0])
+
+        except Exception as e:
+            code_meta['status'][key] = 'Error'
+            year = None
+            progress(f'Error reading {url}: {e!r}')
+
+        if key == 'timeseries':
+            code_meta['timeseries'] = {'layer': layer, 'column': variable_name, 'year': year}
+        else:
+            code_meta[key].append({'layer': layer, 'column': name})
+
+        progress(f'[{layer + 1}/{len(jobs)}] {url}')
+
+    if cube is None:
+        raise ValueError('No file of the screening indices could be read')
+
+    cube.flush()
+    del cube
+    os.replace(os.path.join(directory, CUBE_FILE + '.tmp'), os.path.join(directory, CUBE_FILE))
+
+    with open(os.path.join(directory, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+    return meta
+
+
+
+class ScreeningBundle():
+
+    '''
+    Memory-mapped screening bundle, opened on first use.
+
+    Parameters:
+    directory (str): The directory of the bundle. Default is the CCKP_SCREENING_BUNDLE environment variable,
+                     or ~/.cache/climalm/screening.
+    '''
+
+    def __init__(self, directory = None):
+
+        self.directory = directory or os.environ.get('CCKP_SCREENING_BUNDLE', os.path.join(os.path.expanduser('~'), '.cache', 'climalm', 'screening'))
+
+        self._lock = threading.Lock()
+        self._cube = None
+        self._meta = None
+
+
+    def _load(self):
+
+        with self._lock:
+            if self._cube is None:
+                with open(os.path.join(self.directory, META_FILE)) as f:
+                    meta = json.load(f)
+
+                meta['lat'] = np.asarray(meta['lat'])
+                meta['lon'] = np.asarray(meta['lon'])
+                self._cube = np.load(os.path.join(self.directory, CUBE_FILE), mmap_mode='r')
+                self._meta = meta
+
+        return self._cube, self._meta
+
+
+    def available(self, codes = SCREENING_CODES):
+
+        '''
+        Function that returns True if the bundle exists and contains all the codes.
+        '''
+
+        if not os.path.exists(os.path.join(self.directory, META_FILE)) or not os.path.exists(os.path.join(self.directory, CUBE_FILE)):
+            return False
+
+        _, meta = self._load()
+
+        return all(code in meta['codes'] for code in codes)
+
+
+    def lookup(self, lat, lon):
+
+        '''
+        Function that returns the row of all the layers in the grid cell nearest to (lat, lon).
+
+        Returns:
+        row (np.ndarray): The values of the layers, as float32.
+        '''
+
+        cube, meta = self._load()
+
+        return np.asarray(cube[nearest_index(meta['lat'], lat), nearest_index(meta['lon'], lon)], dtype='float32')
+
+
+    def screening_objects(self, lat, lon, codes = SCREENING_CODES, products = None, windows = None):
+
+        '''
+        Function that returns the CCKP_api_ERA5(code, True) objects of the codes at a location, with the point dataframes and
+        json_to_llm filled as retrieve_point + make_json_to_llm would, without reading any CCKP file.
+
+        Parameters:
+        lat (float): The latitude of the location.
+        lon (float): The longitude of the location.
+        codes (list): The codes of the indices.
+        products (list): The products of the objects (climatology, trend, trendconfidence). Default is all.
+        windows (list): The trend windows of the objects. Default is all.
+
+        Returns:
+        objects (list): The CCKP_api_ERA5 objects, in the order of the codes.
+        '''
+
+        row = self.lookup(lat, lon)
+        _, meta = self._load()
+
+        objects = []
+        for code in codes:
+            code_meta = meta['codes'][code]
+            timeseries = code_meta['timeseries']
+
+            obj = CCKP_api_ERA5(code, True, products, windows)
+            jobs = obj.product_jobs()
+            obj.status_dict = {key: code_meta['status'][key] if key in jobs else status for key, status in obj.status_dict.items()}
+
+            if obj.status_dict['timeseries'] == 'Retrieved':
+                values = row[timeseries['layer']:timeseries['layer'] + 1].astype(float) / obj.variables_dict['Normalization factor']
+                obj.timeseries_point_dataframe = pd.DataFrame({timeseries['column']: values}, index=pd.Index([timeseries['year']], name='time'))
+            else:
+                obj.timeseries_point_dataframe = pd.DataFrame()
+
+            if obj.status_dict['trend'] == 'Retrieved':
+                names = [name for _, _, name in jobs['trend']]
+                obj.trends_point_dataframe = pd.DataFrame({layer['column']: row[layer['layer']:layer['layer'] + 1] for layer in code_meta['trend'] if layer['column'] in names})
+            else:
+                obj.trends_point_dataframe = pd.DataFrame()
+
+            if obj.status_dict['confidence'] == 'Retrieved':
+                names = [name for _, _, name in jobs['confidence']]
+                obj.confidence_point_dataframe = pd.DataFrame({layer['column']: row[layer['layer']:layer['layer'] + 1] for layer in code_meta['confidence'] if layer['column'] in names})
+            else:
+                obj.confidence_point_dataframe = pd.DataFrame()
+
+            obj.point_to_json()
+            obj.make_json_to_llm()
+            objects.append(obj)
+
+        return objects
+
+
+    def screening_payloads(self, lat, lon, codes = SCREENING_CODES, products = None, windows = None):
+
+        '''
+        Function that returns the json_to_llm payloads of the codes at a location.
+        '''
+
+        return [obj.json_to_llm for obj in self.screening_objects(lat, lon, codes, products, windows)]
+
+
+# Shared bundle used by the pages
+screening_bundle = ScreeningBundle()
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build the memory-mapped screening bundle of the ERA5 1991-2020 climatologies.')
+    parser.add_argument('directory', nargs='?', default=screening_bundle.directory, help='Directory of the bundle')
+    parser.add_argument('--codes', nargs='+', default=SCREENING_CODES, help='Codes of the indices')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'],
+                        help='float32 gives the payloads of the live retrieval; float16 halves the size, but the rounded numbers can differ')
+    args = parser.parse_args()
+
+    meta = build_bundle(args.directory, args.codes, args.dtype)
+    size = os.path.getsize(os.path.join(args.directory, CUBE_FILE))
+
+    print(f'Bundle of {len(meta["codes"])} indices written to {args.directory} ({size / 2 ** 20:.0f} MiB)')
@@ -0,0 +1,138 @@
+# Tool executor importations
+import os
+import json
+import time
+import threading
+from concurrent.futures import Future, TimeoutError
+
+# -- CONCURRENT EXECUTION OF THE TOOL CALLS OF A TURN
+# -- The tool calls requested by the model in one turn are independent, so they run at the same time in worker threads:
+# -- a turn takes about as long as its slowest call. The results keep the order of the calls, and a call that fails or
+# -- exceeds its timeout (counted from its own start) gives an error for the model instead of stopping the turn
+
+
+
+# Maximum number of tool calls running at the same time
+MAX_WORKERS = int(os.environ.get('TOOL_MAX_WORKERS', 4))
+
+# Seconds after which a tool call is abandoned, unless a timeout is given for the tool
+TOOL_TIMEOUT = float(os.environ.get('TOOL_TIMEOUT', 180))
+
+
+def _timed_call(function, arguments):
+
+    # Runs in a worker thread: the time is measured there, so the waiting for a free worker is not counted, and the errors
+    # are returned with their time instead of being raised
+    start = time.perf_counter()
+    try:
+        value, error = function(**arguments), None
+    except Exception as e:
+        value, error = None, e
+
+    return value, error, time.perf_counter() - start
+
+
+
+class _Call():
+
+    # A tool call running in its own thread. The slot of the call is released when it ends or when it is abandoned,
+    # whichever comes first, so a call that never answers does not hold back the calls waiting for a slot
+    def __init__(self, function, arguments, slots):
+
+        self.function = function
+        self.arguments = arguments
+        self.slots = slots
+        self.future = Future()
+        self.started = threading.Event()
+        self.start = None
+        self._released = False
+        self._lock = threading.Lock()
+
+    def run(self):
+
+        self.start = time.perf_counter()
+        self.started.set()
+        try:
+            self.future.set_result(_timed_call(self.function, self.arguments))
+        finally:
+            self.release()
+
+    def release(self):
+
+        with self._lock:
+            if not self._released:
+                self._released = True
+                self.slots.release()
+
+
+def _launch(calls, slots):
+
+    # Starting the calls in order, each one as soon as a slot is free
+    for call in calls:
+        slots.acquire()
+        threading.Thread(target=call.run, daemon=True).start()
+
+
+def run_tool_calls(tool_calls, functions, timeouts = None, default_timeout = TOOL_TIMEOUT, max_workers = MAX_WORKERS):
+
+    '''
+    Function that runs the tool calls of a turn concurrently and returns their results in the order of the calls.
+    The tools must not write to the Streamlit page or session: their return values are handled by the caller, in its thread.
+
+    Parameters:
+    tool_calls (list): The tool calls of the model message (openai objects with id, function.name and function.arguments).
+    functions (dict): The functions of the tools, by name.
+    timeouts (dict): The timeouts of the tools, in seconds, by name.
+    default_timeout (float): The timeout of the tools without one. The timeout of a call counts from its start, so the
+                             calls waiting for a free worker are not penalized.
+    max_workers (int): Maximum number of calls running at the same time. With 1 the calls run one after the other
+                       (still with their timeouts). An abandoned call frees its worker for the next calls.
+
+    Returns:
+    results (list): For each call, a dictionary with id, name, arguments, value (the return value, None on error),
+                    error (the error message, None on success), timed_out, seconds (duration of the call, or the time
+                    waited before abandoning it) and elapsed (seconds between the submission of the calls and the result).
+    '''
+
+    timeouts = timeouts or {}
+    results = [{'id': tool_call.id, 'name': tool_call.function.name, 'arguments': None, 'value': None, 'error': None,
+                'timed_out': False, 'seconds': 0.0, 'elapsed': 0.0} for tool_call in tool_calls]
+
+    if not results:
+        return results
+
+    # The calls with unknown functions or invalid arguments are answered without running
+    pending = []
+    for result, tool_call in zip(results, tool_calls):
+        try:
+            result['arguments'] = json.loads(tool_call.function.arguments or '{}')
+            if result['name'] not in functions:
+                raise KeyError(f'unknown tool {result["name"]}')
+            pending.append(result)
+        except (ValueError, KeyError) as e:
+            result['error'] = f'Invalid tool call: {e}'
+
+    slots = threading.Semaphore(max(1, max_workers))
+    calls = [_Call(functions[result['name']], result['arguments'], slots) for result in pending]
+    start = time.perf_counter()
+
+    threading.Thread(target=_launch, args=(calls, slots), daemon=True).start()
+
+    for result, call in zip(pending, calls):
+        # The calls start in order, and the previous ones have ended or have been abandoned: this one gets a slot
+        call.started.wait()
+
+        # The timeout of a call counts from its own start
+        timeout = timeouts.get(result['name'], default_timeout)
+        try:
+            result['value'], error, result['seconds'] = call.future.result(timeout=max(0.0, call.start + timeout - time.perf_counter()))
+            if error is not None:
+                result['error'] = f'The tool {result["name"]} failed: {error!r}'
+        except TimeoutError:
+            # A timed out call cannot be interrupted: its thread is left to end in the background, without its slot
+            call.release()
+            result['timed_out'], result['seconds'] = True, time.perf_counter() - call.start
+            result['error'] = f'The tool {result["name"]} did not answer within {timeout:g} seconds'
+        result['elapsed'] = time.perf_counter() - start
+
+    return results
@@ -0,0 +1,149 @@
+# Variable catalog importations
+import os
+import json
+import threading
+
+# -- CATALOG OF THE CCKP VARIABLES (names, units, descriptions, normalization factors and categories)
+# -- The 'Variables' sheet of geonames.xlsx is parsed once per process. It can also be compiled to JSON, which is
+# -- much faster to load than the workbook:  python -m packages.variable_catalog
+
+
+
+CATALOG_XLSX = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geonames.xlsx')
+CATALOG_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geonames_variables.json')
+
+
+class VariableCatalog():
+
+    '''
+    Catalog of the variables, indexed by code, by display name and by category.
+
+    Parameters:
+    records (list): One dictionary for each variable, with the columns of the 'Variables' sheet (Code, Variable, Unit,
+                    Description, Normalization factor, Category). The order of the records is kept.
+    '''
+
+    def __init__(self, records):
+
+        self.records = records
+
+        self.by_code = {record['Code']: record for record in records}
+        self.by_name = {record['Variable']: record['Code'] for record in records}
+        self.position = {record['Code']: i for i, record in enumerate(records)}
+
+        self.by_category = {}
+        for record in records:
+            self.by_category.setdefault(record['Category'], []).append(record['Code'])
+
+
+    def __contains__(self, code):
+        return code in self.by_code
+
+
+    def get(self, code):
+
+        '''
+        Function that returns the dictionary of a variable (the variables_dict of the CCKP objects).
+        Raises KeyError if the code is not in the catalog.
+        '''
+
+        return dict(self.by_code[code])
+
+
+    def code(self, name):
+
+        '''
+        Function that returns the code of a variable from its display name.
+        '''
+
+        return self.by_name[name]
+
+
+    def codes_from_names(self, names):
+
+        '''
+        Function that returns the codes of the variables with the given display names, in the order of the catalog.
+        '''
+
+        return sorted({self.by_name[name] for name in names if name in self.by_name}, key=self.position.get)
+
+
+    def codes(self, category):
+
+        '''
+        Function that returns the codes of the variables of a category, in the order of the catalog.
+        '''
+
+        return list(self.by_category.get(category, []))
+
+
+    def columns(self):
+
+        '''
+        Function that returns the catalog as {column: {code: value}}, the layout of names_table.set_index('Code').to_dict().
+        '''
+
+        return {column: {record['Code']: record[column] for record in self.records} for column in self.records[0] if column != 'Code'}
+
+
+
+def read_workbook(path = CATALOG_XLSX):
+
+    '''
+    Function that reads the records of the catalog from the 'Variables' sheet of the workbook.
+    '''
+
+    import pandas as pd
+
+    names_table = pd.read_excel(path, sheet_name='Variables')
+
+    return json.loads(names_table.to_json(orient='records'))
+
+
+def compile_catalog(path = CATALOG_JSON, workbook = CATALOG_XLSX):
+
+    '''
+    Function that compiles the 'Variables' sheet of the workbook to a JSON file, loaded by variable_catalog() instead of the workbook.
+    '''
+
+    records = read_workbook(workbook)
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False, indent=1)
+
+    return path
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def variable_catalog():
+
+    '''
+    Function that returns the catalog of the process, loading it on first use.
+    The compiled JSON is used when it is not older than the workbook, otherwise the workbook is parsed.
+
+    Returns:
+    catalog (VariableCatalog): The catalog of the variables.
+    '''
+
+    global _catalog
+
+    with _catalog_lock:
+        if _catalog is None:
+            if os.path.exists(CATALOG_JSON) and os.path.getmtime(CATALOG_JSON) >= os.path.getmtime(CATALOG_XLSX):
+                with open(CATALOG_JSON, encoding='utf-8') as f:
+                    records = json.load(f)
+            else:
+                records = read_workbook()
+
+            _catalog = VariableCatalog(records)
+
+        return _catalog
+
+
+
+if __name__ == '__main__':
+
+    print(f'Catalog compiled to {compile_catalog()}')
@@ -1,20 +1,25 @@
 import streamlit as st
 
-from langchain_openai import AzureChatOpenAI
 from langchain_core.messages import HumanMessage, ToolMessage, SystemMessage
-from langchain_core.tools import tool
 
 from packages.CCKP_new_api import CCKP_api_ERA5, CCKP_api_CMIP6
 from packages.interaction_funcs import *
 from packages.LLM_agents import main_agent, fill_form
-from openai import AzureOpenAI
+from packages.llm_clients import azure_chat_llm
+from packages.llm_descriptions import describe_all
+from packages.llm_streaming import CURSOR
+from packages.screening_bundle import screening_bundle, SCREENING_CODES, SCREENING_PRODUCTS
+from packages.lazy_imports import lazy_import
+from packages.llm_context import build_context, climate_data_context
+from packages.horizon_stats import horizon_stats, stats_text
 
 import pandas as pd
 from stqdm import stqdm
 from dotenv import load_dotenv
-from openai import AzureOpenAI
 import json, os
-import plotly.express as px
+
+# Plotly is only imported when the first plot is drawn
+px = lazy_import('plotly.express')
 
 # Insert here the path for the credentials.env file
 load_dotenv("../credentials.env")
@@ -56,21 +61,8 @@ with st.container(border=True):
 st.divider()
 st.subheader('Select the variables')
 
-azure_endpoint = st.secrets['AZURE_ENDPOINT']
-openai_api_key = st.secrets['OPENAI_API_KEY']
-
-
-llm = AzureChatOpenAI(deployment_name="llm-gpt35", openai_api_version="2024-02-01",
-                            openai_api_key=openai_api_key, azure_endpoint=azure_endpoint, temperature=0)
-
-
-
-# Initialize the AzureOpenAI client
-client = AzureOpenAI(
-  azure_endpoint = st.secrets['AZURE_ENDPOINT'], 
-  api_key = st.secrets['OPENAI_API_KEY'],  
-  api_version="2024-02-01"
-)
+# The clients are built once per process and reused by every rerun
+llm = azure_chat_llm("llm-gpt35", temperature=0)
 
 
 categories = ['Average temperatures', 'Average precipitation', 'Heat', 'Cold', 'Drought', 'Extreme precipitation']
@@ -137,28 +129,9 @@ if 'screening' not in st.session_state:
 if 'screening_data' not in st.session_state:
     st.session_state.screening_data = None
 
-def describe_graphs(json, request):
-
-    messages = [
-        {
-            "role": "system",
-            "content": request
-        }
-    ]
-
-
-    messages.append(
-        {
-            "role": "system",
-            "content": str(json)
-        }
-    )
-    response = client.chat.completions.create(
-        model = "llm-gpt35",
-        messages=messages,
-    )
-
-    return response.choices[0].message.content
+# Latency of the description calls, by variable
+if 'description_timings' not in st.session_state:
+    st.session_state.description_timings = {}
 
 
 with col1:
@@ -177,33 +150,41 @@ with col1:
 
     if prompt:
 
+        # The proposal is streamed here while it is written, then shown in the proposed analysis box
+        proposal_stream = st.empty()
+
         st.session_state.main_agent.conversation.append(HumanMessage(prompt))
         st.session_state.main_agent.conversation_step(True)
-        st.session_state.main_agent.check_tool()
+        st.session_state.main_agent.check_tool(proposal_stream)
 
         if st.session_state.screening and st.session_state.screening_data is None and st.session_state.proposed_analysis is not None:
 
-            st.session_state.screening_data = [CCKP_api_ERA5('tas', True), CCKP_api_ERA5('pr', True),
-                                                CCKP_api_ERA5('tasmin', True), CCKP_api_ERA5('tasmax', True), CCKP_api_ERA5('sd', True),
-                                                CCKP_api_ERA5('wsdi', True), CCKP_api_ERA5('hd30', True), CCKP_api_ERA5('hd35', True),
-                                                CCKP_api_ERA5('hd40', True), CCKP_api_ERA5('hd42', True), CCKP_api_ERA5('tr23', True),
-                                                CCKP_api_ERA5('tr26', True), CCKP_api_ERA5('tr29', True), CCKP_api_ERA5('rx1day', True),
-                                                CCKP_api_ERA5('rx5day', True), CCKP_api_ERA5('r20mm', True), CCKP_api_ERA5('r50mm', True)]
-
-            st.write('Importing data for the screening...')
-            for obj in stqdm(st.session_state.screening_data):
-                obj.retrieve_request()
-                obj.load_point(st.session_state.latitude, st.session_state.latitude)
-                obj.make_json_to_llm()
+            # With the precomputed bundle the screening is a single local lookup, otherwise the files are read from the bucket
+            if screening_bundle.available():
+                screening_objects = screening_bundle.screening_objects(st.session_state.latitude, st.session_state.longitude, products=SCREENING_PRODUCTS)
+
+            else:
+                screening_objects = [CCKP_api_ERA5(code, True, SCREENING_PRODUCTS) for code in SCREENING_CODES]
+
+                st.write('Importing data for the screening...')
+                for obj in stqdm(screening_objects):
+                    obj.retrieve_point(st.session_state.latitude, st.session_state.longitude)
+                    obj.make_json_to_llm()
+
+            # Only the compact point results are kept in the session
+            st.session_state.screening_data = [obj.point_result() for obj in screening_objects]
         
         if st.session_state.screening and st.session_state.screening_data is not None:
 
-            st.session_state.main_agent.conversation.append(SystemMessage(f'Here some local data for a pre screening. Remember that the timelines of these data are climatological, that is to say they are average for the period 1991-2020.The data are: {[x.json_to_llm for x in st.session_state.screening_data]}. \
+            screening_context = build_context([('ERA5 1991-2020', x.json_to_llm) for x in st.session_state.screening_data])
+            st.session_state.main_agent.conversation.append(SystemMessage(f'Here some local data for a pre screening. Remember that the timelines of these data are climatological, that is to say they are average for the period 1991-2020.The data are: {screening_context["text"]}. \
                                                                         Empty the form and rewrite the proposal for the analysis basing on the parameters that i provided you. \
                                                                         Use them to make a more consistent proposal. In the new proposal, you do not have to include all these variables. Just use them to choose the most appropriate variables and to justify the choices.\
                                                                         In the new proposal, specify how you used the screening data in the choiches. Make specific references to the numerical values you have found in the screening data.'))
             st.session_state.main_agent.conversation_step(True)
-            st.session_state.main_agent.check_tool()
+            st.session_state.main_agent.check_tool(proposal_stream)
+
+        proposal_stream.empty()
 
 
 
@@ -226,8 +207,10 @@ with col2:
                                                                             Latitude: {st.session_state.latitude} \
                                                                             Longitude: {st.session_state.longitude} \
                                                                             Please, rewrite the proposal for the analysis basing on the parameters that i provided you.'))
-            st.session_state.main_agent.conversation_step(False)
+            proposal_stream = st.empty()
+            st.session_state.main_agent.conversation_step(False, proposal_stream)
             st.session_state.proposed_analysis = st.session_state.main_agent.conversation[-1].content
+            proposal_stream.empty()
 
             #st.write(st.session_state.main_agent.conversation)
 
@@ -249,6 +232,11 @@ st.divider()
 st.show_data = st.checkbox('Show data', st.session_state.show_data)
 
 if st.show_data:
+
+    # Descriptions to write, requested all together after the loop
+    pending = {}
+    placeholders = {}
+
     for var in st.session_state.climate_data:
 
         if var != 'attrs':
@@ -286,34 +274,54 @@ if st.show_data:
                     # check if the description is already present IN st.session_state.climate_data[var]
                     if not 'Description' in st.session_state.climate_data[var]:
 
-                        tot_json = {}
+                        # Compact tables of the variable (horizon means and decimated series) within the token budget
+                        sections = []
                         if st.session_state.sources[0] and st.session_state.climate_data[var]['ERA5']:
-                            era_json = st.session_state.climate_data[var]['ERA5']['historical'].json_to_llm
-                            tot_json = {**tot_json, **era_json}
+                            sections.append(('ERA5 historical', st.session_state.climate_data[var]['ERA5']['historical'].json_to_llm))
 
                         if st.session_state.sources[1] and st.session_state.climate_data[var]['CMIP6']:
-                            cmip_json = {scenario: st.session_state.climate_data[var]['CMIP6'][scenario].json_to_llm for scenario in st.session_state.scenarios}
-                            tot_json = {**tot_json, **cmip_json}
+                            sections += [(f'CMIP6 {scenario}', st.session_state.climate_data[var]['CMIP6'][scenario].json_to_llm) for scenario in st.session_state.scenarios]
                         
-                        answ = describe_graphs(tot_json, f'{st.session_state.proposed_analysis} \n Based on that request, analyze only the variable you are provided with data. Please, be exauhstive in your analysis and make a long output. Follow the proposal you made at the beginning of the conversation. Consider explicity the time horizons that you wrote in the proposal.')
-                        st.session_state.climate_data[var]['Description'] = answ
+                        # The statistics of the time horizons are computed locally, the model only has to cite them
+                        notes = [stats_text(horizon_stats({var: st.session_state.climate_data[var]}))]
+                        pending[var] = (build_context(sections, notes=notes)['text'], f'{st.session_state.proposed_analysis} \n Based on that request, analyze only the variable you are provided with data. Please, be exauhstive in your analysis and make a long output. Follow the proposal you made at the beginning of the conversation. Consider explicity the time horizons that you wrote in the proposal.')
+                        placeholders[var] = st.empty()
+                        placeholders[var].info('Writing the description...')
+
+                    else:
+                        st.write(st.session_state.climate_data[var]['Description'])
+                        
+    # All the missing descriptions are requested concurrently, and each one is shown as soon as it arrives
+    if pending:
 
+        def show_description(result):
+            st.session_state.description_timings[result['key']] = {'ttft': result['ttft'], 'total': result['seconds'], 'cached': result['cached']}
+            if result['error']:
+                placeholders[result['key']].error(f'The description could not be written: {result["error"]}')
+            else:
+                st.session_state.climate_data[result['key']]['Description'] = result['description']
+                placeholders[result['key']].write(result['description'])
+
+        describe_all(pending, on_result=show_description, on_text=lambda var, text: placeholders[var].markdown(text + CURSOR))
 
-                    st.write(st.session_state.climate_data[var]['Description'])
-                        
 
 
     with st.expander('Summary'):
 
-        if st.button('Reset summary'):
+        reset_summary = st.button('Reset summary')
+
+        # The summary is streamed into this placeholder while it is written
+        summary = st.empty()
+
+        if reset_summary:
             del st.session_state.summarizer
             st.session_state.summarizer = main_agent(llm)
             st.session_state.summarizer.conversation.append(HumanMessage('Summarize the analysis of the data that you have just done.'))
             if st.session_state.climatology:
                 st.session_state.summarizer.conversation.append(SystemMessage('I have used the climatology for the CMIP6 data. This means that the data are representative for the 20 years after the date. E.g 2020 means 2020-2040.'))
             st.session_state.summarizer.conversation.append(SystemMessage(st.session_state.proposed_analysis))
-            st.session_state.summarizer.conversation.append(SystemMessage(str(st.session_state.climate_data)))
-            st.session_state.summarizer.conversation_step(False)
+            st.session_state.summarizer.conversation.append(SystemMessage(climate_data_context(st.session_state.climate_data)['text']))
+            st.session_state.summarizer.conversation_step(False, summary)
 
 
         if 'summarizer' not in st.session_state:
@@ -322,16 +330,16 @@ if st.show_data:
             if st.session_state.climatology:
                 st.session_state.summarizer.conversation.append(SystemMessage('I have used the climatology for the CMIP6 data. This means that the data are representative for the 20 years after the date. E.g 2020 means 2020-2040.'))
             st.session_state.summarizer.conversation.append(SystemMessage(st.session_state.proposed_analysis))
-            st.session_state.summarizer.conversation.append(SystemMessage(str(st.session_state.climate_data)))
-            st.session_state.summarizer.conversation_step(False)
+            st.session_state.summarizer.conversation.append(SystemMessage(climate_data_context(st.session_state.climate_data)['text']))
+            st.session_state.summarizer.conversation_step(False, summary)
         
 
         inpt = st.text_input('Addition request')
         if inpt:
             st.session_state.summarizer.conversation.append(HumanMessage(inpt))
-            st.session_state.summarizer.conversation_step(False)
+            st.session_state.summarizer.conversation_step(False, summary)
 
-        st.write(st.session_state.summarizer.conversation[-1].content)
+        summary.write(st.session_state.summarizer.conversation[-1].content)
 
 
 
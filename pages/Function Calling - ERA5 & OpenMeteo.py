@@ -2,29 +2,27 @@ import streamlit as st
 import os
 
 import json
-import numpy as np
 import pandas as pd
-import requests
-from streamlit_folium import folium_static
-import folium
+from packages.lazy_imports import lazy_import
+from packages.open_meteo import past_weather, past_weather_many, weather_payload, unique_names
+from packages.llm_clients import azure_openai_client
+from packages.tool_executor import run_tool_calls
 import warnings
 warnings.filterwarnings("ignore")
 
+# The map modules are only imported when the first map is drawn
+folium = lazy_import('folium')
+streamlit_folium = lazy_import('streamlit_folium')
 
-# -- GENERAL SETTINGS
-
-# Initialize the AzureOpenAI capabilities
-from openai import AzureOpenAI
-client = AzureOpenAI(
-  azure_endpoint = st.secrets['AZURE_ENDPOINT'], 
-  api_key = st.secrets['OPENAI_API_KEY'],  
-  api_version="2024-02-01"
-)
 
+# -- GENERAL SETTINGS
 
 # Set the page configuration
 st.set_page_config(page_title='Function Calling ERA5', page_icon='🌍', layout='wide')
 
+# Initialize the AzureOpenAI capabilities (built once per process and reused by every rerun)
+client = azure_openai_client()
+
 st.title('Function Calling - ERA5')
 # Initialize chat history as streamlit session states
 if "messages" not in st.session_state:
@@ -34,46 +32,39 @@ if "messages" not in st.session_state:
 if "data" not in st.session_state:
     st.session_state.data = []
 
+if "tool_timings" not in st.session_state:
+    st.session_state.tool_timings = []
+
 
 # -- FUNCTIONS
 
-# Defining the function that can be called by GPT
+# Defining the function that can be called by GPT. The functions run in worker threads (see generate_response), so they
+# return the json for the model and the data to show, and the session is updated by generate_response
 def get_past_weather(latitude, longitude, variable, start, end, resample='Y'):
 
-    # Create the link to the API 
-    link = f'https://archive-api.open-meteo.com/v1/archive?latitude={latitude}&longitude={longitude}&start_date={start}&end_date={end}&hourly={variable}&models=era5'
+    # Get the data aggregated over the resample periods (from the daily aggregates of Open-Meteo when they are enough)
+    dat = past_weather(latitude, longitude, variable, start, end, resample)
 
-    # Get the data
-    f = requests.get(link, verify=False)
-    data = f.json()
+    entries = [{'latitude': latitude, 'longitude': longitude, 'variable': variable, 'start': start, 'end': end, 'resample': resample, 'data': dat}]
 
-    # Convert the data in a pandas dataframe
-    dat = pd.DataFrame(data['hourly'])
+    return dat.to_json(), entries
 
-    # convert dat.time in datetime
-    dat['time'] = pd.to_datetime(dat['time'])
-    dat = dat.set_index('time')
+# Defining the batched function: several variables of several locations retrieved with the same requests
+def get_past_weather_batch(locations, variables, start, end, resample='Y'):
 
-    if resample != 'H' and variable != 'precipitation':
-        dat = dat.resample(resample).agg({variable: [np.mean, np.min, np.max]})
-    
-    if resample != 'H' and variable == 'precipitation':
-        dat = dat.resample(resample).agg({variable: np.sum})
+    # Repeated names get a suffix, so each location keeps its own columns
+    names = unique_names([location.get('name') or f"{location['latitude']},{location['longitude']}" for location in locations])
+    latitudes = [float(location['latitude']) for location in locations]
+    longitudes = [float(location['longitude']) for location in locations]
 
-    if resample == 'Y':
-        dat.index = dat.index.strftime('%Y')
-    if resample == 'M':
-        dat.index = dat.index.strftime('%Y-%m')
-    if resample == 'W':
-        dat.index = dat.index.strftime('%Y-%W')
-    if resample == 'D':
-        dat.index = dat.index.strftime('%Y-%m-%d')
-    if resample == 'H':
-        dat.index = dat.index.strftime('%Y-%m-%d %H')
+    # Get the data of all the locations and variables, with the (location, variable, aggregation) columns
+    dat = past_weather_many(latitudes, longitudes, variables, start, end, resample, names)
 
-    st.session_state.data.append({'latitude': latitude, 'longitude': longitude, 'variable': variable, 'start': start, 'end': end, 'resample': resample, 'data': dat})
+    # One entry per location and variable, as the single function does, so the data is shown in the same way
+    entries = [{'latitude': latitude, 'longitude': longitude, 'variable': variable, 'start': start, 'end': end, 'resample': resample, 'data': dat[name]}
+               for name, latitude, longitude in zip(names, latitudes, longitudes) for variable in variables]
 
-    return dat.to_json()
+    return weather_payload(dat), entries
 
 # Define the dictionary with the structure of the function
 get_past_weather_dict ={
@@ -116,15 +107,72 @@ get_past_weather_dict ={
         
     }
 
+# Define the dictionary with the structure of the batched function
+get_past_weather_batch_dict ={
+
+        "type": "function",
+        "function": {
+            "name": "get_past_weather_batch",
+            "description": "Get the past weather data of several variables and/or several locations at once from ERA5 dataset. Prefer it to several calls of get_past_weather when comparing variables or locations over the same period.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "locations": {
+                        "type": "array",
+                        "description": "The locations to retrieve",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "name": {"type": "string", "description": "A short name of the location (e.g. the city or the airport)"},
+                                "latitude": {"type": "number", "description": "The latitude of the location"},
+                                "longitude": {"type": "number", "description": "The longitude of the location"},
+                            },
+                            "required": ["name", "latitude", "longitude"],
+                        },
+                    },
+                    "variables": {
+                        "type": "array",
+                        "description": "The weather variables to retrieve",
+                        "items": {
+                            "type": "string",
+                            "enum": ["temperature_2m", "precipitation", "wind_speed_10m", "relative_humidity_2m", "wind_gusts_10m"],
+                        },
+                    },
+                    "start": {
+                        "type": "string",
+                        "description": "The start date of the period",
+                    },
+                    "end": {
+                        "type": "string",
+                        "description": "The end date of the period",
+                    },
+                    "resample": {
+                        "type": "string",
+                        "description": "The resampling frequency. Use 'Y' for yearly data, 'M' for monthly data, 'W' for weekly data, 'D' for daily data, 'H' for hourly data. Use preferaily YEARLY data.",}
+                },
+                "required": ["locations", "variables", "start", "end", "resample"],
+            },
+        }
+
+    }
+
 # Register the functions
 tools = [
-    get_past_weather_dict
+    get_past_weather_dict,
+    get_past_weather_batch_dict
     ]
 
 available_functions = {
-    "get_past_weather": get_past_weather
+    "get_past_weather": get_past_weather,
+    "get_past_weather_batch": get_past_weather_batch
     } 
 
+# Seconds after which a tool call is abandoned and the model is told so
+tool_timeouts = {
+    "get_past_weather": 120,
+    "get_past_weather_batch": 300
+    }
+
 
 # A function for making a step in the conversation
 def conversation_step(messages, tools=None, tool_choice=None):
@@ -152,24 +200,31 @@ def generate_response(tools=None, tool_choice=None):
                 st.session_state.messages.append(choice.message)
                 
                 if choice.message.tool_calls:
-                    for tool_call in choice.message.tool_calls:
-                        
-                        # Get the data from the tool call
-                        function_name = tool_call.function.name
-                        function_to_call = available_functions[function_name]
-                        function_args = json.loads(tool_call.function.arguments)
-                        
-                        # Call the function
-                        data = function_to_call(**function_args)
-                        
+
+                    # Call the functions of the turn concurrently, the results keep the order of the tool calls
+                    results = run_tool_calls(choice.message.tool_calls, available_functions, tool_timeouts)
+
+                    for result in results:
+
+                        # Get the data from the tool call, or the error for the model
+                        if result['error'] is None:
+                            data, entries = result['value']
+                            st.session_state.data.extend(entries)
+                        else:
+                            data = result['error']
+
                         st.session_state.messages.append(
                             {
-                                "tool_call_id": tool_call.id,
+                                "tool_call_id": result['id'],
                                 "role": "tool",
-                                "name": function_name,
+                                "name": result['name'],
                                 "content": data,
                             }
                         )
+
+                        st.session_state.tool_timings.append({'tool': result['name'], 'arguments': json.dumps(result['arguments']), 'seconds': result['seconds'],
+                                                              'elapsed': result['elapsed'], 'timed_out': result['timed_out'], 'error': result['error'],
+                                                              'calls in turn': len(results)})
                 
                 else:
                     generating = False
@@ -184,6 +239,7 @@ if __name__ == "__main__":
         st.session_state.messages = [{"role": "system", "content": "Retrieve the past weather data for the given location from the ERA5 dataset, and comment."},
                                     {"role": "system", "content": "Don't make assumptions about what values to use with functions. Ask for clarification if a user request is ambiguous."}]
         st.session_state.data = []
+        st.session_state.tool_timings = []
         st.rerun()
 
     col1, col2 = st.columns([1, 1])
@@ -241,10 +297,14 @@ if __name__ == "__main__":
                         fill_color='k',
                         fill_opacity=0.7
                     ).add_to(m)
-                    folium_static(m)
+                    streamlit_folium.folium_static(m)
 
     st.divider()
 
     # Look at messages and put all dictionary in a dataframe. Some items in messages are not dictionaries, so we need to filter them out
     df = pd.DataFrame([i for i in st.session_state.messages if isinstance(i, dict)])
     st.write(df)
+
+    # Timings of the tool calls (seconds of each call, elapsed seconds of its turn when its result was collected)
+    if len(st.session_state.tool_timings) != 0:
+        st.write(pd.DataFrame(st.session_state.tool_timings))
@@ -0,0 +1,94 @@
+# Test fixtures importations
+import os
+import re
+import zlib
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+import packages.CCKP_new_api as api
+from packages.CCKP_new_api import S3FilePool
+from packages.CCKP_dataset_cache import DatasetCache
+from packages.CCKP_point_cache import PointCache
+from packages.CCKP_reference_index import ReferenceIndex
+
+# -- LOCAL CCKP ARCHIVE FOR THE TESTS
+# -- The urls of the CCKP objects are served from NetCDF files written in a temporary directory, with the layout and the
+# -- variable names of the bucket, so the retrievals run end to end without network
+
+
+
+# Grid of the files (a coarse global grid)
+LATS = np.array([-67.5, -22.5, 22.5, 67.5])
+LONS = np.arange(-157.5, 180, 45.0)
+
+
+class LocalBucket():
+
+    # Filesystem of the pool for the s3 urls: s3://bucket/key is read from root/bucket/key
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, url):
+        return os.path.join(self.root, url.split('://', 1)[-1])
+
+    def open(self, url, mode = 'rb', block_size = None):
+        return open(self.path(url), mode)
+
+
+class LocalPool(S3FilePool):
+
+    def __init__(self, root, **kwargs):
+        super().__init__(**kwargs)
+        self.bucket = LocalBucket(root)
+
+    def filesystem(self, url):
+        return self.bucket if url.startswith('s3://') else super().filesystem(url)
+
+
+def file_dataset(url):
+
+    '''
+    Function that returns the dataset of a CCKP url: the variable is the first part of the file name, the timeseries have
+    one value per year of the period at the end of the name, the other products a single time.
+    '''
+
+    name = os.path.basename(url)
+    variable_name = name.split('_')[0]
+    first, last = map(int, re.search(r'_(\d{4})-(\d{4})\.nc$', name).groups())
+    years = range(first, last + 1) if variable_name.startswith('timeseries') else [first]
+
+    # Values with 3 decimals, different for every file, year and cell (the rounding of the payloads is exercised),
+    # stored as float32 like the CCKP files
+    rng = np.random.default_rng(zlib.crc32(url.encode()))
+    values = np.round(rng.uniform(-50, 50, (len(years), len(LATS), len(LONS))), 3).astype('float32')
+
+    return xr.Dataset({variable_name: (('time', 'lat', 'lon'), values)},
+                      coords={'time': pd.to_datetime([f'{year}-01-01' for year in years]), 'lat': LATS, 'lon': LONS})
+
+
+@pytest.fixture
+def archive(monkeypatch, tmp_path):
+
+    '''
+    Fixture that serves the s3 urls from tmp_path/bucket, with fresh caches. It returns a function that writes the files
+    of a list of urls.
+    '''
+
+    root = tmp_path / 'bucket'
+    pool = LocalPool(str(root), max_handles=8)
+    monkeypatch.setattr(api, 's3_pool', pool)
+    monkeypatch.setattr(api, 'dataset_cache', DatasetCache(max_bytes=64 * 2 ** 20))
+    monkeypatch.setattr(api, 'point_cache', PointCache(str(tmp_path / 'cache')))
+    monkeypatch.setattr(api, 'reference_index', ReferenceIndex(str(tmp_path / 'missing_index.json')))
+
+    def write(urls):
+        for url in urls:
+            path = pool.bucket.path(url)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file_dataset(url).to_netcdf(path, engine='h5netcdf')
+
+    write.pool = pool
+    write.path = pool.bucket.path
+
+    return write
@@ -0,0 +1,56 @@
+# Batch portfolio tests importations
+import os
+import pandas as pd
+import packages.CCKP_new_api as api
+from packages.batch_portfolio import read_sites, run_portfolio, read_checkpoint, plan_units
+
+# -- FAILED UNITS AND RESUMED RUNS OF THE BATCH PORTFOLIO
+# -- A unit whose files cannot be read must fail, and not be checkpointed, so a resumed run retries it
+
+
+
+def write_sites(path):
+
+    pd.DataFrame({'site': ['a', 'b', 'c'], 'latitude': [45.0, -30.0, 60.0], 'longitude': [10.0, 150.0, -100.0]}).to_csv(path, index=False)
+
+    return read_sites(path, variables=['tas'], sources=['ERA5'])
+
+
+def test_failed_unit_is_not_checkpointed(archive, tmp_path):
+
+    sites = write_sites(tmp_path / 'sites.csv')
+    output = str(tmp_path / 'results')
+    key = plan_units(sites)[0]['key']
+
+    # The timeseries file is not in the bucket
+    summary = run_portfolio(sites, output, workers=1, progress=lambda message: None)
+    assert summary['units_failed'] == 1 and summary['units_run'] == 0
+    assert key in summary['errors'] and 'timeseries' in summary['errors'][key]
+    assert read_checkpoint(output) == {}
+
+    # The resumed run retries the unit once the file is there
+    archive(api.CCKP_api_ERA5('tas', products=['timeseries']).urls())
+    summary = run_portfolio(sites, output, workers=1, progress=lambda message: None)
+    assert summary['units_run'] == 1 and summary['units_skipped'] == 0 and summary['units_failed'] == 0
+    assert summary['rows'] == 3 * 73
+    assert read_checkpoint(output)[key]['rows'] == 3 * 73
+
+
+def test_completed_unit_is_resumed(archive, tmp_path):
+
+    sites = write_sites(tmp_path / 'sites.csv')
+    output = str(tmp_path / 'results')
+    archive(api.CCKP_api_ERA5('tas', products=['timeseries']).urls())
+
+    run_portfolio(sites, output, workers=1, progress=lambda message: None)
+    summary = run_portfolio(sites, output, workers=1, progress=lambda message: None)
+    assert summary['units_run'] == 0 and summary['units_skipped'] == 1
+
+    # A unit whose Parquet file was removed is run again
+    for root, _, names in os.walk(output):
+        for name in names:
+            if name.endswith('.parquet'):
+                os.remove(os.path.join(root, name))
+
+    summary = run_portfolio(sites, output, workers=1, progress=lambda message: None)
+    assert summary['units_run'] == 1 and summary['units_skipped'] == 0
@@ -0,0 +1,116 @@
+# Dataset cache tests importations
+import numpy as np
+import xarray as xr
+import pytest
+import packages.CCKP_new_api as api
+from packages.CCKP_new_api import S3FilePool
+from packages.CCKP_dataset_cache import DatasetCache
+from packages.CCKP_point_cache import PointCache
+
+# -- REGRESSION TESTS OF THE CACHED VARIABLES AGAINST THE HANDLES OF THE POOL
+# -- The variables are cached lazily: they must keep working when the pool closes its handles
+
+
+
+def write_files(directory, n = 3):
+
+    # Small global grids, one variable per file
+    urls = []
+    for i in range(n):
+        data = np.arange(2 * 4 * 8, dtype='float32').reshape(2, 4, 8) + 100 * i
+        dataset = xr.Dataset({'tas': (('time', 'lat', 'lon'), data)},
+                             coords={'time': [0, 1], 'lat': [-67.5, -22.5, 22.5, 67.5], 'lon': np.arange(-157.5, 180, 45.0)})
+        path = str(directory / f'file{i}.nc')
+        dataset.to_netcdf(path, engine='h5netcdf')
+        urls.append(path)
+
+    return urls
+
+
+@pytest.fixture
+def pool(monkeypatch, tmp_path):
+
+    pool = S3FilePool(max_handles=2)
+    monkeypatch.setattr(api, 's3_pool', pool)
+    monkeypatch.setattr(api, 'dataset_cache', DatasetCache(max_bytes=2 ** 20, max_entries=4))
+    monkeypatch.setattr(api, 'point_cache', PointCache(str(tmp_path / 'cache')))
+
+    return pool
+
+
+def test_cached_variables_survive_closed_handles(tmp_path, pool):
+
+    urls = write_files(tmp_path)
+    variables = [api.open_variable(url, 'tas') for url in urls]
+
+    # Point reads fill the idle handles beyond max_handles, then everything idle is closed, as batch_portfolio does
+    for url in urls:
+        api._read_point(url, 'tas', 0, 0)
+    pool.close_all()
+
+    for i, (url, variable) in enumerate(zip(urls, variables)):
+        assert float(variable.isel(time=0, lat=0, lon=0)) == 100 * i
+        assert float(api.open_variable(url, 'tas').isel(time=1, lat=3, lon=7)) == 63 + 100 * i
+
+
+def test_borrowed_handles_are_not_shared(tmp_path, pool):
+
+    url = write_files(tmp_path, 1)[0]
+
+    with pool.borrow(url) as first, pool.borrow(url) as second:
+        assert first is not second
+        assert pool.stats()['handles_borrowed'] == 2
+
+    with pool.borrow(url) as third:
+        assert third in (first, second)
+
+    pool.close_all()
+    assert pool.stats()['handles_idle'] == 0
+
+
+def test_entries_are_capped(tmp_path, pool):
+
+    urls = write_files(tmp_path, 6)
+    for url in urls:
+        api.open_variable(url, 'tas')
+
+    assert api.dataset_cache.stats()['entries'] == 4
+
+
+def test_variables_stay_lazy_by_default(tmp_path, pool):
+
+    url = write_files(tmp_path, 1)[0]
+    for _ in range(3):
+        data = api.open_variable(url, 'tas')
+
+    assert not data._in_memory
+    assert api.dataset_cache.stats()['bytes'] == 0
+
+
+def test_variables_are_decoded_when_allowed(tmp_path, pool, monkeypatch):
+
+    url = write_files(tmp_path, 1)[0]
+    monkeypatch.setattr(api, 'dataset_cache', DatasetCache(max_bytes=2 ** 20, max_entries=4, decode_bytes=2 ** 10))
+
+    assert not api.open_variable(url, 'tas')._in_memory
+    assert api.open_variable(url, 'tas')._in_memory
+
+    # A variable bigger than decode_bytes stays lazy
+    monkeypatch.setattr(api, 'dataset_cache', DatasetCache(max_bytes=2 ** 20, max_entries=4, decode_bytes=16))
+    for _ in range(3):
+        assert not api.open_variable(url, 'tas')._in_memory
+
+
+def test_request_counters_are_bounded():
+
+    cache = DatasetCache(max_bytes=2 ** 20, max_entries=4)
+
+    # The values of get (e.g. the points of many locations) are not counted
+    for i in range(100):
+        cache.get(('point', i), lambda: i)
+    assert len(cache._requests) == 0
+
+    for i in range(100):
+        cache.request(('variable', i))
+    assert len(cache._requests) == 4
+    assert cache.request(('variable', 99)) == 2 and cache.request(('variable', 0)) == 1
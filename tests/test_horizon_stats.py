@@ -0,0 +1,49 @@
+# Horizon statistics tests importations
+import numpy as np
+import pandas as pd
+from packages.point_result import PointResult
+from packages.variable_catalog import variable_catalog
+from packages.horizon_stats import horizon_stats, stats_text
+
+# -- BASELINE OF THE HORIZON STATISTICS
+# -- The projections take their 1991-2020 baseline from the historical run: without it there is no baseline
+
+
+
+def cmip6_result(scenario, first, last, offset):
+
+    years = np.arange(first, last + 1)
+    timeseries = pd.DataFrame({f'tas_{scenario}_median': offset + 0.1 * (years - 1950)}, index=pd.Index(years, name='time'))
+
+    return PointResult.from_dataframes('CMIP6', 'tas', scenario, variable_catalog().get('tas'), {'timeseries': 'Retrieved'},
+                                       {'timeseries': ['median'], 'trend': [], 'confidence': []}, timeseries, None, None, {})
+
+
+def test_projection_without_historical_has_no_baseline():
+
+    stats = horizon_stats({'tas': {'CMIP6': {'ssp245': cmip6_result('ssp245', 2015, 2100, 10)}}})
+    base = stats[stats['horizon'] == '1991-2020'].iloc[0]
+    horizon = stats[stats['horizon'] == '2050'].iloc[0]
+
+    # Only 2015-2020 are in the baseline window: it is not reported as the 1991-2020 normal
+    assert base['baseline_years'] == 6 and base['years'] == 6
+    assert np.isnan(base['mean']) and np.isnan(horizon['baseline']) and np.isnan(horizon['delta']) and np.isnan(horizon['threshold'])
+    assert horizon['mean'] == 10 + 0.1 * 100
+
+    text = stats_text(stats)
+    assert 'base - (only 6 years of 1991-2020)' in text
+    assert '2050 20.00 (-, -%, -/11)' in text
+
+
+def test_projection_with_historical_has_baseline():
+
+    climate_data = {'tas': {'CMIP6': {'historical': cmip6_result('historical', 1950, 2014, 10),
+                                      'ssp245': cmip6_result('ssp245', 2015, 2100, 10)}}}
+    stats = horizon_stats(climate_data)
+    rows = stats[(stats['scenario'] == 'ssp245')].set_index('horizon')
+
+    # The baseline joins 1991-2014 of the historical run and 2015-2020 of the projection
+    assert rows.loc['1991-2020', 'baseline_years'] == 30
+    assert np.isclose(rows.loc['2050', 'baseline'], 10 + 0.1 * (2005.5 - 1950))
+    assert np.isclose(rows.loc['2050', 'delta'], 0.1 * (2050 - 2005.5))
+    assert 'only' not in stats_text(stats)
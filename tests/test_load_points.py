@@ -0,0 +1,54 @@
+# Multi-site extraction tests importations
+import numpy as np
+import packages.CCKP_new_api as api
+
+# -- TESTS OF THE VECTORIZED MULTI-SITE EXTRACTION AGAINST THE SINGLE POINTS
+# -- load_points must give, for every site, the data and the json of retrieve_point at the same location
+
+
+
+# Duplicated sites, sites outside the grid (beyond the last cell and beyond the dateline) and cell boundaries
+SITES = {'a': (45.0, 10.0), 'b': (45.0, 10.0), 'c': (89.9, 200.0), 'd': (-90.0, -180.0), 'e': (0.0, -135.0), 'f': (-22.5, 112.5)}
+
+
+def test_era5_load_points_matches_retrieve_point(archive):
+
+    obj = api.CCKP_api_ERA5('tas')
+    archive(obj.urls())
+
+    obj.retrieve_request()
+    sites_dataframe, sites_json = obj.load_points([lat for lat, _ in SITES.values()], [lon for _, lon in SITES.values()], list(SITES))
+
+    for site, (lat, lon) in SITES.items():
+        point = api.CCKP_api_ERA5('tas')
+        point.retrieve_point(lat, lon)
+        point.make_json_to_llm()
+
+        values = sites_dataframe[sites_dataframe['site'] == site].set_index('year')['value']
+        np.testing.assert_array_equal(values.index, point.timeseries_point_dataframe.index)
+        np.testing.assert_allclose(values.values, point.timeseries_point_dataframe.iloc[:, 0].values)
+        assert sites_json[site] == point.json_to_llm
+
+    assert sites_json['a'] == sites_json['b']
+
+
+def test_cmip6_load_points_matches_retrieve_point(archive):
+
+    obj = api.CCKP_api_CMIP6('tas', 'ssp585', ['median', 'p10', 'p90'])
+    archive(obj.urls())
+
+    obj.retrieve_request()
+    sites_dataframe, sites_json = obj.load_points([lat for lat, _ in SITES.values()], [lon for _, lon in SITES.values()], list(SITES))
+
+    for site, (lat, lon) in SITES.items():
+        point = api.CCKP_api_CMIP6('tas', 'ssp585', ['median', 'p10', 'p90'])
+        point.retrieve_point(lat, lon)
+        point.make_json_to_llm()
+
+        for band in ['median', 'p10', 'p90']:
+            values = sites_dataframe[(sites_dataframe['site'] == site) & (sites_dataframe['band'] == band)].set_index('year')['value']
+            np.testing.assert_array_equal(values.index, point.timeseries_point_dataframe.index)
+            np.testing.assert_allclose(values.values, point.timeseries_point_dataframe[f'tas_ssp585_{band}'].values)
+        assert sites_json[site] == point.json_to_llm
+
+    assert sites_json['a'] == sites_json['b']
@@ -0,0 +1,84 @@
+# Open-Meteo cache tests importations
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from packages.open_meteo_cache import WeatherCache
+
+# -- TESTS OF THE OPEN-METEO CACHE WITH A FAKE ARCHIVE
+# -- The fake values depend on the exact coordinates, as the elevation-adjusted series of Open-Meteo do
+
+
+
+class FakeArchive():
+
+    def __init__(self, delay = 0.0):
+
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+
+
+    def fetch_many(self, latitudes, longitudes, variables, start, end, frequency = 'hourly', models = 'era5'):
+
+        with self._lock:
+            self.requests.append((tuple(latitudes), tuple(longitudes), tuple(variables), start, end))
+        time.sleep(self.delay)
+
+        index = pd.date_range(start, pd.Timestamp(end) + pd.Timedelta(hours=23), freq='h', name='time')
+        hours = (index - pd.Timestamp('2000-01-01')) / pd.Timedelta(hours=1)
+        frames = {i: pd.DataFrame({variable: np.sin(hours / 24 + latitude) * 10 + longitude + len(variable) for variable in variables}, index=index)
+                  for i, (latitude, longitude) in enumerate(zip(latitudes, longitudes))}
+
+        return pd.concat(frames, axis=1, names=['location', 'variable'])
+
+
+def test_cached_series_match_the_uncached_ones(tmp_path):
+
+    archive, cache = FakeArchive(), WeatherCache(str(tmp_path))
+    latitudes, longitudes = [45.07, 45.03], [7.68, 7.71]
+
+    expected = archive.fetch_many(latitudes, longitudes, ['temperature_2m'], '2010-01-01', '2011-12-31')
+    first = cache.fetch_many(archive.fetch_many, latitudes, longitudes, ['temperature_2m'], '2010-01-01', '2011-12-31')
+    requests = len(archive.requests)
+    second = cache.fetch_many(archive.fetch_many, latitudes, longitudes, ['temperature_2m'], '2010-03-01', '2011-06-30')
+
+    pd.testing.assert_frame_equal(first, expected, check_freq=False)
+    pd.testing.assert_frame_equal(second, expected.loc['2010-03-01':'2011-06-30 23:00'], check_freq=False)
+    assert len(archive.requests) == requests
+    # The locations of the same grid cell are requested with their own coordinates
+    assert archive.requests[1][:2] == (tuple(latitudes), tuple(longitudes))
+
+
+def test_concurrent_writes_keep_all_the_days(tmp_path):
+
+    archive, cache = FakeArchive(delay=0.05), WeatherCache(str(tmp_path))
+    months = [(f'2010-{m:02d}-01', (pd.Timestamp(f'2010-{m:02d}-01') + pd.offsets.MonthEnd()).strftime('%Y-%m-%d')) for m in range(1, 13)]
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        list(executor.map(lambda month: cache.fetch(archive.fetch_many, 45.0, 7.0, ['precipitation'], *month), months))
+
+    requests = len(archive.requests)
+    cache.fetch(archive.fetch_many, 45.0, 7.0, ['precipitation'], '2010-01-01', '2010-12-31')
+    assert len(archive.requests) == requests
+
+
+def test_file_evicted_during_a_read_is_a_miss(tmp_path, monkeypatch):
+
+    archive, cache = FakeArchive(), WeatherCache(str(tmp_path))
+    expected = cache.fetch(archive.fetch_many, 45.0, 7.0, ['temperature_2m'], '2010-01-01', '2010-01-31')
+    requests = len(archive.requests)
+
+    # A concurrent eviction removes the file between the read and the update of its access time
+    read_parquet = pd.read_parquet
+    def read_and_evict(path, *args, **kwargs):
+        data = read_parquet(path, *args, **kwargs)
+        os.remove(path)
+        return data
+    monkeypatch.setattr(pd, 'read_parquet', read_and_evict)
+
+    data = cache.fetch(archive.fetch_many, 45.0, 7.0, ['temperature_2m'], '2010-01-01', '2010-01-31')
+    pd.testing.assert_frame_equal(data, expected, check_freq=False)
+    assert len(archive.requests) == requests + 1
@@ -0,0 +1,49 @@
+# Payload encoder tests importations
+import json
+import numpy as np
+import pandas as pd
+import packages.CCKP_new_api as api
+from packages.payload_encoder import encode_dataframe
+
+# -- PAYLOADS OF THE ENCODER AGAINST THE PREVIOUS PANDAS OUTPUT
+# -- The point jsons must stay byte-identical to json.loads(DataFrame.round(2).astype(str).to_json())
+
+
+
+def to_json(dataframe):
+
+    # The encoding used before payload_encoder
+    return json.loads(dataframe.round(2).astype(str).to_json())
+
+
+def test_encoder_matches_to_json():
+
+    rng = np.random.default_rng(0)
+    index = pd.Index(np.arange(1950, 2101), name='time')
+
+    for dtype in ['float32', 'float64']:
+        values = rng.uniform(-1000, 1000, (len(index), 3))
+
+        # Halves of the last decimal, values rounding to zero, missing values and big values
+        values[:10, 0] = np.arange(10) + 0.005
+        values[10:20, 0] = -np.arange(10) / 1000
+        values[20:30, 1] = np.nan
+        values[30:40, 2] = rng.uniform(1e5, 1e7, 10)
+
+        dataframe = pd.DataFrame(values.astype(dtype), index=index, columns=['tas_ssp245_median', 'tas_ssp245_p10', 'tas_ssp245_p90'])
+        assert json.dumps(encode_dataframe(dataframe)) == json.dumps(to_json(dataframe))
+
+
+def test_point_payloads_match_to_json(archive):
+
+    era5 = api.CCKP_api_ERA5('tas')
+    cmip6 = api.CCKP_api_CMIP6('tas', 'ssp245', ['median', 'p10', 'p90'])
+    archive(era5.urls() + cmip6.urls())
+
+    era5.retrieve_point(45, 10)
+    assert json.dumps(era5.timeseries_point_json) == json.dumps(to_json(era5.timeseries_point_dataframe))
+    assert json.dumps(era5.trends_point_json) == json.dumps(to_json(era5.trends_point_dataframe))
+    assert json.dumps(era5.confidence_point_json) == json.dumps(to_json(era5.confidence_point_dataframe))
+
+    cmip6.retrieve_point(45, 10)
+    assert json.dumps(cmip6.timeseries_point_json) == json.dumps(to_json(cmip6.timeseries_point_dataframe))
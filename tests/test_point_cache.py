@@ -0,0 +1,50 @@
+# Point cache tests importations
+import numpy as np
+import xarray as xr
+import pytest
+import packages.CCKP_new_api as api
+from packages.CCKP_new_api import S3FilePool
+from packages.CCKP_dataset_cache import DatasetCache
+from packages.CCKP_point_cache import PointCache
+
+# -- TESTS OF THE CACHED POINTS ON DIFFERENT GRID LAYOUTS
+# -- A cached point must be the cell that a fresh extraction (and xarray) selects, whatever the order of the coordinates
+
+
+
+GRIDS = {
+    'ascending': (np.arange(-89.875, 90, 0.25), np.arange(-179.875, 180, 0.25)),
+    'descending': (np.arange(-89.875, 90, 0.25)[::-1], np.arange(-179.875, 180, 0.25)),
+    '0-360': (np.arange(-89.875, 90, 0.25), np.arange(0.125, 360, 0.25)),
+}
+
+LOCATIONS = [(45.0, 10.0), (45.1, 10.1), (44.9, 9.9), (-33.87, 151.21), (0.0, 0.0), (60.0, 185.0), (60.0, 190.0), (-60.0, 359.9)]
+
+
+@pytest.fixture
+def caches(monkeypatch, tmp_path):
+
+    monkeypatch.setattr(api, 's3_pool', S3FilePool())
+    monkeypatch.setattr(api, 'dataset_cache', DatasetCache(max_bytes=0))
+    monkeypatch.setattr(api, 'point_cache', PointCache(str(tmp_path / 'cache')))
+
+
+@pytest.mark.parametrize('layout', GRIDS)
+def test_cached_points_match_xarray(tmp_path, caches, layout):
+
+    lat, lon = GRIDS[layout]
+    # The value of a cell encodes its indices in the file
+    values = (np.arange(len(lat))[:, None] * 10000 + np.arange(len(lon))[None, :]).astype('float64')[None]
+    path = str(tmp_path / f'{layout}.nc')
+    xr.Dataset({'tas': (('time', 'lat', 'lon'), values)}, coords={'time': [0], 'lat': lat, 'lon': lon}).to_netcdf(path, engine='h5netcdf')
+
+    with xr.open_dataset(path, engine='h5netcdf') as dataset:
+        # First pass fills the cache, second pass reads from it
+        for rerun in [False, True]:
+            hits = api.point_cache.stats()['hits']
+            for latitude, longitude in LOCATIONS:
+                expected = dataset['tas'].sel(lat=latitude, lon=longitude, method='nearest')
+                point = api.read_point(path, 'tas', latitude, longitude)
+                assert point['values'][0] == float(expected[0]), (layout, latitude, longitude)
+
+    assert api.point_cache.stats()['hits'] - hits == len(LOCATIONS)
@@ -0,0 +1,39 @@
+# Point extraction tests importations
+import numpy as np
+import xarray as xr
+import pytest
+from packages.CCKP_point_extract import nearest_index, extract_point
+
+# -- TESTS OF THE NEAREST CELL SELECTION AGAINST XARRAY
+# -- The whole-degree coordinates are half way between two cells of the 0.25° grids, so the ties must match xarray
+
+
+
+LATITUDES = np.arange(-89.875, 90, 0.25)
+
+
+@pytest.mark.parametrize('coordinates', [LATITUDES, LATITUDES[::-1]], ids=['ascending', 'descending'])
+def test_nearest_index_matches_xarray(coordinates):
+
+    data = xr.DataArray(np.arange(len(coordinates)), coords={'lat': coordinates}, dims='lat')
+
+    for value in np.arange(-90, 90.01, 0.125):
+        assert nearest_index(coordinates, value) == int(data.sel(lat=value, method='nearest'))
+
+
+@pytest.mark.parametrize('descending', [False, True], ids=['ascending', 'descending'])
+def test_extract_point_matches_xarray(tmp_path, descending):
+
+    lat = np.arange(40.125, 50, 0.25)[::-1 if descending else 1]
+    lon = np.arange(5.125, 15, 0.25)
+    values = np.random.default_rng(0).random((3, len(lat), len(lon)))
+    path = str(tmp_path / 'grid.nc')
+    xr.Dataset({'tas': (('time', 'lat', 'lon'), values)}, coords={'time': [0, 1, 2], 'lat': lat, 'lon': lon}).to_netcdf(path, engine='h5netcdf')
+
+    with xr.open_dataset(path, engine='h5netcdf') as dataset:
+        for latitude, longitude in [(45.0, 10.0), (42.3, 7.0), (48.125, 12.6)]:
+            expected = dataset['tas'].sel(lat=latitude, lon=longitude, method='nearest')
+            with open(path, 'rb') as f:
+                point = extract_point(f, 'tas', latitude, longitude)
+            assert point['lat'] == float(expected['lat']) and point['lon'] == float(expected['lon'])
+            np.testing.assert_array_equal(point['values'], expected.values)
@@ -0,0 +1,46 @@
+# Reference index tests importations
+import numpy as np
+import pandas as pd
+import xarray as xr
+from packages.CCKP_point_extract import extract_point, extract_point_from_dataset
+from packages.CCKP_reference_index import ReferenceIndex, build_index
+
+# -- TESTS OF THE REFERENCE INDEX AGAINST THE NETCDF FILES
+# -- A point read through the kerchunk references must give the values read directly from the file with h5netcdf
+
+
+
+def write_grid(path):
+
+    # Chunked and packed like the CCKP files: the references must keep the chunks and the CF decoding
+    lat = np.arange(-89.5, 90, 1.0)
+    lon = np.arange(-179.5, 180, 1.0)
+    values = np.random.default_rng(0).uniform(-40, 40, (5, len(lat), len(lon)))
+    values[:, :10, :10] = np.nan
+
+    dataset = xr.Dataset({'timeseries-tas-annual-mean': (('time', 'lat', 'lon'), values)},
+                         coords={'time': pd.to_datetime([f'{year}-01-01' for year in range(2015, 2020)]), 'lat': lat, 'lon': lon})
+    encoding = {'timeseries-tas-annual-mean': {'chunksizes': (5, 30, 30), 'dtype': 'int16', 'scale_factor': 0.01, '_FillValue': -32768}}
+    dataset.to_netcdf(path, engine='h5netcdf', encoding=encoding)
+
+
+def test_indexed_point_matches_h5netcdf(tmp_path):
+
+    path = str(tmp_path / 'grid.nc')
+    index_path = str(tmp_path / 'index.json')
+    write_grid(path)
+
+    assert build_index([path], index_path) == {}
+
+    index = ReferenceIndex(index_path)
+    assert path in index and str(tmp_path / 'other.nc') not in index
+
+    dataset = index.open_dataset(path)
+    for latitude, longitude in [(45.0, 10.0), (-85.2, -175.3), (0.0, 179.9), (89.9, -0.4)]:
+        with open(path, 'rb') as f:
+            expected = extract_point(f, 'timeseries-tas-annual-mean', latitude, longitude)
+        point = extract_point_from_dataset(dataset, 'timeseries-tas-annual-mean', latitude, longitude)
+
+        assert (point['lat_index'], point['lon_index']) == (expected['lat_index'], expected['lon_index'])
+        np.testing.assert_array_equal(point['values'], expected['values'])
+        np.testing.assert_array_equal(point['time'], expected['time'])
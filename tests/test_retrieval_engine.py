@@ -0,0 +1,47 @@
+# Retrieval engine tests importations
+import os
+import packages.CCKP_new_api as api
+from packages.retrieval_engine import retrieve, plan_jobs
+
+# -- FAILED JOBS OF THE RETRIEVAL ENGINE
+# -- A job with a failed product must not be stored as loaded, so the next retrieval plans it again
+
+
+
+def test_failed_job_is_retried(archive):
+
+    urls = api.CCKP_api_ERA5('tas').urls()
+    archive(urls)
+
+    # The 1991-2020 trend is missing from the bucket
+    missing = [url for url in urls if '/trend-' in url and url.endswith('_1991-2020.nc')][0]
+    os.remove(archive.path(missing))
+
+    result = retrieve(['tas'], [True, False], [], ['median'], 45, 10, max_workers=1)
+    assert result.jobs[0]['status'] == 'Partial'
+    assert 'trend' in result.jobs[0]['error']
+    assert result.data == {}
+
+    jobs, skipped = plan_jobs(['tas'], [True, False], [], result.data)
+    assert jobs == [('tas', 'ERA5', 'historical')] and skipped == []
+
+    # Once the file is there, the retry completes and the job is then skipped
+    archive([missing])
+    result = retrieve(['tas'], [True, False], [], ['median'], 45, 10, loaded=result.data, max_workers=1)
+    assert result.status == 'Retrieved'
+    assert result.data['tas']['ERA5']['historical'].status_dict['trend'] == 'Retrieved'
+
+    jobs, skipped = plan_jobs(['tas'], [True, False], [], result.data)
+    assert jobs == [] and skipped == [('tas', 'ERA5', 'historical')]
+
+
+def test_loaded_result_with_error_is_planned_again():
+
+    obj = api.CCKP_api_CMIP6('tas', 'ssp245', ['median'])
+    loaded = {'tas': {'CMIP6': {'ssp245': obj}}}
+
+    obj.status_dict['timeseries'] = 'Error'
+    assert plan_jobs(['tas'], [False, True], ['ssp245'], loaded)[0] == [('tas', 'CMIP6', 'ssp245')]
+
+    obj.status_dict['timeseries'] = 'Retrieved'
+    assert plan_jobs(['tas'], [False, True], ['ssp245'], loaded)[0] == []
@@ -0,0 +1,59 @@
+# Screening bundle tests importations
+import numpy as np
+import packages.CCKP_new_api as api
+from packages.screening_bundle import build_bundle, ScreeningBundle
+
+# -- PAYLOADS OF THE SCREENING BUNDLE AGAINST THE LIVE RETRIEVAL
+# -- A float32 bundle must give the json_to_llm of retrieve_point + make_json_to_llm, a float16 bundle only approximately
+
+
+
+CODES = ['tas', 'hd30', 'pr']
+LOCATIONS = [(45.0, 10.0), (-30.0, 150.0), (0.0, -135.0), (89.9, 200.0)]
+
+
+def live_payload(code, lat, lon):
+
+    obj = api.CCKP_api_ERA5(code, True)
+    obj.retrieve_point(lat, lon)
+    obj.make_json_to_llm()
+
+    return obj.json_to_llm
+
+
+def numbers(payload):
+
+    # The numbers of the values of a payload, in order
+    return np.array([float(v) for product in payload['values'].values() for column in product.values() for v in column.values()])
+
+
+def build(archive, tmp_path, dtype):
+
+    archive([url for code in CODES for url in api.CCKP_api_ERA5(code, True).urls()])
+    build_bundle(str(tmp_path / dtype), CODES, dtype, progress=lambda message: None)
+
+    return ScreeningBundle(str(tmp_path / dtype))
+
+
+def test_float32_bundle_matches_live_payloads(archive, tmp_path):
+
+    bundle = build(archive, tmp_path, 'float32')
+
+    for lat, lon in LOCATIONS:
+        for code, payload in zip(CODES, bundle.screening_payloads(lat, lon, CODES)):
+            assert payload == live_payload(code, lat, lon)
+
+
+def test_float16_bundle_is_close_to_live_payloads(archive, tmp_path):
+
+    bundle = build(archive, tmp_path, 'float16')
+
+    for lat, lon in LOCATIONS:
+        for code, payload in zip(CODES, bundle.screening_payloads(lat, lon, CODES)):
+            live = live_payload(code, lat, lon)
+
+            # Same products, columns and statuses; the values within the precision of float16 and the rounding
+            assert {k: v for k, v in payload.items() if k != 'values'} == {k: v for k, v in live.items() if k != 'values'}
+            assert {k: {c: list(v) for c, v in p.items()} for k, p in payload['values'].items()} == \
+                   {k: {c: list(v) for c, v in p.items()} for k, p in live['values'].items()}
+            np.testing.assert_allclose(numbers(payload), numbers(live), rtol=2 ** -10, atol=0.01)
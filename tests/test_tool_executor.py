@@ -0,0 +1,41 @@
+# Tool executor tests importations
+import json
+import time
+from types import SimpleNamespace
+from packages.tool_executor import run_tool_calls
+
+# -- TIMEOUTS OF THE CONCURRENT TOOL CALLS
+# -- The timeout of a call counts from its start: the calls waiting for a free worker must not time out
+
+
+
+def tool_call(i, name, arguments):
+    return SimpleNamespace(id=f'call_{i}', function=SimpleNamespace(name=name, arguments=json.dumps(arguments)))
+
+
+def wait(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def test_queued_calls_do_not_time_out():
+
+    # 4 calls of 0.3 s on 2 workers: the last two start after 0.3 s and end after 0.6 s, beyond the timeout of 0.5 s
+    calls = [tool_call(i, 'wait', {'seconds': 0.3}) for i in range(4)]
+    results = run_tool_calls(calls, {'wait': wait}, default_timeout=0.5, max_workers=2)
+
+    assert [result['error'] for result in results] == [None] * 4
+    assert [result['value'] for result in results] == [0.3] * 4
+    assert results[-1]['elapsed'] >= 0.6
+
+
+def test_timed_out_call_frees_its_worker():
+
+    # The first call never answers in time: the second one still runs, on the only worker
+    calls = [tool_call(0, 'wait', {'seconds': 2}), tool_call(1, 'wait', {'seconds': 0.1})]
+    start = time.perf_counter()
+    results = run_tool_calls(calls, {'wait': wait}, default_timeout=0.3, max_workers=1)
+
+    assert results[0]['timed_out'] and not results[1]['timed_out']
+    assert results[1]['value'] == 0.1
+    assert time.perf_counter() - start < 1.5